@@ -7,7 +7,8 @@ Two entry points:
 """
 
 from __future__ import annotations
-import logging, textwrap
+import logging, textwrap, hashlib, threading
+from cachetools import LRUCache
 from openai import AzureOpenAI
 from app.core.config import settings
 import json, re
@@ -55,7 +56,28 @@ _SYSTEM_ERR = (
     "Return ONLY the fully corrected CadQuery script that runs without errors.\n"
 )
 
-def fix_cadquery (code: str, error: str, system_prompt: str | None = None) -> str:
+# (code digest, error digest) → fixed code, for fixes whose script then ran.
+# Unverified fixes are never replayed: a fresh LLM call is the retry's only
+# chance when the previous fix failed too.
+_FIX_MEMO: LRUCache = LRUCache(maxsize=256)
+_FIX_MEMO_LOCK = threading.Lock()
+_NO_USAGE = {"prompt_tokens": 0, "completion_tokens": 0}
+
+def _fix_key(code: str, error_digest: str) -> tuple[str, str]:
+    return hashlib.sha256(code.encode("utf-8")).hexdigest(), error_digest
+
+def remember_fix(code: str, error_digest: str, fixed: str) -> None:
+    """Memoize fix_cadquery(code, <error>) → fixed once `fixed` ran successfully."""
+    with _FIX_MEMO_LOCK:
+        _FIX_MEMO[_fix_key(code, error_digest)] = fixed
+
+def fix_cadquery (code: str, error: str, system_prompt: str | None = None,
+                  error_digest: str | None = None) -> str:
+    if error_digest and system_prompt is None:
+        with _FIX_MEMO_LOCK:
+            hit = _FIX_MEMO.get(_fix_key(code, error_digest))
+        if hit is not None:
+            return hit, _NO_USAGE   # nothing billed for a replayed fix
     prompt = textwrap.dedent(f"""
         <SCRIPT>
         ```python
@@ -79,7 +101,8 @@ def fix_cadquery (code: str, error: str, system_prompt: str | None = None) -> st
         #temperature=0.2,
     )
     content = resp.choices[0].message.content or ""
-    return _strip_fence(content), resp.usage  # clean up the code, remove fences and leading “python” tag
+    fixed = _strip_fence(content)  # clean up the code, remove fences and leading “python” tag
+    return fixed, resp.usage
 
 
 # ───────────────────── 2. User-driven design edit ───────────────────────
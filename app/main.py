@@ -1,6 +1,6 @@
 # app/main.py
 from __future__ import annotations
-import json, pathlib, uuid, time, re
+import json, pathlib, uuid, time, re, hashlib, hmac, base64, itertools
 from typing import Optional
 import logging
 from pathlib import Path
@@ -10,17 +10,23 @@ import sys
 from io import BytesIO
 from PIL import Image
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse, Response
 import os
 import reportlab
+from reportlab.lib.pagesizes import letter
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, ListFlowable, ListItem
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.lib.units import inch
 import asyncio
 import threading
+import concurrent.futures
 
 from fastapi import FastAPI, HTTPException, BackgroundTasks, Body, Query, Depends
 from pydantic import BaseModel, Field
 from traceback import format_exc
 from fastapi.middleware.cors import CORSMiddleware
 from operator import itemgetter
+from cachetools import LRUCache
 from fastapi.responses import StreamingResponse, RedirectResponse
 from app.services.storage import last_chat_messages, download_blob_to_temp
 from app.routes.share import share_preview_html
@@ -29,9 +35,10 @@ from app.agents.brainstorm      import heavy_brainstorm
 # from app.agents.code_creation_azure   import generate_cadquery
 from app.agents.code_creation_aws   import generate_cadquery
 from app.services.feature_tree_sync import feature_tree_sync
-from app.agents.code_edit       import fix_cadquery, edit_cadquery
+from app.agents.code_edit       import fix_cadquery, edit_cadquery, remember_fix
 from app.services.cad_generation_integration import cad_integration
-from app.services.sandbox       import run_cadquery, SandboxError
+from app.services.sandbox       import run_cadquery, run_cadquery_bytes, SandboxError, SandboxBusy
+from app.services               import sandbox
 from app.agents.brainstorm_edit import edit_brainstorm
 from app.services               import storage
 from app.agents.intent_classifier import classify_intents
@@ -40,6 +47,7 @@ from app.services.versioning import snapshot_bundle
 from app.agents.planner import make_plan
 from fastapi import Depends, Request
 from app.services.auth import get_current_user
+from app.services.rate_limit import limit_ip
 from app.routes.helpers import artifact_id
 from app.routes import community 
 from app.routes import thumbnails
@@ -53,13 +61,17 @@ from app.api.v1.auth_firebase import router as auth_firebase_router
 from app.routes import feature_tree
 from app.routes import account
 from google.cloud import firestore
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound
 from app.services.storage_gcp import C_META
+from app.services.gcp_clients import get_firestore_client, get_publisher_client
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import app.api.v1.auth_magic as magic_router
 from app.routes import billing
-from openai import APIStatusError
+from openai import APIStatusError, APIConnectionError, RateLimitError
+from tenacity import Retrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 
-app = FastAPI(title="Makistry MVP")
+# orjson for every JSON body (routers inherit this default)
+app = FastAPI(title="Makistry MVP", default_response_class=ORJSONResponse)
 SESSION_ID = lambda: f"sess_{uuid.uuid4().hex[:6]}"
 TIMESTAMP  = lambda: int(time.time() * 1000)
 BASE = Path(__file__).parent
@@ -92,12 +104,12 @@ if static_path.exists():
 LOCK_TTL_S = int(os.getenv("CODEGEN_LOCK_TTL_S", "900"))  # 15 min default
 
 def _now_ms() -> int:
-    return int(time.time() * 1000)
+    return time.time_ns() // 1_000_000  # integer clock read, no float round-trip
 
 def _acquire_codegen_lock(project_id: str, user_id: str, session_id: str, ttl_s: int = LOCK_TTL_S):
     """Returns (acquired: bool, info: dict). Uses Firestore transaction on C_META/{project_id}."""
     doc = C_META.document(project_id)
-    tx = firestore.Client().transaction()
+    tx = get_firestore_client().transaction()
 
     @firestore.transactional
     def _do(t):
@@ -126,7 +138,7 @@ def _acquire_codegen_lock(project_id: str, user_id: str, session_id: str, ttl_s:
 def _release_codegen_lock(project_id: str, session_id: str | None, force: bool = False):
     """Releases the codegen lock if owned or if force=True. Returns True/False."""
     doc = C_META.document(project_id)
-    tx = firestore.Client().transaction()
+    tx = get_firestore_client().transaction()
 
     @firestore.transactional
     def _do(t):
@@ -165,6 +177,66 @@ def project_state(project_id: str):
 def _api_project_state(project_id: str = Query(...)):
     return project_state(project_id)
 
+@app.on_event("startup")
+def _warm_cadquery_pool():
+    # spawn + import CadQuery in the workers before the first request lands
+    try:
+        sandbox.warm_pool()
+    except Exception as e:
+        print(f"[Makistry] CadQuery pool warm-up failed: {e}", file=sys.stderr)
+
+@app.on_event("shutdown")
+def _stop_cadquery_pool():
+    sandbox.shutdown_pool()
+
+# ───────── Stripe webhook retries ─────────
+WEBHOOK_DRAIN_INTERVAL_S = 60
+_webhook_drain_task: asyncio.Task | None = None
+
+async def _webhook_drain_loop():
+    while True:
+        await asyncio.sleep(WEBHOOK_DRAIN_INTERVAL_S)
+        try:
+            await asyncio.to_thread(billing.drain_webhook_events)
+        except Exception as e:
+            print(f"[Makistry] webhook drain failed: {e}", file=sys.stderr)
+
+@app.on_event("startup")
+async def _start_webhook_drain():
+    global _webhook_drain_task
+    _webhook_drain_task = asyncio.create_task(_webhook_drain_loop())
+
+@app.on_event("shutdown")
+async def _stop_webhook_drain():
+    if _webhook_drain_task is not None:
+        _webhook_drain_task.cancel()
+
+# ───────── View counter flush ─────────
+_view_flush_task: asyncio.Task | None = None
+
+async def _view_flush_loop():
+    while True:
+        await asyncio.sleep(storage.VIEW_FLUSH_INTERVAL_S)
+        try:
+            await asyncio.to_thread(storage.flush_views)
+        except Exception as e:
+            print(f"[Makistry] view flush failed: {e}", file=sys.stderr)
+
+@app.on_event("startup")
+async def _start_view_flush():
+    global _view_flush_task
+    _view_flush_task = asyncio.create_task(_view_flush_loop())
+
+@app.on_event("shutdown")
+async def _stop_view_flush():
+    if _view_flush_task is not None:
+        _view_flush_task.cancel()
+    # don't lose the last few seconds of views on deploy / scale-down
+    try:
+        await asyncio.to_thread(storage.flush_views)
+    except Exception as e:
+        print(f"[Makistry] final view flush failed: {e}", file=sys.stderr)
+
 @app.get("/api/healthz")
 def healthz():
     return {"ok": True}
@@ -280,17 +352,17 @@ def _export_step_bg(
     try:
         logger.info(f"Starting STEP export for project {project_id}, version {code_ver}")
         
-        # Run CadQuery to generate STEP file
-        step_path = run_cadquery(code, ext="stp")
-        logger.info(f"Generated STEP file at: {step_path}")
+        # Run CadQuery to generate STEP file (kept in memory, no local copy)
+        step_bytes, step_name = run_cadquery_bytes(code, ext="stp")
+        logger.info(f"Generated STEP file {step_name} ({len(step_bytes)} bytes)")
 
         # Upload to storage (prefer gz upload if available)
         try:
-            url, gcs_path = storage.upload_step_gz(step_path, project_id, code_ver, ttl_sec=86_400)
+            url, gcs_path = storage.upload_step_gz_bytes(step_bytes, project_id, code_ver, ttl_sec=86_400)
             logger.info(f"Uploaded STEP (gz) to: {gcs_path}")
         except AttributeError:
             # Fallback to regular geometry upload
-            url, gcs_path = storage.upload_geometry(step_path, project_id, code_ver, "step", ttl_sec=86_400)
+            url, gcs_path = storage.upload_geometry_bytes(step_bytes, project_id, code_ver, "step", ttl_sec=86_400)
             logger.info(f"Uploaded STEP to: {gcs_path}")
 
         # Store artifact record
@@ -302,7 +374,7 @@ def _export_step_bg(
             blob_url=url,
             data={
                 "export": "step",
-                "filename": Path(step_path).name,
+                "filename": step_name,
                 "gcs_path": gcs_path,
                 "source_code_ver": int(code_ver),
                 "design_ver": int(code_ver),
@@ -350,6 +422,86 @@ def _export_step_bg(
             logger.error(f"Failed to release STEP lock: {e}")
 
 
+# --- STEP export queue --------------------------------------------------------
+# With STEP_EXPORT_TOPIC set, exports are published to Pub/Sub and a push
+# subscription drives /internal/step-worker (on any instance), so jobs survive
+# restarts and drain N-wide. Without it we fall back to in-process execution.
+STEP_EXPORT_TOPIC = os.getenv("STEP_EXPORT_TOPIC", "")     # projects/<p>/topics/<t>
+STEP_WORKER_TOKEN = os.getenv("STEP_WORKER_TOKEN", "")     # ?token=… on the push URL
+
+def _enqueue_step_export(
+    tasks: BackgroundTasks | None,
+    project_id: str,
+    session_id: str,
+    user_id: str,
+    code: str,
+    code_ver: int,
+    *,
+    award_on_complete: bool = False,
+) -> None:
+    if STEP_EXPORT_TOPIC:
+        try:
+            payload = {
+                "project_id": project_id,
+                "session_id": session_id,
+                "user_id": user_id,
+                "code": code,
+                "code_ver": int(code_ver),
+                "award_on_complete": award_on_complete,
+            }
+            get_publisher_client().publish(
+                STEP_EXPORT_TOPIC,
+                data=json.dumps(payload).encode("utf-8"),
+                ordering_key=project_id,   # keep per-project STEP builds in order
+            ).result(timeout=10)
+            return
+        except Exception as e:
+            logger.warning(f"[step_queue] publish failed, running in-process: {e}")
+            # a failed ordered publish pauses the key until resumed
+            try:
+                get_publisher_client().resume_publish(STEP_EXPORT_TOPIC, project_id)
+            except Exception:
+                pass
+
+    args = (project_id, session_id, user_id, code, code_ver)
+    kwargs = {"award_on_complete": award_on_complete}
+    if tasks is not None:
+        tasks.add_task(_export_step_bg, *args, **kwargs)
+    else:
+        threading.Thread(target=_export_step_bg, args=args, kwargs=kwargs, daemon=True).start()
+
+@app.post("/internal/step-worker", include_in_schema=False)
+def step_worker(envelope: dict = Body(...), token: str = Query("")):
+    """
+    Pub/Sub push target: runs one queued STEP export. The subscription's ack
+    deadline must outlast a run (see README); a redelivery that still arrives
+    while a run is going, or after it finished, is acked without re-running.
+    """
+    if not STEP_WORKER_TOKEN or not hmac.compare_digest(token, STEP_WORKER_TOKEN):
+        raise HTTPException(403, "Forbidden")
+    try:
+        raw = base64.b64decode((envelope.get("message") or {}).get("data") or "")
+        job = json.loads(raw)
+    except Exception:
+        # malformed message: ack it (2xx) so Pub/Sub doesn't redeliver forever
+        logger.error("[step_worker] dropping malformed message")
+        return {"ok": False}
+
+    project_id, code_ver = job["project_id"], int(job["code_ver"])
+    if _step_artifact_exists(project_id, code_ver):
+        logger.info(f"[step_worker] STEP already exported for {project_id}:{code_ver}")
+        return {"ok": True}
+    if not _claim_step_run(project_id, code_ver):
+        logger.info(f"[step_worker] duplicate delivery for {project_id}:{code_ver}, already running")
+        return {"ok": True}
+
+    _export_step_bg(
+        project_id, job["session_id"], job["user_id"], job["code"], code_ver,
+        award_on_complete=bool(job.get("award_on_complete")),
+    )
+    return {"ok": True}
+
+
 def _enforce_ai_quota_or_402(user_id: str):
     allowed, info = storage.check_ai_allowed(user_id)
     if not allowed:
@@ -482,6 +634,96 @@ MAX_RETRIES = 5
 logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Pacing between sandbox attempts / LLM fix calls (seconds, full jitter)
+RETRY_BACKOFF_MIN = 0.2
+RETRY_BACKOFF_MAX = 4.0
+_LLM_TRANSIENT = (RateLimitError, APIConnectionError, ConnectionError)
+
+def _code_digest(code: str) -> str:
+    return hashlib.sha256(code.encode("utf-8")).hexdigest()
+
+def _usage_tokens(usage) -> tuple[int, int]:
+    if isinstance(usage, dict):
+        return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    return getattr(usage, "prompt_tokens", 0), getattr(usage, "completion_tokens", 0)
+
+# temp dirs / object addresses differ between runs of the same failure
+_ERROR_NOISE_RX = re.compile(r"cqrun_\w+|0x[0-9a-fA-F]+")
+
+def _error_digest(error: str) -> str:
+    return hashlib.sha256(_ERROR_NOISE_RX.sub("", error).encode("utf-8")).hexdigest()
+
+def _fix_with_backoff(code: str, error: str):
+    """fix_cadquery, retried with exponential backoff on rate limits / connection drops."""
+    for attempt in Retrying(
+        wait=wait_random_exponential(min=RETRY_BACKOFF_MIN, max=RETRY_BACKOFF_MAX),
+        stop=stop_after_attempt(MAX_RETRIES),
+        retry=retry_if_exception_type(_LLM_TRANSIENT),
+        reraise=True,
+    ):
+        with attempt:
+            return fix_cadquery(code, error, error_digest=_error_digest(error))
+
+class _FixStalled(Exception):
+    """fix_cadquery handed back a script that already failed; stop retrying."""
+
+def _run_with_fixes(code: str, on_fix=None, raise_fix_errors: bool = False
+                    ) -> tuple[tuple[bytes, str] | None, str, str | None]:
+    """
+    Run CadQuery, asking fix_cadquery() to repair the script between attempts.
+    The whole loop runs under one tenacity policy (full-jitter exponential
+    backoff, MAX_RETRIES attempts, retried on SandboxError only), and we stop
+    early when the fixer hands back a script we already saw fail.
+    A failing fixer is skipped (same script re-run next attempt) unless
+    raise_fix_errors, in which case its exception propagates to the caller.
+    Returns ((geometry_bytes, filename) | None, final_code, last_error).
+    """
+    failed: set[str] = set()
+    state = {"code": code, "error": None, "fix": None}
+
+    def _attempt(attempt_number: int):
+        try:
+            result = run_cadquery_bytes(state["code"])
+        except SandboxBusy as e:
+            state["error"] = str(e)
+            raise   # the script never ran: back off and retry, nothing to fix
+        except Exception as e:
+            state["error"] = str(e)
+        else:
+            if state["fix"] is not None:   # only a fix that ran is worth replaying
+                remember_fix(*state["fix"])
+            return result
+        failed.add(_code_digest(state["code"]))
+        if attempt_number < MAX_RETRIES:   # no point fixing after the last run
+            try:
+                new_code, usage = _fix_with_backoff(state["code"], state["error"])
+            except Exception:
+                if raise_fix_errors:
+                    raise
+                new_code = None
+            if new_code is not None:
+                if on_fix is not None:
+                    on_fix(usage)
+                if _code_digest(new_code) in failed:
+                    logger.info("[sandbox] fix_cadquery returned already-failed code; giving up")
+                    raise _FixStalled()
+                state["fix"] = (state["code"], _error_digest(state["error"]), new_code)
+                state["code"] = new_code
+        raise SandboxError(state["error"])
+
+    try:
+        for attempt in Retrying(
+            wait=wait_random_exponential(min=RETRY_BACKOFF_MIN, max=RETRY_BACKOFF_MAX),
+            stop=stop_after_attempt(MAX_RETRIES),
+            retry=retry_if_exception_type(SandboxError),
+            reraise=True,
+        ):
+            with attempt:
+                return _attempt(attempt.retry_state.attempt_number), state["code"], None
+    except (SandboxError, _FixStalled):
+        pass
+    return None, state["code"], state["error"]
+
 @app.post("/generate-design")
 def generate_design_route(data: DesignIn, tasks: BackgroundTasks, user=Depends(get_current_user)):
     """
@@ -709,33 +951,21 @@ def _sandbox_flow(
     export = export.lower()
 
     try:
-        # --- retry loop for sandbox run (same logic you had) ---
-        file_path: str | None = None
-        last_error: str | None = None
-        for attempt in range(MAX_RETRIES):
+        # --- retry loop for sandbox run (paced, see _run_with_fixes) ---
+        def _log_fix(usage1):
+            tokens_prompt, tokens_comp = _usage_tokens(usage1)
             try:
-                file_path = run_cadquery(code)
-                last_error = None
-                break
-            except Exception as e:
-                last_error = str(e)
-                try:
-                    code, usage1 = fix_cadquery(code, last_error)
-                    tokens_prompt = getattr(usage1, "prompt_tokens", 0)
-                    tokens_comp   = getattr(usage1, "completion_tokens", 0)
-                    if isinstance(usage1, dict):
-                        tokens_prompt = usage1.get("prompt_tokens", 0)
-                        tokens_comp   = usage1.get("completion_tokens", 0)
-                    storage.log_operation(
-                        user_id, project_id, session_id,
-                        op_type="code_fix", agent="o4-mini",
-                        tokens_prompt=tokens_prompt, tokens_comp=tokens_comp, latency_ms=0
-                    )
-                except Exception:
-                    # Keep retrying even if fix step fails once
-                    pass
+                storage.log_operation(
+                    user_id, project_id, session_id,
+                    op_type="code_fix", agent="o4-mini",
+                    tokens_prompt=tokens_prompt, tokens_comp=tokens_comp, latency_ms=0
+                )
+            except Exception:
+                pass
 
-        if not file_path:
+        geom, code, last_error = _run_with_fixes(code, on_fix=_log_fix)
+
+        if not geom:
             logger.error("Initial sandbox failed after retries:\n%s", format_exc())
             storage.log_operation(
                 user_id, project_id, session_id,
@@ -745,9 +975,10 @@ def _sandbox_flow(
             )
             return
 
-        # --- upload STL + cad_file artifact ---
-        blob_url, gcs_path = storage.upload_geometry(
-            file_path, project_id, code_ver, "stl", ttl_sec=86_400
+        # --- upload STL + cad_file artifact (straight from memory) ---
+        stl_bytes, filename = geom
+        blob_url, gcs_path = storage.upload_geometry_bytes(
+            stl_bytes, project_id, code_ver, "stl", ttl_sec=86_400
         )
         try:
             slot_path = storage.geometry_blob_path(project_id, code_ver, "stl")
@@ -765,7 +996,7 @@ def _sandbox_flow(
             blob_url=blob_url,
             data={
                 "export": export,
-                "filename": Path(file_path).name,
+                "filename": filename,
                 "gcs_path": gcs_path,
                 "design_ver": int(code_ver),
             },
@@ -789,17 +1020,13 @@ def _sandbox_flow(
         except Exception as e:
             logger.warning(f"[sandbox_flow] Failed to update project meta: {e}")
 
-        logger.info(f"[sandbox_flow] About to start STEP export thread for project {project_id}")
+        logger.info(f"[sandbox_flow] About to queue STEP export for project {project_id}")
         try:
-            threading.Thread(
-                target=_export_step_bg,
-                args=(project_id, session_id, user_id, code, code_ver),
-                kwargs={"award_on_complete": False},
-                daemon=True,
-            ).start()
-            logger.info(f"[sandbox_flow] Successfully started STEP export thread for project {project_id}")
+            _enqueue_step_export(None, project_id, session_id, user_id, code, code_ver,
+                                 award_on_complete=False)
+            logger.info(f"[sandbox_flow] Successfully queued STEP export for project {project_id}")
         except Exception as e:
-            logger.warning(f"[sandbox_flow] Failed to start STEP export thread: {e}")
+            logger.warning(f"[sandbox_flow] Failed to queue STEP export: {e}")
 
         # Log success for the sandbox op
         logger.info(f"[sandbox_flow] About to log sandbox operation success for project {project_id}")
@@ -834,9 +1061,44 @@ def _sandbox_flow(
             pass
 
 
+# ─────────────────────── Single-flight ───────────────────────────
+# Double-clicks / client retries can fire the same heavy request twice within
+# milliseconds. The first caller does the work; identical callers that arrive
+# while it is running wait for and share its result (or exception).
+_SF_LOCK = threading.Lock()
+_SF_CALLS: dict[str, concurrent.futures.Future] = {}
+
+def _flight_key(*parts) -> str:
+    raw = ":".join("" if p is None else str(p) for p in parts)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+def _single_flight(key: str, fn):
+    with _SF_LOCK:
+        fut = _SF_CALLS.get(key)
+        leader = fut is None
+        if leader:
+            fut = _SF_CALLS[key] = concurrent.futures.Future()
+    if not leader:
+        return fut.result()
+    try:
+        result = fn()
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
+    else:
+        fut.set_result(result)
+        return result
+    finally:
+        with _SF_LOCK:
+            _SF_CALLS.pop(key, None)
+
 # ─────────────────────── Edit Design  ────────────────────────────
 @app.post("/edit-design")
 def edit_design_route(data: CadEditIn, tasks: BackgroundTasks, user=Depends(get_current_user)):
+    key = _flight_key("edit-design", user["sub"], data.project_id, data.cad_code_version, data.user_query)
+    return _single_flight(key, lambda: _edit_design(data, tasks, user))
+
+def _edit_design(data: CadEditIn, tasks: BackgroundTasks, user: dict):
     USER_ID = user["sub"]
     _enforce_ai_quota_or_402(USER_ID)
     session = SESSION_ID()
@@ -876,27 +1138,24 @@ def edit_design_route(data: CadEditIn, tasks: BackgroundTasks, user=Depends(get_
         content=summary_md
     )
     export = "stl"
-    file_path = None
-    last_error = None
-    for attempt in range(MAX_RETRIES):
-        try:
-            file_path = run_cadquery(new_code)
-            last_error = None
-            break
-        except Exception as e:
-            last_error = str(e)
-            new_code, usage4 = fix_cadquery(new_code, last_error)
-            storage.log_operation(
-                    USER_ID, data.project_id, session,
-                    op_type="code_fix", agent="o4-mini",
-                    tokens_prompt=usage4.prompt_tokens, tokens_comp=usage4.completion_tokens, latency_ms=0,
-                )
-    if not file_path:
+
+    def _log_fix(usage4):
+        tokens_prompt, tokens_comp = _usage_tokens(usage4)
+        storage.log_operation(
+                USER_ID, data.project_id, session,
+                op_type="code_fix", agent="o4-mini",
+                tokens_prompt=tokens_prompt, tokens_comp=tokens_comp, latency_ms=0,
+            )
+
+    # fixer failures surface as a 500 here, as they did before the shared loop
+    geom, new_code, last_error = _run_with_fixes(new_code, on_fix=_log_fix, raise_fix_errors=True)
+    if not geom:
         logger.error("Initial sandbox failed after retries:\n%s", format_exc())
         raise HTTPException(500, f"Initial sandbox failed: {last_error}")
     
     else:
-        blob_url, gcs_path = storage.upload_geometry(file_path, data.project_id, new_ver, "stl", ttl_sec=86_400)
+        stl_bytes, filename = geom
+        blob_url, gcs_path = storage.upload_geometry_bytes(stl_bytes, data.project_id, new_ver, "stl", ttl_sec=86_400)
         # NEW: log what we uploaded and verify the slot path exists
         try:
             slot_path = storage.geometry_blob_path(data.project_id, new_ver, "stl")
@@ -910,9 +1169,9 @@ def edit_design_route(data: CadEditIn, tasks: BackgroundTasks, user=Depends(get_
         # record the cad_file artifact
         storage.put_artifact(
             data.project_id, USER_ID, session,
-            art_type="cad_file", version=f"{new_ver}", blob_url=blob_url, data={"export": export, "filename": Path(file_path).name, "gcs_path": gcs_path}
+            art_type="cad_file", version=f"{new_ver}", blob_url=blob_url, data={"export": export, "filename": filename, "gcs_path": gcs_path}
         )
-    tasks.add_task(_export_step_bg, data.project_id, session, USER_ID, new_code, new_ver, award_on_complete=False)
+    _enqueue_step_export(tasks, data.project_id, session, USER_ID, new_code, new_ver, award_on_complete=False)
     return {"new_version": new_ver, "summary_md": summary_md, "code": new_code, "blob_url": blob_url}
 
 # ─────────────────────── Manual sandbox (debug) ─────────────────────
@@ -941,12 +1200,12 @@ def latest_cad(
             stls = [a for a in arts if (a.get("data") or {}).get("export") == "stl"]
             if not stls:
                 return None, None
-            latest_stl = max(stls, key=lambda d: int(d.get("version", 0)))
+            latest_stl = max(stls, key=lambda d: d.get("version", 0))
             data = latest_stl.get("data") or {}
             gcs_path = data.get("gcs_path")
             if not gcs_path:
                 return None, None
-            v = int(data.get("design_ver") or latest_stl.get("version", 0))
+            v = data.get("design_ver") or latest_stl.get("version", 0)
             url = storage.sign_path(gcs_path, ttl_sec=86_400)
             return url, v
         except Exception as e:
@@ -979,8 +1238,8 @@ def latest_cad(
                 arts = storage.list_artifacts(project_id, "cad_file", latest=False) or []
                 stls = [a for a in arts if (a.get("data") or {}).get("export") == "stl"]
                 if stls:
-                    latest_stl = max(stls, key=lambda d: int(d.get("version", 0)))
-                    dv = (latest_stl.get("data") or {}).get("design_ver") or int(latest_stl.get("version", 0))
+                    latest_stl = max(stls, key=lambda d: d.get("version", 0))
+                    dv = (latest_stl.get("data") or {}).get("design_ver") or latest_stl.get("version", 0)
                     url, v = _sign_for_slot(dv)
             except Exception:
                 pass
@@ -1004,7 +1263,7 @@ def latest_cad(
                 snap  = storage.get_progress_snapshot(user["sub"])
             except Exception:
                 pass
-        return {"status": "ready", "blob_url": url, "version": int(v),
+        return {"status": "ready", "blob_url": url, "version": v,
                 "award": award, "progressSnapshot": snap}
 
     # 2) No version provided → use meta.cadVersion, then fallbacks
@@ -1020,8 +1279,8 @@ def latest_cad(
             arts = storage.list_artifacts(project_id, "cad_file", latest=False) or []
             stls = [a for a in arts if (a.get("data") or {}).get("export") == "stl"]
             if stls:
-                latest_stl = max(stls, key=lambda d: int(d.get("version", 0)))
-                dv = (latest_stl.get("data") or {}).get("design_ver") or int(latest_stl.get("version", 0))
+                latest_stl = max(stls, key=lambda d: d.get("version", 0))
+                dv = (latest_stl.get("data") or {}).get("design_ver") or latest_stl.get("version", 0)
                 url, v = _sign_for_slot(dv)
         except Exception:
             pass
@@ -1043,13 +1302,95 @@ def latest_cad(
             snap  = storage.get_progress_snapshot(user["sub"])
         except Exception:
             pass
-    return {"status": "ready", "blob_url": url, "version": int(v),
+    return {"status": "ready", "blob_url": url, "version": v,
             "award": award, "progressSnapshot": snap}
 
 
+# ---- push variant of /latest-cad --------------------------------------------
+# One Firestore listener per subscriber instead of N polls (each poll costs a
+# meta read + artifact query + signing). Emits an SSE `cad` event whenever a
+# newer STL lands; comment lines keep proxies from idling the stream out.
+# Anonymous callers may subscribe, so opens are rate-limited per IP and the
+# number of live listeners (each a billed Firestore watch) is capped per process.
+STREAM_KEEPALIVE_S = 15
+STREAM_MAX_S = 900
+STREAM_MAX_LISTENERS = int(os.getenv("CAD_STREAM_MAX_LISTENERS", "200"))
+_stream_listeners = 0   # only touched on the event loop
+_limit_cad_stream = limit_ip("latest_cad_stream", 20)
+
+def _newest_stl_signed(docs: list[dict]):
+    stls = [d for d in docs if (d.get("data") or {}).get("export") == "stl"]
+    if not stls:
+        return None
+    latest_stl = max(stls, key=lambda d: d.get("version", 0))
+    data = latest_stl.get("data") or {}
+    gcs_path = data.get("gcs_path")
+    if not gcs_path:
+        return None
+    v = data.get("design_ver") or latest_stl.get("version", 0)
+    return {"status": "ready", "blob_url": storage.sign_path(gcs_path, ttl_sec=86_400), "version": v}
+
+@app.get("/latest-cad/stream", dependencies=[Depends(_limit_cad_stream)])
+async def latest_cad_stream(
+    project_id: str = Query(..., description="Project ID"),
+    max_s: int = Query(600, ge=1, le=STREAM_MAX_S, description="Close the stream after this many seconds"),
+):
+    if _stream_listeners >= STREAM_MAX_LISTENERS:
+        raise HTTPException(503, "Too many live streams, poll /latest-cad",
+                            headers={"Retry-After": str(STREAM_KEEPALIVE_S)})
+    loop = asyncio.get_running_loop()
+    updates: asyncio.Queue = asyncio.Queue()
+
+    def _on_change(docs: list[dict]):
+        try:
+            payload = _newest_stl_signed(docs)
+        except Exception as e:
+            logger.error(f"[latest_cad_stream] signing failed: {e}")
+            return
+        if payload:
+            loop.call_soon_threadsafe(updates.put_nowait, payload)
+
+    async def gen():
+        global _stream_listeners
+        last_version = None
+        deadline = loop.time() + max_s
+        # the listener lives only while the body is streamed
+        _stream_listeners += 1
+        try:
+            watch = storage.watch_artifacts(project_id, "cad_file", _on_change)
+        except BaseException:
+            _stream_listeners -= 1
+            raise
+        try:
+            while (remaining := deadline - loop.time()) > 0:
+                try:
+                    payload = await asyncio.wait_for(
+                        updates.get(), timeout=min(STREAM_KEEPALIVE_S, remaining)
+                    )
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if payload["version"] == last_version:
+                    continue
+                last_version = payload["version"]
+                yield f"event: cad\ndata: {json.dumps(payload)}\n\n"
+        finally:
+            _stream_listeners -= 1
+            watch.unsubscribe()
+
+    return StreamingResponse(
+        gen(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 
 @app.post("/edit-brainstorm")
 def brainstorm_edit_route(data: BrainstormEditIn, user=Depends(get_current_user)):
+    key = _flight_key("edit-brainstorm", user["sub"], data.project_id, data.brainstorm_version, data.user_query)
+    return _single_flight(key, lambda: _edit_brainstorm(data, user))
+
+def _edit_brainstorm(data: BrainstormEditIn, user: dict):
     USER_ID = user["sub"]
     _enforce_ai_quota_or_402(USER_ID)
     session = SESSION_ID()
@@ -1082,15 +1423,22 @@ def classify_route(data: ClassifierIn, user=Depends(get_current_user)):
     )
     return raw
 
+# Strong refs to STL builds started by /chat: the event loop only keeps weak
+# ones, and a build must finish (and persist) even if its client disconnects.
+_BG_TASKS: set[asyncio.Task] = set()
+
+# /chat single-flight: key → Future resolved with the leader's full reply.
+# Only touched from the event loop, so no lock is needed.
+_CHAT_FLIGHTS: dict[str, asyncio.Future] = {}
+
 @app.post("/chat")
 async def chat_route(data: ChatIn, tasks: BackgroundTasks, user=Depends(get_current_user)):
     USER_ID = user["sub"]
     _enforce_ai_quota_or_402(USER_ID)
     session = SESSION_ID()
-
-    storage.add_chat_message(
-        data.project_id, session, USER_ID,
-        role="user", content=data.user_query
+    flight_key = _flight_key(
+        "chat", USER_ID, data.project_id,
+        data.cad_code_version, data.brainstorm_version, data.user_query,
     )
 
     KEEPALIVE = "\u2063"          # zero-width; client will ignore it
@@ -1099,6 +1447,51 @@ async def chat_route(data: ChatIn, tasks: BackgroundTasks, user=Depends(get_curr
         # Send first byte immediately so proxies don’t time out.
         yield KEEPALIVE
 
+        if (leader := _CHAT_FLIGHTS.get(flight_key)) is not None:
+            # Identical request already running: replay its reply instead of redoing the edits.
+            try:
+                yield await asyncio.shield(leader)
+            except Exception as e:
+                yield f"\n\n⚠ Error generating response: {str(e)}"
+            return
+        flight = asyncio.get_running_loop().create_future()
+        # followers may never come; don't log "exception was never retrieved"
+        flight.add_done_callback(lambda f: f.cancelled() or f.exception())
+        _CHAT_FLIGHTS[flight_key] = flight
+        # Generation runs in its own task, not in this response: if the
+        # leader's client goes away, followers still get the full reply.
+        chunks: asyncio.Queue = asyncio.Queue()
+        task = asyncio.create_task(drive(flight, chunks))
+        _BG_TASKS.add(task)
+        task.add_done_callback(_BG_TASKS.discard)
+        while (chunk := await chunks.get()) is not None:
+            yield chunk
+
+    async def drive(flight: asyncio.Future, chunks: asyncio.Queue):
+        full_msg = ""
+        try:
+            async for chunk in lead():
+                full_msg += chunk
+                chunks.put_nowait(chunk)
+        except asyncio.CancelledError:
+            flight.set_exception(RuntimeError("chat generation was cancelled"))
+            raise
+        except Exception as e:
+            # followers get the error, not a truncated reply passed off as complete
+            flight.set_exception(e)
+            chunks.put_nowait(f"\n\n⚠ Error generating response: {str(e)}")
+        else:
+            flight.set_result(full_msg)
+        finally:
+            _CHAT_FLIGHTS.pop(flight_key, None)
+            chunks.put_nowait(None)
+
+    async def lead():
+        storage.add_chat_message(
+            data.project_id, session, USER_ID,
+            role="user", content=data.user_query
+        )
+
         summaries: list[str] = []
         changed_tags: set[str] = set()
         sandbox_task: asyncio.Task | None = None
@@ -1192,7 +1585,8 @@ async def chat_route(data: ChatIn, tasks: BackgroundTasks, user=Depends(get_curr
                             summaries.append(summary_md)
                             changed_tags.add("Design")
 
-                            # ⬇️ Run STL pipeline NOW in a worker thread and wrap in a Task
+                            # ⬇️ Run STL pipeline NOW in a worker thread and wrap in a Task.
+                            #    Held in _BG_TASKS so it outlives this response if the client drops.
                             sandbox_task = asyncio.create_task(asyncio.to_thread(
                                 _sandbox_flow,
                                 data.project_id,
@@ -1203,6 +1597,8 @@ async def chat_route(data: ChatIn, tasks: BackgroundTasks, user=Depends(get_curr
                                 "stl",
                                 False,  # add_message=False (we'll speak after it finishes)
                             ))
+                            _BG_TASKS.add(sandbox_task)
+                            sandbox_task.add_done_callback(_BG_TASKS.discard)
 
                 except Exception as exc:
                     summaries.append(f"⚠ `{intent}` failed: {exc}")
@@ -1220,12 +1616,15 @@ async def chat_route(data: ChatIn, tasks: BackgroundTasks, user=Depends(get_curr
                     pass
 
             # 3) If we edited CAD, WAIT for STL/upload/meta to finish (keep connection alive)
+            #    Woken by task completion; only yields a keepalive if it's been quiet a while.
             if sandbox_task is not None:
-                while not sandbox_task.done():
+                while True:
+                    done, _ = await asyncio.wait({sandbox_task}, timeout=STREAM_KEEPALIVE_S)
+                    if done:
+                        break
                     yield KEEPALIVE
-                    await asyncio.sleep(0.5)
-                # propagate any exception
-                await sandbox_task
+                # propagate any exception; shield so a disconnect doesn't cancel the build
+                await asyncio.shield(sandbox_task)
 
         except Exception as exc_all:
             yield f"\n\n⚠ Error during edits: {exc_all}\n"
@@ -1255,21 +1654,29 @@ async def chat_route(data: ChatIn, tasks: BackgroundTasks, user=Depends(get_curr
     return StreamingResponse(gen(), media_type="text/plain")
 
 
+_BUNDLE_FIELDS = [
+    "version", "data.changed", "data.summary",
+    "data.brainstorm_ver", "data.cad_code_ver", "data.cad_file_ver",
+]
+
 @app.get("/versions")
-def list_version_bundles(project_id: str):
-    docs = storage.list_artifacts(project_id, "version_bundle", latest=False)
-    docs.sort(key=lambda d: d.get("version", 0), reverse=True)       # newest first
-    return [
-        {
+def list_version_bundles(project_id: str, limit: int = Query(100, ge=1, le=500)):
+    # read only the fields the history panel shows; Firestore returns newest first
+    docs = storage.list_artifacts(
+        project_id, "version_bundle", latest=False, fields=_BUNDLE_FIELDS, limit=limit
+    )
+    out = []
+    for d in docs:
+        bd = d.get("data") or {}
+        out.append({
             "version":   d["version"],
-            "changed":   d["data"].get("changed", []),
-            "summary":   d["data"].get("summary", ""),
-            "brain_ver": d["data"].get("brainstorm_ver"),
-            "cad_code_ver": d["data"].get("cad_code_ver"),
-            "cad_file_ver": d["data"].get("cad_file_ver"),
-        }
-        for d in docs
-    ]
+            "changed":   bd.get("changed", []),
+            "summary":   bd.get("summary", ""),
+            "brain_ver": bd.get("brainstorm_ver"),
+            "cad_code_ver": bd.get("cad_code_ver"),
+            "cad_file_ver": bd.get("cad_file_ver"),
+        })
+    return out
 
 # @app.get("/export/brainstorm-pdf")
 # def export_brainstorm_pdf(project_id: str, version: int | None = None):
@@ -1353,6 +1760,10 @@ def list_version_bundles(project_id: str):
 
 @app.post("/export-step")
 def export_step(data: StepExportIn, tasks: BackgroundTasks, user=Depends(get_current_user)):
+    key = _flight_key("export-step", user["sub"], data.project_id, data.cad_code_version)
+    return _single_flight(key, lambda: _export_step(data, tasks, user))
+
+def _export_step(data: StepExportIn, tasks: BackgroundTasks, user: dict):
     USER_ID = user["sub"]
     session = SESSION_ID()
 
@@ -1369,9 +1780,9 @@ def export_step(data: StepExportIn, tasks: BackgroundTasks, user=Depends(get_cur
         for doc in existing:
             doc_data = doc.get("data") or {}
             if doc_data.get("export") == "step":
-                src_ver = int(doc_data.get("source_code_ver", doc.get("version", 0)))
+                src_ver = doc_data.get("source_code_ver", doc.get("version", 0))
                 # Match by source code version if specified, otherwise use latest
-                if data.cad_code_version is None or src_ver == int(data.cad_code_version):
+                if data.cad_code_version is None or src_ver == data.cad_code_version:
                     logger.info(f"STEP already exists for {data.project_id}:{src_ver}")
                     try:
                         award = storage.record_progress(
@@ -1402,7 +1813,7 @@ def export_step(data: StepExportIn, tasks: BackgroundTasks, user=Depends(get_cur
             return JSONResponse({"error": "CAD code not found for STEP export"}, status_code=404)
 
         cad_code = doc["data"]["code"]
-        code_ver = int(doc["version"])
+        code_ver = doc["version"]
 
         # Try to acquire lock to prevent duplicate exports
         acquired, lock_info = _acquire_step_lock(data.project_id, code_ver)
@@ -1412,8 +1823,8 @@ def export_step(data: StepExportIn, tasks: BackgroundTasks, user=Depends(get_cur
 
         # Start background export
         logger.info(f"Starting background STEP export for {data.project_id}:{code_ver}")
-        tasks.add_task(
-            _export_step_bg, 
+        _enqueue_step_export(
+            tasks,
             data.project_id, session, USER_ID, cad_code, code_ver,
             award_on_complete=True
         )
@@ -1436,10 +1847,10 @@ def step_url(project_id: str, cad_code_version: int | None = None):
         for doc in existing:
             doc_data = doc.get("data") or {}
             if doc_data.get("export") == "step":
-                src_ver = int(doc_data.get("source_code_ver", doc.get("version", 0)))
+                src_ver = doc_data.get("source_code_ver", doc.get("version", 0))
                 
                 # If version specified, check if it matches
-                if cad_code_version is not None and src_ver != int(cad_code_version):
+                if cad_code_version is not None and src_ver != cad_code_version:
                     continue
                     
                 logger.info(f"Found STEP file for {project_id}:{src_ver}")
@@ -1487,9 +1898,13 @@ def _api_latest_cad(
 ):
     return latest_cad(project_id=project_id, version=version, record=record, download=False, user=user)
 
+@app.get("/api/latest-cad/stream", dependencies=[Depends(_limit_cad_stream)])
+async def _api_latest_cad_stream(project_id: str = Query(...), max_s: int = Query(600, ge=1, le=STREAM_MAX_S)):
+    return await latest_cad_stream(project_id=project_id, max_s=max_s)
+
 @app.get("/api/versions")
-def _api_versions(project_id: str = Query(...)):
-    return list_version_bundles(project_id)
+def _api_versions(project_id: str = Query(...), limit: int = Query(100, ge=1, le=500)):
+    return list_version_bundles(project_id, limit)
 
 @app.post("/api/sandbox-run")
 def _api_sandbox_run(code: str = Body(..., media_type="text/plain")):
@@ -1512,128 +1927,190 @@ async def _api_chat(data: ChatIn, tasks: BackgroundTasks, user=Depends(get_curre
     return await chat_route(data, tasks, user)
 
 # --- Brainstorm → PDF (pure-Python) ------------------------------------------
-def _brainstorm_to_pdf_bytes(data: dict) -> bytes:
-    """Generate PDF from brainstorm data matching the actual JSON structure"""
-    from reportlab.lib.pagesizes import letter
-    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, ListFlowable, ListItem
-    from reportlab.lib.styles import getSampleStyleSheet
-    from reportlab.lib.units import inch
+# Stylesheet built once at import time, not per PDF.
+_STYLES = getSampleStyleSheet()
+_BODY  = _STYLES["BodyText"]
+_H2    = _STYLES["Heading2"]
+_TITLE = _STYLES["Title"]
+_PDF_ROWS_PER_PARAGRAPH = 20   # key/value rows merged into one Paragraph
+
+# Add all the sections that match your brainstorm structure
+_SECTIONS: tuple[tuple[str, str], ...] = (
+    ("key_features", "Key Features"),
+    ("key_functionalities", "Key Functionalities"),
+    ("design_components", "Design Components"),
+    ("optimal_geometry", "Geometry"),
+    ("design_objectives", "Design Objectives"),
+    ("design_requirements", "Design Requirements"),
+    ("technical_specifications", "Technical Specifications"),
+    ("materials", "Materials"),
+    ("manufacturing_considerations", "Manufacturing Considerations"),
+    ("constraints", "Constraints"),
+    ("assumptions", "Assumptions"),
+    ("risks_and_challenges", "Risks and Challenges"),
+    ("testing_validation", "Testing and Validation"),
+    ("implementation_plan", "Implementation Plan"),
+    ("success_criteria", "Success Criteria"),
+    ("notes", "Additional Notes"),
+)
 
+def _brainstorm_to_pdf_bytes(data: dict) -> BytesIO:
+    """Generate PDF from brainstorm data matching the actual JSON structure.
+    Returns the rewound buffer itself (no getvalue() copy) so it can be streamed."""
     buf = BytesIO()
     doc = SimpleDocTemplate(buf, pagesize=letter)
-    styles = getSampleStyleSheet()
     elems = []
 
+    def add_space(height):
+        """Add vertical space, merging with a directly preceding Spacer"""
+        if elems and isinstance(elems[-1], Spacer):
+            elems[-1] = Spacer(1, elems[-1].height + height)
+        else:
+            elems.append(Spacer(1, height))
+
     def add_header(txt):
         """Add a section header"""
-        elems.append(Spacer(1, 0.2 * inch))
-        elems.append(Paragraph(txt, styles["Heading2"]))
+        add_space(0.2 * inch)
+        elems.append(Paragraph(txt, _H2))
 
     def add_paragraph(txt):
         """Add a paragraph of text"""
         if txt and txt.strip():
-            elems.append(Paragraph(txt.strip(), styles["BodyText"]))
+            elems.append(Paragraph(txt.strip(), _BODY))
 
     def add_bullet_list(title, items):
         """Add a bulleted list section"""
         if not items:
             return
         add_header(title)
+        _p = Paragraph
         flow = []
         for item in items:
             if isinstance(item, dict):
                 # Handle dict items by joining key-value pairs
-                text = ", ".join(f"{k}: {v}" for k, v in item.items())
-                flow.append(ListItem(Paragraph(text, styles["BodyText"]), leftIndent=12))
+                text = ", ".join("%s: %s" % kv for kv in item.items())
+                flow.append(ListItem(_p(text, _BODY), leftIndent=12))
             else:
                 # Handle string items
-                flow.append(ListItem(Paragraph(str(item), styles["BodyText"]), leftIndent=12))
+                flow.append(ListItem(_p(str(item), _BODY), leftIndent=12))
         elems.append(ListFlowable(flow, bulletType="bullet"))
 
+    def add_text_section(title, text):
+        add_header(title)
+        add_paragraph(text)
+
+    def add_dict_section(title, mapping):
+        """Handle dict fields by converting to key: value format"""
+        add_header(title)
+        # One Paragraph per block of rows so ReportLab parses the markup once
+        # per block rather than once per row
+        rows = ["<b>%s:</b> %s" % (key, value) for key, value in mapping.items() if value]
+        for i in range(0, len(rows), _PDF_ROWS_PER_PARAGRAPH):
+            elems.append(Paragraph("<br/>".join(rows[i:i + _PDF_ROWS_PER_PARAGRAPH]), _BODY))
+
+    section_handlers = {
+        list: add_bullet_list, tuple: add_bullet_list,
+        str: add_text_section, dict: add_dict_section,
+    }
+
     # Title and one-liner
     title = data.get("project_name") or "Brainstorm"
-    elems.append(Paragraph(title, styles["Title"]))
-    elems.append(Spacer(1, 0.15 * inch))
+    elems.append(Paragraph(title, _TITLE))
+    add_space(0.15 * inch)
 
     # One-liner (if present)
     one_liner = data.get("design_one_liner")
     if one_liner:
-        elems.append(Paragraph(f"<b>One-liner:</b> {one_liner}", styles["BodyText"]))
-        elems.append(Spacer(1, 0.1 * inch))
-
-    # Add all the sections that match your brainstorm structure
-    sections = [
-        ("key_features", "Key Features"),
-        ("key_functionalities", "Key Functionalities"), 
-        ("design_components", "Design Components"),
-        ("optimal_geometry", "Geometry"),
-        ("design_objectives", "Design Objectives"),
-        ("design_requirements", "Design Requirements"),
-        ("technical_specifications", "Technical Specifications"),
-        ("materials", "Materials"),
-        ("manufacturing_considerations", "Manufacturing Considerations"),
-        ("constraints", "Constraints"),
-        ("assumptions", "Assumptions"),
-        ("risks_and_challenges", "Risks and Challenges"),
-        ("testing_validation", "Testing and Validation"),
-        ("implementation_plan", "Implementation Plan"),
-        ("success_criteria", "Success Criteria"),
-        ("notes", "Additional Notes"),
-    ]
+        elems.append(Paragraph(f"<b>One-liner:</b> {one_liner}", _BODY))
+        add_space(0.1 * inch)
 
-    for field_name, display_title in sections:
-        field_value = data.get(field_name)
-        
-        if isinstance(field_value, (list, tuple)) and field_value:
-            add_bullet_list(display_title, field_value)
-        elif isinstance(field_value, str) and field_value.strip():
-            add_header(display_title)
-            add_paragraph(field_value.strip())
-        elif isinstance(field_value, dict) and field_value:
-            # Handle dict fields by converting to key: value format
-            add_header(display_title)
-            for key, value in field_value.items():
-                if value:
-                    elems.append(Paragraph(f"<b>{key}:</b> {value}", styles["BodyText"]))
+    # Drop empty sections up front so only populated ones reach a handler
+    present = [
+        (display_title, value) for field_name, display_title in _SECTIONS
+        if (value := data.get(field_name)) and (type(value) is not str or value.strip())
+    ]
+    for display_title, value in present:
+        handler = section_handlers.get(type(value))
+        if handler:
+            handler(display_title, value)
 
     # Footer
-    elems.append(Spacer(1, 0.5 * inch))
-    elems.append(Paragraph("Generated by <b>Makistry</b>", styles["BodyText"]))
+    add_space(0.5 * inch)
+    elems.append(Paragraph("Generated by <b>Makistry</b>", _BODY))
 
     doc.build(elems)
-    return buf.getvalue()
+    buf.seek(0)
+    return buf
+
+def _brainstorm_to_pdf_bytes_copy(data: dict) -> bytes:
+    """For callers that need an actual bytes object."""
+    return _brainstorm_to_pdf_bytes(data).getvalue()
+
+# Brainstorm versions are immutable, so a rendered PDF can be reused as long
+# as the content hash matches: (project_id, version, etag) → pdf bytes.
+_PDF_CACHE: LRUCache = LRUCache(maxsize=128)
+_PDF_CACHE_LOCK = threading.Lock()
+
+def _brainstorm_etag(data: dict) -> str:
+    raw = json.dumps(data, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+def _render_cached(project_id: str, version, etag: str, data: dict) -> bytes:
+    key = (project_id, version, etag)
+    with _PDF_CACHE_LOCK:
+        pdf = _PDF_CACHE.get(key)
+    if pdf is None:
+        pdf = _brainstorm_to_pdf_bytes_copy(data)
+        with _PDF_CACHE_LOCK:
+            _PDF_CACHE[key] = pdf
+    return pdf
 
 @app.get("/export/brainstorm-pdf")
-def export_brainstorm_pdf(project_id: str, version: int | None = None):
-    doc = get_artifact_for_version(project_id, "brainstorm", version)
+async def export_brainstorm_pdf(request: Request, project_id: str, version: int | None = None):
+    # Firestore read and ReportLab render are blocking → worker threads
+    doc = await asyncio.to_thread(get_artifact_for_version, project_id, "brainstorm", version)
     if not doc:
         raise HTTPException(404, "Brainstorm not found")
     data = doc["data"]
-    pdf = _brainstorm_to_pdf_bytes(data)
+    etag = _brainstorm_etag(data)
+    cache_headers = {"ETag": f'"{etag}"', "Cache-Control": "private, max-age=3600"}
+    if request.headers.get("if-none-match") == cache_headers["ETag"]:
+        return Response(status_code=304, headers=cache_headers)
+
+    pdf = await asyncio.to_thread(_render_cached, project_id, doc.get("version", version), etag, data)
     fname = f"{(data.get('project_name') or 'brainstorm').replace(' ', '_')}.pdf"
     return StreamingResponse(BytesIO(pdf),
         media_type="application/pdf",
-        headers={"Content-Disposition": f'attachment; filename="{fname}"'})
+        headers={"Content-Disposition": f'attachment; filename="{fname}"', **cache_headers})
 
 # /api alias so the Hosting rewrite still reaches it
 @app.get("/api/export/brainstorm-pdf")
-def _api_export_brainstorm_pdf(project_id: str, version: int | None = None):
-    return export_brainstorm_pdf(project_id, version)
+async def _api_export_brainstorm_pdf(request: Request, project_id: str, version: int | None = None):
+    return await export_brainstorm_pdf(request, project_id, version)
+
+
+# STEP locks live at locks.step_export_<ver> and are written by field path, so
+# other lock entries on the meta doc are never rewritten. Acquire still reads
+# (TTL check) and compare-and-sets on update_time; release is a blind delete.
+STEP_LOCK_CAS_ATTEMPTS = 3
 
+_SESSION_CTR = itertools.count()   # lock session ids: pid + counter, no urandom per lock
+
+def _step_lock_key(code_ver: int) -> str:
+    return f"step_export_{int(code_ver)}"
 
 def _acquire_step_lock(project_id: str, code_ver: int, ttl_s: int = 600):
-    """Acquire a lock for STEP export to prevent duplicates"""
+    """Acquire a lock for STEP export to prevent duplicates.
+    Always answered from Firestore (one single-field read): the lock may be
+    released by the Pub/Sub step worker on another instance, so a local
+    record of "held" can't be trusted."""
     doc = C_META.document(project_id)
-    tx = firestore.Client().transaction()
-    
-    @firestore.transactional
-    def _do(t):
+    key = _step_lock_key(code_ver)  # More specific key
+
+    for _ in range(STEP_LOCK_CAS_ATTEMPTS):
         try:
-            snap = doc.get(transaction=t)
-            data = snap.to_dict() or {}
-            locks = data.get("locks") or {}
-            key = f"step_export_{int(code_ver)}"  # More specific key
-            lock = locks.get(key)
+            snap = doc.get([f"locks.{key}"])
+            lock = ((snap.to_dict() or {}).get("locks") or {}).get(key)
             now = _now_ms()
             
             # Check if lock exists and hasn't expired
@@ -1644,44 +2121,81 @@ def _acquire_step_lock(project_id: str, code_ver: int, ttl_s: int = 600):
             # Acquire new lock
             new_lock = {
                 "owner": "step_export", 
-                "session": f"step_{code_ver}_{uuid.uuid4().hex[:8]}", 
+                "session": f"step_{code_ver}_{os.getpid():x}_{next(_SESSION_CTR):x}", 
                 "startedAt": now, 
                 "expiresAt": now + ttl_s * 1000
             }
-            locks[key] = new_lock
-            t.set(doc, {"locks": locks}, merge=True)
+            if snap.exists:
+                option = firestore.Client.write_option(last_update_time=snap.update_time)
+                doc.update({f"locks.{key}": new_lock}, option=option)
+            else:
+                doc.create({"locks": {key: new_lock}})
             logger.info(f"Acquired STEP lock for {project_id}:{code_ver}")
             return True, new_lock
-            
+
+        except (FailedPrecondition, AlreadyExists):
+            continue  # meta doc changed under us; re-read and retry
         except Exception as e:
             logger.error(f"Error acquiring STEP lock: {e}")
             return False, None
-            
-    return _do(tx)
 
+    logger.info(f"STEP lock contended for {project_id}:{code_ver}")
+    return False, None
 
-def _release_step_lock(project_id: str, code_ver: int):
-    """Release the STEP export lock"""
+
+def _claim_step_run(project_id: str, code_ver: int, ttl_s: int = 600) -> bool:
+    """Mark the STEP lock as being worked on by this delivery. False when
+    another delivery of the same job already runs it."""
     doc = C_META.document(project_id)
-    tx = firestore.Client().transaction()
-    
-    @firestore.transactional
-    def _do(t):
+    key = _step_lock_key(code_ver)
+
+    for _ in range(STEP_LOCK_CAS_ATTEMPTS):
         try:
-            snap = doc.get(transaction=t)
-            data = snap.to_dict() or {}
-            locks = data.get("locks") or {}
-            key = f"step_export_{int(code_ver)}"
-            
-            if key in locks:
-                locks.pop(key, None)
-                t.set(doc, {"locks": locks}, merge=True)
-                logger.info(f"Released STEP lock for {project_id}:{code_ver}")
-            
+            snap = doc.get([f"locks.{key}"])
+            lock = ((snap.to_dict() or {}).get("locks") or {}).get(key) or {}
+            now = _now_ms()
+            if lock.get("runner") and int(lock.get("expiresAt", 0)) > now:
+                return False
+            claimed = {
+                **lock,
+                "runner": f"{os.getpid():x}_{next(_SESSION_CTR):x}",
+                "expiresAt": now + ttl_s * 1000,
+            }
+            if snap.exists:
+                option = firestore.Client.write_option(last_update_time=snap.update_time)
+                doc.update({f"locks.{key}": claimed}, option=option)
+            else:
+                doc.create({"locks": {key: claimed}})
             return True
-            
+
+        except (FailedPrecondition, AlreadyExists):
+            continue  # meta doc changed under us; re-read and retry
         except Exception as e:
-            logger.error(f"Error releasing STEP lock: {e}")
-            return False
-            
-    return _do(tx)
+            # running twice is better than never running
+            logger.error(f"Error claiming STEP run: {e}")
+            return True
+
+    return False
+
+
+def _step_artifact_exists(project_id: str, code_ver: int) -> bool:
+    for doc in storage.list_artifacts(project_id, art_type="cad_file", latest=False) or []:
+        data = doc.get("data") or {}
+        if data.get("export") == "step" and data.get("source_code_ver") == int(code_ver):
+            return True
+    return False
+
+
+def _release_step_lock(project_id: str, code_ver: int):
+    """Release the STEP export lock"""
+    try:
+        C_META.document(project_id).update(
+            {f"locks.{_step_lock_key(code_ver)}": firestore.DELETE_FIELD}
+        )
+        logger.info(f"Released STEP lock for {project_id}:{code_ver}")
+        return True
+    except NotFound:
+        return True  # no meta doc → nothing to release
+    except Exception as e:
+        logger.error(f"Error releasing STEP lock: {e}")
+        return False
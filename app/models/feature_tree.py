@@ -7,10 +7,15 @@ where each node is a CAD operation/feature with parameters and dependencies.
 from __future__ import annotations
 
 from typing import Dict, List, Optional, Any, Union, Set
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, model_validator
 from enum import Enum
 import uuid
-from datetime import datetime
+from datetime import datetime, timezone
+
+
+def _utcnow() -> datetime:
+    # datetime.utcnow() is deprecated (3.12) and returns a naive value
+    return datetime.now(timezone.utc)
 
 
 class FeatureType(str, Enum):
@@ -109,8 +114,8 @@ class FeatureNode(BaseModel):
     error_message: Optional[str] = None
     
     # Metadata
-    created_at: datetime = Field(default_factory=datetime.utcnow)
-    updated_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=_utcnow)
+    updated_at: datetime = Field(default_factory=_utcnow)
     
     # Visual properties
     visible: bool = True
@@ -118,8 +123,80 @@ class FeatureNode(BaseModel):
     transparency: Optional[float] = None
 
 
+def _find_cycles(nodes: Dict[str, FeatureNode]) -> List[List[str]]:
+    """
+    Strongly connected components of the parent-reference graph that form a
+    cycle (size > 1, or a node referencing itself). Iterative Tarjan, O(V+E),
+    so deep feature histories can't hit the recursion limit.
+    """
+    # Edges run parent → dependent (ref.feature_id → node.id)
+    edges: Dict[str, List[str]] = {node_id: [] for node_id in nodes}
+    self_loops: Set[str] = set()
+    for node in nodes.values():
+        for ref in node.parent_references:
+            if ref.feature_id in edges:
+                edges[ref.feature_id].append(node.id)
+                if ref.feature_id == node.id:
+                    self_loops.add(node.id)
+    
+    index: Dict[str, int] = {}
+    lowlink: Dict[str, int] = {}
+    on_stack: Set[str] = set()
+    scc_stack: List[str] = []
+    cycles: List[List[str]] = []
+    counter = 0
+    
+    for start in edges:
+        if start in index:
+            continue
+        work = [(start, iter(edges[start]))]
+        index[start] = lowlink[start] = counter
+        counter += 1
+        scc_stack.append(start)
+        on_stack.add(start)
+        while work:
+            node_id, successors = work[-1]
+            for succ in successors:
+                if succ not in index:
+                    index[succ] = lowlink[succ] = counter
+                    counter += 1
+                    scc_stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter(edges[succ])))
+                    break
+                if succ in on_stack:
+                    lowlink[node_id] = min(lowlink[node_id], index[succ])
+            else:
+                work.pop()
+                if work:
+                    parent_id = work[-1][0]
+                    lowlink[parent_id] = min(lowlink[parent_id], lowlink[node_id])
+                if lowlink[node_id] == index[node_id]:
+                    component = []
+                    while True:
+                        member = scc_stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node_id:
+                            break
+                    if len(component) > 1 or node_id in self_loops:
+                        cycles.append(component)
+    
+    return cycles
+
+
+def _is_design_params_node(node_id: str, node: FeatureNode) -> bool:
+    name = node.name.lower()
+    return ("design_params" in node_id.lower() or
+            "design_params" in name or
+            ("design" in name and "param" in name))
+
+
 class FeatureTree(BaseModel):
     """Complete feature tree for a CAD model"""
+    # Tree-walking methods assign fields in loops; keep those writes validator-free
+    model_config = ConfigDict(extra="ignore", validate_assignment=False)
+    
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     project_id: str
     version: int
@@ -146,54 +223,121 @@ class FeatureTree(BaseModel):
     needs_full_regeneration: bool = False  # Structural edits that require full code regeneration
     last_good_artifact_id: Optional[str] = None  # ID of last successfully generated artifact
     
+    # Write-side indices, recomputed by refresh_indices() whenever the tree is saved
+    design_params_node_id: Optional[str] = None
+    feature_type_counts: Dict[str, int] = Field(default_factory=dict)  # FeatureType value → count
+    
     # Metadata
-    created_at: datetime = Field(default_factory=datetime.utcnow)
-    updated_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=_utcnow)
+    updated_at: datetime = Field(default_factory=_utcnow)
     created_by: str
     
-    def add_node(self, node: FeatureNode, parent_id: Optional[str] = None) -> None:
-        """Add a node to the tree and update relationships"""
-        self.nodes[node.id] = node
+    # node id → full ancestor closure; cleared whenever the tree mutates
+    _dep_cache: Dict[str, frozenset] = PrivateAttr(default_factory=dict)
+    
+    # child id → ids of nodes listing it in child_ids (reverse of child_ids)
+    _parent_index: Dict[str, Set[str]] = PrivateAttr(default_factory=dict)
+    
+    @model_validator(mode="after")
+    def _build_parent_index(self) -> "FeatureTree":
+        index: Dict[str, Set[str]] = {}
+        for node in self.nodes.values():
+            for child_id in node.child_ids:
+                index.setdefault(child_id, set()).add(node.id)
+        self._parent_index = index
+        return self
+    
+    def refresh_indices(self) -> None:
+        """Recompute design_params_node_id and feature_type_counts from nodes."""
+        dp_id = None
+        counts: Dict[str, int] = {}
+        for node_id, node in self.nodes.items():
+            ft = node.feature_type.value
+            counts[ft] = counts.get(ft, 0) + 1
+            if dp_id is None and _is_design_params_node(node_id, node):
+                dp_id = node_id
+        self.design_params_node_id = dp_id
+        self.feature_type_counts = counts
+    
+    def design_params_node(self) -> Optional[FeatureNode]:
+        """The "Design Parameters" node, via the saved index when present."""
+        if self.design_params_node_id is None and self.nodes and not self.feature_type_counts:
+            self.refresh_indices()   # tree saved before the index existed
+        return self.nodes.get(self.design_params_node_id) if self.design_params_node_id else None
+    
+    def invalidate_dependency_cache(self) -> None:
+        """Call after editing parent_references outside add_node/remove_node."""
+        self._dep_cache.clear()
+    
+    def add_node(self, node: FeatureNode, parent_id: Optional[str] = None,
+                 now: Optional[datetime] = None) -> None:
+        """Add a node to the tree and update relationships.
+        Pass `now` when adding many nodes so they share one clock read."""
+        now = now or _utcnow()
+        self._dep_cache.clear()
+        nodes = self.nodes
+        nodes[node.id] = node
         self.regeneration_order.append(node.id)
         
-        if parent_id and parent_id in self.nodes:
+        if parent_id and parent_id in nodes:
             # Add this node as child of parent
-            if node.id not in self.nodes[parent_id].child_ids:
-                self.nodes[parent_id].child_ids.append(node.id)
+            children = nodes[parent_id].child_ids
+            if node.id not in children:
+                children.append(node.id)
+            self._parent_index.setdefault(node.id, set()).add(parent_id)
         
         if not self.root_node_id:
             self.root_node_id = node.id
         
-        self.updated_at = datetime.utcnow()
+        self.updated_at = now
     
-    def remove_node(self, node_id: str) -> None:
+    def remove_node(self, node_id: str, now: Optional[datetime] = None) -> None:
         """Remove a node and all its descendants"""
         if node_id not in self.nodes:
             return
         
-        node = self.nodes[node_id]
+        now = now or _utcnow()
+        self._dep_cache.clear()
+        order = self._collect_subtree(node_id)
+        removed = set(order)
         
-        # Recursively remove all children
-        for child_id in node.child_ids.copy():
-            self.remove_node(child_id)
+        # Remove from parents' children lists; only the indexed parents are touched
+        nodes = self.nodes
+        parent_index = self._parent_index
+        for rid in order:
+            for parent_id in parent_index.pop(rid, ()):
+                if parent_id not in removed and parent_id in nodes:
+                    children = nodes[parent_id].child_ids
+                    if rid in children:
+                        children.remove(rid)
         
-        # Remove from parent's children list
-        for other_node in self.nodes.values():
-            if node_id in other_node.child_ids:
-                other_node.child_ids.remove(node_id)
+        # Remove from regeneration order with a set lookup instead of list.remove per node
+        self.regeneration_order = [n for n in self.regeneration_order if n not in removed]
         
-        # Remove from regeneration order
-        if node_id in self.regeneration_order:
-            self.regeneration_order.remove(node_id)
-        
-        # Remove the node itself
-        del self.nodes[node_id]
+        # Remove the nodes themselves, descendants first
+        for rid in reversed(order):
+            del nodes[rid]
         
         # Update root if needed
-        if self.root_node_id == node_id:
+        if self.root_node_id in removed:
             self.root_node_id = self.regeneration_order[0] if self.regeneration_order else None
         
-        self.updated_at = datetime.utcnow()
+        self.updated_at = now
+    
+    def _collect_subtree(self, node_id: str) -> List[str]:
+        """Ids of a node and all its descendants (via child_ids), pre-order"""
+        nodes = self.nodes
+        seen: Set[str] = set()
+        order: List[str] = []
+        to_visit = [node_id]
+        while to_visit:
+            nid = to_visit.pop()
+            if nid in seen or nid not in nodes:
+                continue
+            seen.add(nid)
+            order.append(nid)
+            to_visit.extend(nodes[nid].child_ids)
+        return order
     
     def get_node_children(self, node_id: str) -> List[FeatureNode]:
         """Get all child nodes of a given node"""
@@ -205,47 +349,56 @@ class FeatureTree(BaseModel):
     
     def get_node_dependencies(self, node_id: str, visited: Optional[Set[str]] = None) -> List[str]:
         """Get all nodes that this node depends on (directly or indirectly)"""
-        if node_id not in self.nodes:
+        nodes = self.nodes
+        if node_id not in nodes:
             return []
         
-        if visited is None:
-            visited = set()
+        cache = self._dep_cache
+        closure = cache.get(node_id)
+        if closure is None:
+            # Iterative DFS over parent references, reusing ancestors' closures
+            dependencies: Set[str] = set()
+            expanded: Set[str] = set()
+            stack = [node_id]
+            while stack:
+                current = stack.pop()
+                if current in expanded:
+                    continue
+                expanded.add(current)
+                for ref in nodes[current].parent_references:
+                    parent_id = ref.feature_id
+                    if parent_id not in nodes:
+                        continue
+                    dependencies.add(parent_id)
+                    if parent_id in expanded:
+                        continue
+                    known = cache.get(parent_id)
+                    if known is not None:
+                        dependencies |= known
+                    else:
+                        stack.append(parent_id)
+            closure = cache[node_id] = frozenset(dependencies)
         
-        if node_id in visited:
-            return []
-        
-        visited.add(node_id)
-        
-        dependencies = set()
-        node = self.nodes[node_id]
-        
-        # Add direct parent references
-        for ref in node.parent_references:
-            if ref.feature_id in self.nodes:
-                dependencies.add(ref.feature_id)
-                # Recursively add dependencies of dependencies
-                dependencies.update(self.get_node_dependencies(ref.feature_id, visited))
-        
-        return list(dependencies)
+        return list(closure)
     
     def validate_tree(self) -> List[str]:
         """Validate the tree structure and return list of errors"""
         errors = []
+        nodes = self.nodes
+        order = self.regeneration_order
         
-        # Check for circular dependencies
-        for node_id in self.nodes:
-            dependencies = self.get_node_dependencies(node_id)
-            if node_id in dependencies:
-                errors.append(f"Circular dependency detected for node {node_id}")
+        # Check for circular dependencies (one pass over the whole graph)
+        for component in _find_cycles(nodes):
+            errors.append(f"Circular dependency detected between nodes {', '.join(component)}")
         
         # Check that all referenced nodes exist
-        for node in self.nodes.values():
+        for node in nodes.values():
             for ref in node.parent_references:
-                if ref.feature_id not in self.nodes:
+                if ref.feature_id not in nodes:
                     errors.append(f"Node {node.id} references non-existent node {ref.feature_id}")
         
-        # Check regeneration order contains all nodes
-        if set(self.regeneration_order) != set(self.nodes.keys()):
+        # Check regeneration order contains all nodes (exactly once)
+        if len(order) != len(nodes) or nodes.keys() != set(order):
             errors.append("Regeneration order doesn't match node list")
         
         return errors
@@ -265,4 +418,4 @@ class FeatureTreeHistory(BaseModel):
     """History of changes to a feature tree"""
     tree_id: str
     operations: List[FeatureTreeOperation] = Field(default_factory=list)
-    created_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=_utcnow)
@@ -1,34 +1,62 @@
 # app/routes/account.py
 from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, BackgroundTasks
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, Literal
+from typing import Optional, Dict, List, Literal
 from app.services import storage_gcp as storage   # need direct access to collections
 from app.services.auth import get_current_user
+from app.services.gcp_clients import get_firestore_client
 from app.core.config import settings
 from google.cloud import storage as gcs
-import tempfile, shutil, uuid
+import uuid
 from app.services.storage_gcp import (
     TOKENS_PER_CREDIT, PROFIT_FACTOR, PLAN_CONFIG
 )
 from google.cloud import firestore
 from zoneinfo import ZoneInfo
 from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+from google.api_core.exceptions import BadRequest
 import datetime as _dt
+import os
+import json
+import hashlib
 import random
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from fractions import Fraction
+from cachetools import TTLCache
+import threading
 
 LOCAL_TZ = ZoneInfo("America/Chicago")
 
 router = APIRouter(prefix="/account", tags=["account"])
 
+# /me fans its independent Firestore reads out over this pool so the request
+# waits for the slowest read instead of the sum of all three.
+_READ_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix="account-read")
+
+WIPE_WORKERS = 20   # parallel project deletes when an account is removed
+
 # ---- Shared plan helpers (mirror storage_gcp) ----
 def _today_local_iso() -> str:
     return _dt.datetime.now(LOCAL_TZ).date().isoformat()
 
+@lru_cache(maxsize=64)
 def _month_key_from_day(day_iso: str) -> str:
     return f"m:{day_iso[:7]}"
 
+# tokens → credits as an exact ratio: credits = tokens * PROFIT_FACTOR / TOKENS_PER_CREDIT
+_CREDIT_RATIO = Fraction(PROFIT_FACTOR).limit_denominator(10_000) / TOKENS_PER_CREDIT
+_CREDIT_NUM, _CREDIT_DEN = _CREDIT_RATIO.numerator, _CREDIT_RATIO.denominator
+
 def _credits_from_tokens(tokens: int | float) -> int:
-    return int(round((float(tokens) * PROFIT_FACTOR) / TOKENS_PER_CREDIT))
+    if not isinstance(tokens, int):
+        return int(round((float(tokens) * PROFIT_FACTOR) / TOKENS_PER_CREDIT))
+    # integer math; ties go to even like round()
+    q, r = divmod(tokens * _CREDIT_NUM, _CREDIT_DEN)
+    if 2 * r > _CREDIT_DEN or (2 * r == _CREDIT_DEN and q & 1):
+        q += 1
+    return q
 
 def _prev_day_iso(day_iso: str) -> str:
     d = _dt.date.fromisoformat(day_iso)
@@ -39,6 +67,7 @@ def _cap_username(s: Optional[str]) -> Optional[str]:
         return None
     return str(s).strip()[:10] or None
 
+@lru_cache(maxsize=64)
 def _month_end_iso(day_iso: str) -> str:
     d = _dt.date.fromisoformat(day_iso)
     nxt = _dt.date(d.year + (1 if d.month == 12 else 0), 1 if d.month == 12 else d.month + 1, 1)
@@ -47,44 +76,165 @@ def _month_end_iso(day_iso: str) -> str:
     # keep YYYY-MM-DD for UI label
     return eom_midnight.date().isoformat()
 
-def _identity_doc_by_userid(user_id: str):
-    q = storage.C_IDENTITY.where("userID", "==", user_id).limit(1).get()
+# userID → identity DocumentReference. Only the ref is cached (its path never
+# changes), so the doc body is always read fresh; this just skips the query.
+_identity_refs: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+_identity_refs_lock = threading.Lock()
+
+def _forget_identity_ref(user_id: str) -> None:
+    with _identity_refs_lock:
+        _identity_refs.pop(user_id, None)
+
+@lru_cache(maxsize=16)
+def _plan_meta(plan: str) -> dict:
+    return PLAN_CONFIG.get(plan, PLAN_CONFIG["free"])
+
+# Fields each caller actually reads; everything else stays on the server.
+_ME_FIELDS = [
+    "userID", "email", "username", "photoUrl", "plan", "dailyQuota",
+    "monthlyCredits", "tokenUsage", "rolloverBalance", "creditsBank", "bankMode",
+]
+_BANK_FIELDS = ["userID", "rolloverBalance", "creditsBank"]
+_DELETE_FIELDS = ["userID", "projects"]
+
+def _identity_doc_by_userid(user_id: str, email: Optional[str] = None,
+                            fields: Optional[List[str]] = None):
+    # userID is always needed to verify an email-keyed hit
+    if fields is not None:
+        fields = list(dict.fromkeys(["userID", *fields]))
+
+    with _identity_refs_lock:
+        cached = _identity_refs.get(user_id)
+    if cached is not None:
+        snap = cached.get(field_paths=fields)
+        if snap.exists:
+            return snap.reference, snap.to_dict() or {}
+        _forget_identity_ref(user_id)
+
+    # Identity docs are keyed by email and our JWTs carry the email claim,
+    # so try a point read before falling back to the userID query.
+    if email:
+        snap = storage.C_IDENTITY.document(email.lower()).get(field_paths=fields)
+        data = snap.to_dict() if snap.exists else None
+        if data and data.get("userID") == user_id:
+            with _identity_refs_lock:
+                _identity_refs[user_id] = snap.reference
+            return snap.reference, data
+
+    q = storage.C_IDENTITY.where("userID", "==", user_id)
+    if fields is not None:
+        q = q.select(fields)
+    q = q.limit(1).get()
     if q:
-        return q[0].reference, q[0].to_dict()
+        with _identity_refs_lock:
+            _identity_refs[user_id] = q[0].reference
+        return q[0].reference, q[0].to_dict() or {}
     # fallback if sub is an email
     if "@" in user_id:
-        snap = storage.C_IDENTITY.document(user_id.lower()).get()
+        snap = storage.C_IDENTITY.document(user_id.lower()).get(field_paths=fields)
         if snap.exists:
-            return snap.reference, snap.to_dict()
+            return snap.reference, snap.to_dict() or {}
     raise HTTPException(404, f"User not found for sub='{user_id}'")
 
+def _me_reads(user_id: str, email: Optional[str], day_iso: str, mkey: str):
+    """(ref, doc, day_tokens, month_tokens) for /me. With a cached ref the
+    identity doc and both usage docs come back in a single get_all."""
+    with _identity_refs_lock:
+        cached = _identity_refs.get(user_id)
+    if cached is not None:
+        doc, day_tokens, mon_tokens = storage.read_identity_with_usage(cached, day_iso, mkey, _ME_FIELDS)
+        if doc is not None:
+            return cached, doc, day_tokens, mon_tokens
+        _forget_identity_ref(user_id)
+
+    ref, doc = _identity_doc_by_userid(user_id, email, _ME_FIELDS)
+    day_tokens, mon_tokens = storage.read_usage_tokens(ref, day_iso, mkey, legacy=doc.get("tokenUsage"))
+    return ref, doc, day_tokens, mon_tokens
+
+def _identity_ref(user_id: str, email: Optional[str] = None):
+    """Ref only, for writers that never look at the doc body. A cached ref is
+    returned without any read; otherwise resolve it with a userID-only read."""
+    with _identity_refs_lock:
+        cached = _identity_refs.get(user_id)
+    if cached is not None:
+        return cached
+    ref, _ = _identity_doc_by_userid(user_id, email, fields=["userID"])
+    return ref
 
 # ---- Notifications helper ----------------------------------------------------
+# (user_id, dedupe_key) → fingerprint of the content this process last wrote
+# under that key. Threshold notifs re-fire on every /me; a rewrite is skipped
+# only when title/body/data are identical, so live numbers (e.g. 76% after
+# 75%) still reach the doc. Per process only, for a day.
+_sent_notifs: TTLCache = TTLCache(maxsize=100_000, ttl=86_400)
+_sent_notifs_lock = threading.Lock()
+
+def _notif_fingerprint(kind: str, title: str, body: str, data: Optional[Dict]) -> str:
+    raw = json.dumps([kind, title, body, data or {}], sort_keys=True, default=str)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+def _already_sent(user_id: str, dedupe_key: Optional[str], fingerprint: str) -> bool:
+    if not dedupe_key:
+        return False
+    with _sent_notifs_lock:
+        return _sent_notifs.get((user_id, dedupe_key)) == fingerprint
+
+def _mark_sent(user_id: str, sent) -> None:
+    """`sent`: (dedupe_key, fingerprint) pairs that were just written."""
+    with _sent_notifs_lock:
+        for key, fingerprint in sent:
+            if key:
+                _sent_notifs[(user_id, key)] = fingerprint
+
 def _notify(user_id: str, kind: str, title: str, body: str = "",
             data: Optional[Dict] = None, ttl_days: int = 14,
-            dedupe_key: Optional[str] = None):
+            dedupe_key: Optional[str] = None,
+            pending: Optional[list] = None):
+    """Write a notification now, or stage it on `pending` for one batched
+    write via storage.push_notifications_batch."""
+    fingerprint = _notif_fingerprint(kind, title, body, data)
+    if _already_sent(user_id, dedupe_key, fingerprint):
+        return
+    if pending is not None:
+        pending.append({
+            "kind": kind, "title": title, "body": body,
+            "data": data or {}, "dedupe_key": dedupe_key, "ttl_days": ttl_days,
+            "fingerprint": fingerprint,
+        })
+        return
     try:
         storage.push_notification(
             user_id=user_id,
             kind=kind, title=title, body=body,
             data=data or {}, dedupe_key=dedupe_key, ttl_days=ttl_days,
         )
+        _mark_sent(user_id, [(dedupe_key, fingerprint)])
     except Exception as e:
         # Make failures visible in logs so we don't chase ghosts again
         print(f"[notifications] write failed for user_id={user_id}: {e}")
         raise
 
 
+def _flush_notifications(user_id: str, identity_ref, pending: list) -> None:
+    try:
+        storage.push_notifications_batch(identity_ref, pending)
+        _mark_sent(user_id, [(p.get("dedupe_key"), p.get("fingerprint")) for p in pending])
+    except Exception as e:
+        print(f"[notifications] batch write failed for user_id={user_id}: {e}")
+
+
 def _maybe_credit_threshold_notifs(user_id: str, *,
                                    scope: str,        # "daily" | "monthly"
                                    used: int,
                                    quota: int,
-                                   period_key: str):  # e.g. day ISO or "m:YYYY-MM"
+                                   period_key: str,   # e.g. day ISO or "m:YYYY-MM"
+                                   pending: Optional[list] = None):
     """Emit 80/90/100% threshold notifs for credits."""
     if quota <= 0:
         return
     pct = int(round(100 * used / quota))
-    for th in (75, 90, 100):
+    # highest threshold reached only; it supersedes the lower ones
+    for th in (100, 90, 75):
         if pct >= th:
             _notify(
                 user_id,
@@ -93,21 +243,25 @@ def _maybe_credit_threshold_notifs(user_id: str, *,
                 body=f"You used {used}/{quota} credits ({pct}%).",
                 data={"scope": scope, "percent": pct, "used": used, "quota": quota},
                 dedupe_key=f"credit:{scope}:{period_key}:{th}",
+                pending=pending,
             )
+            return
 
 
 def _maybe_action_threshold_notifs(user_id: str, *,
                                    key: str,         # "stl" | "step" | "projects"
                                    used: int,
                                    cap: Optional[int],
-                                   reset_at_iso: Optional[str]):
+                                   reset_at_iso: Optional[str],
+                                   pending: Optional[list] = None):
     """Emit 80/90/100% threshold notifs for STL/STEP/projects action limits."""
     if cap is None or cap <= 0:
         return
     pct = int(round(100 * used / cap))
     # Use reset_at_iso to dedupe once per window
     period_key = reset_at_iso or "unknown"
-    for th in (75, 90, 100):
+    # highest threshold reached only; it supersedes the lower ones
+    for th in (100, 90, 75):
         if pct >= th:
             _notify(
                 user_id,
@@ -116,7 +270,9 @@ def _maybe_action_threshold_notifs(user_id: str, *,
                 body=f"You used {used}/{cap} ({pct}%).",
                 data={"scope": key, "percent": pct, "used": used, "cap": cap, "resetAtISO": reset_at_iso},
                 dedupe_key=f"limit:{key}:{period_key}:{th}",
+                pending=pending,
             )
+            return
 
 
 # ---- Schemas ----
@@ -174,35 +330,73 @@ def record_progress_event(data: ProgressEventIn, user=Depends(get_current_user))
     return {"ok": True, "award": award, "snapshot": snap}
 
 
+# bankMode shapes: legacy string source, or {enabled, source}; anything else = off
+def _bank_mode_off(_):
+    return {"enabled": False, "source": None}
+
+_BANK_MODE_NORMALIZERS = {
+    str:  lambda m: {"enabled": True, "source": m},
+    dict: lambda m: {"enabled": bool(m.get("enabled", False)), "source": m.get("source")},
+}
+
+@dataclass(frozen=True, slots=True)
+class IdentityView:
+    """The identity fields /me uses, coerced once."""
+    user_id: Optional[str]
+    email: Optional[str]
+    username: Optional[str]
+    photo_url: Optional[str]
+    plan: str
+    daily_quota: int
+    monthly_cap: int
+    bank_cap: int
+    bank_mode: dict
+
+    @classmethod
+    def from_firestore(cls, doc: dict) -> "IdentityView":
+        plan = (doc.get("plan") or "free").lower()
+        plan_meta = _plan_meta(plan)
+        email = doc.get("email")
+        raw_mode = doc.get("bankMode")
+        return cls(
+            user_id=doc.get("userID"),
+            email=email,
+            username=_cap_username(doc.get("username") or (email.split("@")[0] if email else None)),
+            photo_url=doc.get("photoUrl"),
+            plan=plan,
+            daily_quota=int(doc.get("dailyQuota") or plan_meta["daily"]),
+            monthly_cap=int(doc.get("monthlyCredits") or plan_meta["monthly_cap"]),
+            bank_cap=int(plan_meta["bank_cap"]),
+            bank_mode=_BANK_MODE_NORMALIZERS.get(type(raw_mode), _bank_mode_off)(raw_mode),
+        )
+
 # ---- Account snapshot ----
 @router.get("/me")
-def me(user=Depends(get_current_user)):
-    ref, doc = _identity_doc_by_userid(user["sub"])
-    snap = storage.get_progress_snapshot(user["sub"])
+def me(bg: BackgroundTasks, user=Depends(get_current_user)):
+    day_iso  = _today_local_iso()
+    mkey     = _month_key_from_day(day_iso)
+    ident_f   = _READ_POOL.submit(_me_reads, user["sub"], user.get("email"), day_iso, mkey)
+    snap_f    = _READ_POOL.submit(storage.get_progress_snapshot, user["sub"])
+    actions_f = _READ_POOL.submit(storage.action_usage_snapshot, user["sub"])
 
-    action_limits = storage.action_usage_snapshot(user["sub"])
+    ref, doc, day_tokens, mon_tokens = ident_f.result()   # raises the 404 if the user is unknown
+    snap = snap_f.result()
+    action_limits = actions_f.result()
 
-    plan = (doc.get("plan") or "free").lower()
-    plan_meta = PLAN_CONFIG.get(plan, PLAN_CONFIG["free"])
+    ident = IdentityView.from_firestore(doc)
 
     # plan caps
-    daily_quota = int(doc.get("dailyQuota") or plan_meta["daily"])
-    monthly_cap = int(doc.get("monthlyCredits") or plan_meta["monthly_cap"])
-    bank_cap    = int(plan_meta["bank_cap"])
+    daily_quota = ident.daily_quota
+    monthly_cap = ident.monthly_cap
 
     # usage rollups
-    tu = doc.get("tokenUsage") or {}
-    day_iso  = _today_local_iso()
-    mkey     = _month_key_from_day(day_iso)
-
-    day_tokens = int((tu.get(day_iso) or {}).get("tokens", 0))
-    mon_tokens = int((tu.get(mkey)    or {}).get("tokens", 0))
-
     day_credits_used = _credits_from_tokens(day_tokens)
     mon_credits_used = _credits_from_tokens(mon_tokens)
     credits_left     = max(0, daily_quota - day_credits_used)
 
         # NEW: opportunistic threshold notifications (idempotent via dedupe keys)
+    #      staged on `pending` and written with one batch commit
+    pending: list = []
     try:
         _maybe_credit_threshold_notifs(
             user["sub"],
@@ -210,6 +404,7 @@ def me(user=Depends(get_current_user)):
             used=day_credits_used,
             quota=daily_quota,
             period_key=day_iso,    # one per day per threshold
+            pending=pending,
         )
         _maybe_credit_threshold_notifs(
             user["sub"],
@@ -217,6 +412,7 @@ def me(user=Depends(get_current_user)):
             used=mon_credits_used,
             quota=monthly_cap,
             period_key=mkey,       # one per month per threshold
+            pending=pending,
         )
 
         # STL/STEP (monthly) and Projects (weekly) action limits
@@ -233,56 +429,44 @@ def me(user=Depends(get_current_user)):
                 used=int(stl.get("used") or 0),
                 cap=(stl.get("cap")),
                 reset_at_iso=stl.get("resetAtISO"),
+                pending=pending,
             )
             _maybe_action_threshold_notifs(
                 user["sub"], key="step",
                 used=int(step.get("used") or 0),
                 cap=(step.get("cap")),
                 reset_at_iso=step.get("resetAtISO"),
+                pending=pending,
             )
             _maybe_action_threshold_notifs(
                 user["sub"], key="projects",
                 used=int(projects.get("used") or 0),
                 cap=(projects.get("cap")),
                 reset_at_iso=projects.get("resetAtISO"),
+                pending=pending,
             )
     except Exception:
         pass
+    if pending:
+        # Written after the response is sent (sync task → Starlette threadpool)
+        bg.add_task(_flush_notifications, user["sub"], ref, pending)
 
     # ── Rollover disabled for beta ───────────────────────────────────
     rollover_balance = 0
-    updates = {}
     # (No accrual, no month change logic, no writes)
-    bank_expiry_iso = _month_end_iso(day_iso)  # UI-only “Resets …” label
-
-    uname_raw = doc.get("username") or (doc.get("email","").split("@")[0] if doc.get("email") else None)
-    username  = _cap_username(uname_raw)
+    bank_expiry_iso = _month_end_iso(day_iso)  # UI subtitle (“Resets Aug 31”)
 
     # # Normalize bankMode but force disabled if it was left on
     # bank_mode = {"enabled": False, "source": None}
     # if doc.get("bankMode"):
     #     ref.set({"bankMode": bank_mode, "rolloverBalance": 0}, merge=True)
 
-    bank_expiry_iso = _month_end_iso(day_iso)  # for UI subtitle (“Resets Aug 31”)
-
-    # Normalize bankMode: support legacy string and new object shape
-    raw_mode = doc.get("bankMode")
-    if isinstance(raw_mode, str):
-        bank_mode = {"enabled": True, "source": raw_mode}
-    elif isinstance(raw_mode, dict):
-        bank_mode = {
-            "enabled": bool(raw_mode.get("enabled", False)),
-            "source":  raw_mode.get("source"),
-        }
-    else:
-        bank_mode = {"enabled": False, "source": None}
-
     return {
-        "userID": doc.get("userID"),
-        "email": doc.get("email"),
-        "username": username,
-        "photoUrl": doc.get("photoUrl"),
-        "plan": plan,
+        "userID": ident.user_id,
+        "email": ident.email,
+        "username": ident.username,
+        "photoUrl": ident.photo_url,
+        "plan": ident.plan,
 
         # daily + monthly
         "dailyQuota": daily_quota,
@@ -292,11 +476,11 @@ def me(user=Depends(get_current_user)):
         "monthlyCreditsUsed": mon_credits_used,
 
         # Bank buckets
-        "bankCap": bank_cap,
+        "bankCap": ident.bank_cap,
         "bankRollover": rollover_balance,               # monthly, expires
         "bankRewards":  int(snap.get("creditsBank", 0)),# lifetime, never expires
         "bankExpiryISO": bank_expiry_iso,               # YYYY-MM-DD
-        "bankMode": bank_mode,                          # normalized: {enabled, source}
+        "bankMode": ident.bank_mode,                    # normalized: {enabled, source}
 
         # Progress
         "xp": snap.get("xp", 0),
@@ -311,7 +495,7 @@ def me(user=Depends(get_current_user)):
 # ---- Profile ----
 @router.patch("/me")
 def patch_me(data: ProfilePatch, user=Depends(get_current_user)):
-    ref, _ = _identity_doc_by_userid(user["sub"])
+    ref = _identity_ref(user["sub"], user.get("email"))
     to_set: Dict = {}
     if data.username is not None:
         u = (data.username or "").strip()
@@ -333,21 +517,27 @@ def upload_avatar(file: UploadFile = File(...), user=Depends(get_current_user)):
     path = f"avatars/{user['sub']}/{uuid.uuid4().hex}{ext}"
     blob = bucket.blob(path)
 
-    with tempfile.NamedTemporaryFile(delete=False) as tmp:
-        shutil.copyfileobj(file.file, tmp)
-        tmp.flush()
-        blob.upload_from_filename(tmp.name, content_type=file.content_type or "image/png")
-
-    # Long-lived, cacheable avatar
+    # Long-lived, cacheable avatar; metadata + public ACL go out with the upload
+    # itself instead of separate patch()/make_public() calls
     blob.cache_control = "public, max-age=31536000, immutable"
-    blob.patch()
+    content_type = file.content_type or "image/png"
+
+    # Stream the request body straight to GCS (resumable, 1 MB chunks); no temp copy
+    blob.chunk_size = 1 << 20
+    src = file.file
     try:
-        blob.make_public()
+        blob.upload_from_file(src, content_type=content_type, predefined_acl="publicRead")
         url = f"https://storage.googleapis.com/{settings.gcs_bucket}/{path}"
-    except Exception:
+    except BadRequest as e:
+        # uniform bucket-level access rejects object ACLs → private + signed URL;
+        # any other failure (network, timeout, bad data) propagates as-is
+        if "uniform bucket-level access" not in str(e).lower() and "acl" not in str(e).lower():
+            raise
+        src.seek(0)
+        blob.upload_from_file(src, content_type=content_type)
         url = blob.generate_signed_url(version="v4", expiration=60*60*24*7, method="GET")
 
-    ref, _ = _identity_doc_by_userid(user["sub"])
+    ref = _identity_ref(user["sub"], user.get("email"))
     ref.set({"photoUrl": url}, merge=True)
     return {"photoUrl": url}
 
@@ -358,7 +548,7 @@ class PlanIn(BaseModel):
 
 @router.post("/plan")
 def set_plan(data: PlanIn, user=Depends(get_current_user)):
-    ref, _ = _identity_doc_by_userid(user["sub"])
+    ref = _identity_ref(user["sub"], user.get("email"))
     plan = (data.plan or "").lower()
     if plan not in PLAN_CONFIG:
         raise HTTPException(400, "unknown plan")
@@ -371,22 +561,28 @@ def set_plan(data: PlanIn, user=Depends(get_current_user)):
         "monthlyCredits": int(cfg["monthly_cap"]),
     }
     ref.set(updates, merge=True)
+    storage.forget_ai_allowed(user["sub"])
     return {"ok": True, "plan": plan}
 
 # ---- Delete account ----
 @router.delete("/me")
 def delete_me(bg: BackgroundTasks, user=Depends(get_current_user)):
-    ref, doc = _identity_doc_by_userid(user["sub"])
+    ref, doc = _identity_doc_by_userid(user["sub"], user.get("email"), _DELETE_FIELDS)
     projects = doc.get("projects", [])
 
     ref.delete()
+    _forget_identity_ref(user["sub"])
+
+    def _delete_one(pid):
+        try:
+            storage.delete_project(pid)
+        except Exception:
+            pass
 
     def _wipe():
-        for pid in projects:
-            try:
-                storage.delete_project(pid)
-            except Exception:
-                pass
+        # each delete is I/O-bound (Firestore + GCS), so run them side by side
+        with ThreadPoolExecutor(max_workers=WIPE_WORKERS, thread_name_prefix="account-wipe") as pool:
+            list(pool.map(_delete_one, projects))
     bg.add_task(_wipe)
 
     return {"ok": True}
@@ -394,7 +590,7 @@ def delete_me(bg: BackgroundTasks, user=Depends(get_current_user)):
 # ---- Bank mode: enable/disable ----
 @router.post("/bank/use")
 def bank_use(data: BankUseIn, user=Depends(get_current_user)):
-    ref, doc = _identity_doc_by_userid(user["sub"])
+    ref, doc = _identity_doc_by_userid(user["sub"], user.get("email"), _BANK_FIELDS)
     src = data.source
 
     # Validate availability
@@ -414,31 +610,45 @@ def bank_use(data: BankUseIn, user=Depends(get_current_user)):
 
 @router.post("/bank/clear")
 def bank_clear(user=Depends(get_current_user)):
-    ref, _ = _identity_doc_by_userid(user["sub"])
+    ref = _identity_ref(user["sub"], user.get("email"))
     ref.set({"bankMode": {"enabled": False, "source": None}}, merge=True)
+    storage.forget_ai_allowed(user["sub"])
     return {"ok": True, "bankMode": {"enabled": False, "source": None}}
 
 # --- Notifications REST (polling) ------------------------------------------
 from google.cloud import firestore as _fs_mod
 from google.cloud.firestore_v1 import FieldFilter
+from google.api_core.exceptions import NotFound
+
+@lru_cache(maxsize=1024)
+def _build_notif_query(ref_path: str, only_unseen: bool, limit: int):
+    # Query objects are immutable builders, so one instance per
+    # (identity, filter, page size) can be reused across requests.
+    q = get_firestore_client().collection(f"{ref_path}/notifications")
+    if only_unseen:
+        q = q.where(filter=FieldFilter("seen", "==", False))
+    return q.order_by("ts", direction=_fs_mod.Query.DESCENDING).limit(limit)
+
+def _purge_notifications(refs: list) -> None:
+    try:
+        storage.delete_refs(refs)
+    except Exception:
+        # best-effort; stale docs are filtered again on the next listing
+        pass
 
 @router.get("/notifications")
 def list_notifications(
+    bg: BackgroundTasks,
     only_unseen: bool = True,
     limit: int = 50,
     user = Depends(get_current_user),
 ):
-    ref, _ = _identity_doc_by_userid(user["sub"])
-    q = ref.collection("notifications")
-
-    if only_unseen:
-        q = q.where(filter=FieldFilter("seen", "==", False))
-
-    q = q.order_by("ts", direction=_fs_mod.Query.DESCENDING).limit(max(1, min(limit, 100)))
+    ref = _identity_ref(user["sub"], user.get("email"))
+    q = _build_notif_query(ref.path, bool(only_unseen), max(1, min(limit, 100)))
 
     snaps = q.get()
     items = []
-    purged = 0
+    stale_refs = []
 
     def _iso(v):
         try:
@@ -446,17 +656,17 @@ def list_notifications(
         except Exception:
             return None
 
+    # one clock read for the whole page
+    now_local   = _dt.datetime.now(LOCAL_TZ)
+    now_utc     = _dt.datetime.now(_dt.timezone.utc).replace(tzinfo=None)
+    today_local = now_local.date()
+
     for s in snaps:
         d = s.to_dict() or {}
         # Opportunistic cleanup: drop notifications that are no longer relevant
         try:
-            if _is_stale_notification_payload(d):
-                try:
-                    s.reference.delete()
-                    purged += 1
-                except Exception:
-                    # best-effort; don't break listings if delete fails
-                    pass
+            if _is_stale_notification_payload(d, now_utc, today_local, now_local):
+                stale_refs.append(s.reference)
                 continue  # skip adding to response
         except Exception:
             # If the checker itself fails, never block the response
@@ -473,27 +683,32 @@ def list_notifications(
             "expiresAt": _iso(d.get("expiresAt")),
         })
 
+    if stale_refs:
+        # batched delete after the response is sent
+        bg.add_task(_purge_notifications, stale_refs)
+
     # (Optional) include how many were purged for debugging; comment out if undesired
-    # return {"items": items, "purged": purged}
+    # return {"items": items, "purged": len(stale_refs)}
     return {"items": items}
 
 
 @router.post("/notifications/{nid}/seen")
 def mark_notification_seen_api(nid: str, user = Depends(get_current_user)):
-    ref, _ = _identity_doc_by_userid(user["sub"])
+    ref = _identity_ref(user["sub"], user.get("email"))
     nref = ref.collection("notifications").document(nid)
-    if not nref.get().exists:
+    try:
+        # update() carries an exists precondition, so no separate read is needed
+        nref.update({"seen": True})
+    except NotFound:
         raise HTTPException(404, "Notification not found")
-    nref.update({"seen": True})
     return {"ok": True}
 
-# Add this to your account.py file temporarily for testing
+# ---- Debug-only notification endpoints -------------------------------------
+# Only registered when DEBUG=1 so they never ship on the production router.
+DEBUG_ROUTES = os.getenv("DEBUG", "").lower() in ("1", "true", "yes")
 
-@router.post("/test-notification")
 def create_test_notification(user=Depends(get_current_user)):
     """Create a test notification for debugging purposes."""
-    import random
-    
     # Create different types of test notifications
     notification_types = [
         {
@@ -539,7 +754,6 @@ def create_test_notification(user=Depends(get_current_user)):
         print(f"Error creating test notification: {e}")
         raise HTTPException(500, f"Failed to create test notification: {str(e)}")
 
-@router.post("/test-notification-bulk")
 def create_bulk_test_notifications(user=Depends(get_current_user)):
     """Create multiple test notifications at once."""
     notifications_created = []
@@ -572,6 +786,10 @@ def create_bulk_test_notifications(user=Depends(get_current_user)):
         "notifications": notifications_created
     }
 
+if DEBUG_ROUTES:
+    router.post("/test-notification")(create_test_notification)
+    router.post("/test-notification-bulk")(create_bulk_test_notifications)
+
 # ---- Notification cleanup helpers ------------------------------------------
 def _to_local_date(ts) -> _dt.date | None:
     """Best-effort convert Firestore timestamp/datetime to LOCAL date."""
@@ -602,7 +820,12 @@ def _as_naive_utc(dt_like) -> _dt.datetime | None:
         pass
     return None
 
-def _is_stale_notification_payload(d: dict) -> bool:
+def _is_stale_notification_payload(
+    d: dict,
+    now_utc: Optional[_dt.datetime] = None,
+    today_local: Optional[_dt.date] = None,
+    now_local: Optional[_dt.datetime] = None,
+) -> bool:
     """
     Decide if a notification is stale *based on its payload*.
     Rules:
@@ -611,9 +834,14 @@ def _is_stale_notification_payload(d: dict) -> bool:
       • credit_threshold(monthly): if ts local month != current month → stale
       • credit_threshold(stl/step/projects): if resetAtISO and now >= resetAtISO → stale
       • others: rely on TTL only
+    Callers checking many payloads should pass the clock values in once.
     """
-    now_utc = _dt.datetime.utcnow().replace(tzinfo=None)
-    today_local = _dt.datetime.now(LOCAL_TZ).date()
+    if now_local is None:
+        now_local = _dt.datetime.now(LOCAL_TZ)
+    if now_utc is None:
+        now_utc = now_local.astimezone(_dt.timezone.utc).replace(tzinfo=None)
+    if today_local is None:
+        today_local = now_local.date()
 
     kind = d.get("kind")
     data = d.get("data") or {}
@@ -646,7 +874,6 @@ def _is_stale_notification_payload(d: dict) -> bool:
                     if reset_dt.tzinfo is None:
                         # treat as local if naive
                         reset_dt = reset_dt.replace(tzinfo=LOCAL_TZ)
-                    now_local = _dt.datetime.now(LOCAL_TZ)
                     if now_local >= reset_dt:
                         return True
                 except Exception:
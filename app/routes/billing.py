@@ -1,11 +1,16 @@
 # app/routes/billing.py
 from __future__ import annotations
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request
 from pydantic import BaseModel
-from typing import Optional, Dict
+from typing import Optional, Dict, Final, Mapping
+from types import MappingProxyType
 import os
+import json
+import asyncio
+import threading
 import stripe
 from app.services.auth import get_current_user
+from app.services.rate_limit import limit_user
 from app.core.config import settings
 from app.services import storage_gcp as storage
 import sys
@@ -13,6 +18,7 @@ import sys
 router = APIRouter(prefix="/billing", tags=["billing"])
 
 stripe.api_key = settings.stripe_secret_key or None
+stripe.max_network_retries = 3   # retries use idempotency keys, so creates stay single
 
 if not stripe.api_key or stripe.api_key.startswith("pk_"):
     raise RuntimeError(
@@ -25,6 +31,16 @@ PRICE_IDS = {
     "plus": settings.stripe_price_plus_monthly,
     "pro":  settings.stripe_price_pro_monthly,
 }
+_bad_prices = [plan for plan, pid in PRICE_IDS.items() if not str(pid or "").startswith("price_")]
+if _bad_prices:
+    raise RuntimeError(
+        f"Invalid Stripe price ID for {', '.join(_bad_prices)}: must start with 'price_'. "
+        "Check STRIPE_PRICE_* in your .env."
+    )
+# validated once; checkout is a plain lookup from here on
+_PRICE_VALID: Final[Mapping[str, str]] = MappingProxyType(dict(PRICE_IDS))
+# …and back, for subscription webhooks that only carry the price id
+_PLAN_BY_PRICE = {pid: plan for plan, pid in PRICE_IDS.items()}
 
 def _stripe_mode(k: str) -> str:
     if not k or not k.startswith("sk_"): return "invalid"
@@ -51,9 +67,9 @@ class CheckoutIn(BaseModel):
     plan: str  # "plus" | "pro"
 
 def _ensure_price(plan: str) -> str:
-    pid = PRICE_IDS.get((plan or "").lower())
-    if not pid or not str(pid).startswith("price_"):
-        raise HTTPException(500, "Stripe price ID not configured. Set STRIPE_PRICE_* env vars.")
+    pid = _PRICE_VALID.get(plan.lower() if plan else "")
+    if not pid:
+        raise HTTPException(400, "unknown plan")
     return pid
 
 @router.post("/portal")
@@ -79,12 +95,6 @@ def _get_or_create_customer(user_doc: Dict) -> str:
 
     email = user_doc.get("email") or None
     username = user_doc.get("username") or None
-    customer = stripe.Customer.create(
-        email=email,
-        name=username or email or None,
-        metadata={"userID": user_doc.get("userID") or ""},
-    )
-    # persist to identity
     try:
         customer = stripe.Customer.create(
             email=email,
@@ -99,8 +109,23 @@ def _get_or_create_customer(user_doc: Dict) -> str:
             "(test vs live). If running locally, ensure config.py loads .env with override=True."
         ) from e
 
+    # persist to identity so the next call reuses it
+    user_id = user_doc.get("userID")
+    if user_id:
+        try:
+            storage.set_identity_fields(user_id, stripeCustomerId=customer.id)
+        except Exception:
+            pass
+    storage.index_stripe_customer(customer.id, user_id)
+    return customer.id
+
+# Checkout fans out to 1-3 Stripe calls; cap how many run at once so a burst
+# can't tie up the threadpool or trip Stripe's own rate limits.
+CHECKOUT_CONCURRENCY = int(os.getenv("CHECKOUT_CONCURRENCY", "8"))
+_checkout_slots = threading.BoundedSemaphore(CHECKOUT_CONCURRENCY)
+
 @router.post("/checkout")
-def create_checkout_session(data: CheckoutIn, user=Depends(get_current_user)):
+def create_checkout_session(data: CheckoutIn, user=Depends(limit_user("checkout", 10))):
     """
     Returns a Stripe-hosted Checkout URL for upgrading the current user
     to the requested plan.
@@ -108,6 +133,14 @@ def create_checkout_session(data: CheckoutIn, user=Depends(get_current_user)):
     if not stripe.api_key:
         raise HTTPException(500, "Stripe not configured")
 
+    if not _checkout_slots.acquire(timeout=5):
+        raise HTTPException(503, "Checkout busy, try again", headers={"Retry-After": "5"})
+    try:
+        return _create_checkout_session(data, user)
+    finally:
+        _checkout_slots.release()
+
+def _create_checkout_session(data: CheckoutIn, user: dict) -> dict:
     ref, doc = storage._identity_ref_by_user_id(user["sub"])  # raises if missing
     price_id = _ensure_price(data.plan)
     customer_id = _get_or_create_customer(doc)
@@ -132,9 +165,10 @@ def create_checkout_session(data: CheckoutIn, user=Depends(get_current_user)):
     return {"url": session.url}
 
 # ---- Webhook ---------------------------------------------------------------
+WEBHOOK_MAX_BYTES = 512 * 1024   # Stripe events are <256 KB; 2x headroom
 
 @router.post("/webhook")
-async def stripe_webhook(request: Request):
+async def stripe_webhook(request: Request, background_tasks: BackgroundTasks):
     """
     Handles Stripe events and updates the user's plan.
     IMPORTANT: configure your Stripe endpoint to POST here:
@@ -144,8 +178,25 @@ async def stripe_webhook(request: Request):
     if not webhook_secret:
         raise HTTPException(500, "Webhook not configured")
 
-    payload = await request.body()
+    # Cheap rejects before reading/parsing anything: a real Stripe signature
+    # header always carries t= and v1=, and events are well under the cap.
     sig_header = request.headers.get("stripe-signature")
+    if not sig_header or "t=" not in sig_header or "v1=" not in sig_header:
+        raise HTTPException(400, "Invalid signature")
+    try:
+        declared = int(request.headers.get("content-length") or 0)
+    except ValueError:
+        raise HTTPException(400, "Invalid content-length")
+    if declared > WEBHOOK_MAX_BYTES:
+        raise HTTPException(413, "Payload too large")
+
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > WEBHOOK_MAX_BYTES:       # chunked bodies have no content-length
+            raise HTTPException(413, "Payload too large")
+        chunks.append(chunk)
+    payload = b"".join(chunks)
     try:
         event = stripe.Webhook.construct_event(payload, sig_header, webhook_secret)
     except stripe.error.SignatureVerificationError:
@@ -153,7 +204,62 @@ async def stripe_webhook(request: Request):
     except Exception as e:
         raise HTTPException(400, f"Webhook error: {e}")
 
-    # Minimal, robust handlers
+    # Stripe redelivers on timeouts/5xx; handle each event id once. The claim
+    # persists the raw event, so we can ack right away and handle it after the
+    # response; anything that fails or dies mid-way is retried by
+    # drain_webhook_events once its lease runs out.
+    claimed = await asyncio.to_thread(
+        storage.claim_webhook_event, event["id"], event["type"], payload.decode("utf-8")
+    )
+    if claimed:
+        background_tasks.add_task(_process_event, event)
+
+    # Always 200 to acknowledge receipt
+    return {"received": True}
+
+
+def _process_event(event) -> None:
+    event_id = event["id"]
+    try:
+        skipped = _dispatch_event(event)
+    except Exception as e:
+        print(f"[Stripe] webhook {event_id} ({event['type']}) failed: {e}", file=sys.stderr)
+        storage.fail_webhook_event(event_id, str(e))
+        return
+    storage.finish_webhook_event(event_id, f"skipped:{skipped}" if skipped else "done")
+
+
+def drain_webhook_events() -> int:
+    """Re-run stored events that failed or were abandoned. Returns events handled."""
+    handled = 0
+    for event_id in storage.due_webhook_events():
+        data = storage.take_over_webhook_event(event_id)
+        if data is None:
+            continue   # another instance got it, or it finished meanwhile
+        if not data.get("payload"):
+            storage.finish_webhook_event(event_id, "dead:no-payload")
+            continue
+        event = stripe.Event.construct_from(json.loads(data["payload"]), stripe.api_key)
+        _process_event(event)
+        handled += 1
+    return handled
+
+
+def _is_stale(event, user_id: str) -> bool:
+    """
+    Plan-changing events share one per-user watermark on `event.created`, so a
+    late redelivery (e.g. an old subscription.deleted) can't undo a newer one.
+    """
+    try:
+        return not storage.advance_stripe_watermark(user_id, "plan", event.get("created") or 0)
+    except Exception:
+        return False
+
+def _dispatch_event(event) -> Optional[str]:
+    """
+    Apply one verified event; returns a skip reason or None. Plan and identity
+    write failures raise, so the caller can hand the event back for a retry.
+    """
     if event["type"] == "checkout.session.completed":
         sess = event["data"]["object"]
         # Only act for subscriptions
@@ -164,51 +270,37 @@ async def stripe_webhook(request: Request):
             subscription_id = sess.get("subscription")
 
             if user_id and plan in ("plus", "pro"):
+                if _is_stale(event, user_id):
+                    return "stale"
+                # Persist Stripe ids; failures propagate so the event is retried
+                storage.set_identity_fields(
+                    user_id,
+                    stripeCustomerId=customer_id,
+                    stripeSubscriptionId=subscription_id,
+                )
                 try:
-                    # Persist Stripe ids
-                    storage.set_identity_fields(
-                        user_id,
-                        stripeCustomerId=customer_id,
-                        stripeSubscriptionId=subscription_id,
-                    )
+                    storage.index_stripe_customer(customer_id, user_id)
                 except Exception:
-                    pass
+                    pass   # best effort: the lookup falls back to a query
                 # Upgrade plan immediately
-                try:
-                    storage.set_plan_for_user(user_id, plan)
-                except Exception:
-                    # Don't fail the webhook; Stripe will retry on 5xx
-                    pass
+                storage.set_plan_for_user(user_id, plan)
 
     elif event["type"] in ("customer.subscription.updated", "customer.subscription.created"):
         sub = event["data"]["object"]
         # If user id not in metadata, we can try to look up by customer id
         customer_id = sub.get("customer")
-        # Resolve user by browsing identity collection for this customer id
-        try:
-            # Small helper: query identity where stripeCustomerId == customer_id
-            snaps = storage.C_IDENTITY.where(filter=storage.FieldFilter("stripeCustomerId", "==", customer_id)).limit(1).get()
-            if snaps:
-                ref = snaps[0].reference
-                doc = snaps[0].to_dict() or {}
-                user_id = doc.get("userID")
-            else:
-                user_id = None
-        except Exception:
-            user_id = None
+        # Resolve user via the customer id → userID index (point read)
+        user_id = storage.user_id_for_stripe_customer(customer_id)
 
         # If price changed (upgrade/downgrade), set plan from price → our plan key
-        try:
-            items = sub.get("items", {}).get("data", [])
-            price_id = items[0]["price"]["id"] if items else None
-            plan = None
-            if price_id == os.getenv("STRIPE_PRICE_PLUS_MONTHLY"): plan = "plus"
-            if price_id == os.getenv("STRIPE_PRICE_PRO_MONTHLY"):  plan = "pro"
-            if user_id and plan:
-                storage.set_plan_for_user(user_id, plan)
-                storage.set_identity_fields(user_id, stripeSubscriptionId=sub.get("id"))
-        except Exception:
-            pass
+        items = (sub.get("items") or {}).get("data") or []
+        price_id = ((items[0].get("price") or {}).get("id")) if items else None
+        plan = _PLAN_BY_PRICE.get(price_id)
+        if user_id and plan:
+            if _is_stale(event, user_id):
+                return "stale"
+            storage.set_plan_for_user(user_id, plan)
+            storage.set_identity_fields(user_id, stripeSubscriptionId=sub.get("id"))
 
         # If cancel_at_period_end flips, you might want to store it for UI:
         # storage.set_identity_fields(user_id, cancelAt=sub.get("cancel_at_period_end"))
@@ -217,14 +309,10 @@ async def stripe_webhook(request: Request):
         # Downgrade to free when subscription is deleted (or payment failed persistently)
         obj = event["data"]["object"]
         customer_id = obj.get("customer")
-        try:
-            snaps = storage.C_IDENTITY.where(filter=storage.FieldFilter("stripeCustomerId", "==", customer_id)).limit(1).get()
-            if snaps:
-                user_id = (snaps[0].to_dict() or {}).get("userID")
-                if user_id:
-                    storage.set_plan_for_user(user_id, "free")
-        except Exception:
-            pass
+        user_id = storage.user_id_for_stripe_customer(customer_id)
+        if user_id:
+            if _is_stale(event, user_id):
+                return "stale"
+            storage.set_plan_for_user(user_id, "free")
 
-    # Always 200 to acknowledge receipt
-    return {"received": True}
+    return None
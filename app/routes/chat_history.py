@@ -1,23 +1,34 @@
 # app/routes/chat_history.py
+from collections import deque
 from fastapi import APIRouter, Depends, HTTPException, Query
 from typing import List
 from google.cloud.firestore import Query as FSQuery
 from app.services.auth import get_current_user
 from app.services.storage_gcp import C_CHAT
+from app.routes.helpers import DocsJSONResponse
 
 router = APIRouter(tags=["chat"])
 
+CHAT_HISTORY_LIMIT = 500   # newest N messages per project
+# what the chat panel renders; token counts/op links stay server-side
+CHAT_HISTORY_FIELDS = ["role", "content", "agent", "designStage", "userID", "ts"]
+
 @router.get("/chat/history", response_model=List[dict])
 def get_chat_history(
     project_id: str = Query(...),
     user=Depends(get_current_user),
 ):
     # TODO: enforce that user.sub === owner of project_id
+    # newest CHAT_HISTORY_LIMIT messages, streamed (limit_to_last can't be) and
+    # prepended as they arrive so the result is already oldest→newest
     snaps = (
         C_CHAT.where("projectID", "==", project_id)
               .order_by("ts", direction=FSQuery.DESCENDING)
-              .get()
+              .select(CHAT_HISTORY_FIELDS)
+              .limit(CHAT_HISTORY_LIMIT)
+              .stream()
     )
-    # return oldest→newest
-    msgs = [{"id": s.id, **s.to_dict()} for s in snaps]
-    return list(reversed(msgs))
\ No newline at end of file
+    msgs: deque = deque()
+    for s in snaps:
+        msgs.appendleft({"id": s.id, **s.to_dict()})
+    return DocsJSONResponse(list(msgs))
@@ -5,8 +5,14 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
 from app.services import storage
 from app.services.auth import get_current_user
+from app.services.rate_limit import limit_user, limit_ip
 from app.services.storage_gcp import C_META
+from app.routes.helpers import DocsJSONResponse
+import asyncio
 import re
+import threading
+from functools import lru_cache
+from cachetools import TTLCache
 
 router = APIRouter(prefix="/community", tags=["community"])
 
@@ -33,12 +39,14 @@ async def get_current_user_optional(
 
 # ───────────────────────── helpers ─────────────────────────
 
-_IMG_VER_RX = re.compile(r"/images/(\d+)\.(?:png|jpe?g|webp)\b", re.I)
+# matches on the full URL; the lookahead stops at the query/fragment
+_IMG_VER_RX = re.compile(r"/images/(\d+)\.(?:png|jpe?g|webp)(?=[?#]|$)", re.I)
 
+@lru_cache(maxsize=4096)
 def _preview_ver_from_url(url: str | None) -> int | None:
     if not url:
         return None
-    m = _IMG_VER_RX.search(url.split("?", 1)[0])
+    m = _IMG_VER_RX.search(url)
     if not m:
         return None
     try:
@@ -52,14 +60,13 @@ def _is_stl_ver(pid: str, ver: int | None) -> bool:
     doc = storage.get_artifact(pid, f"cad_file_{int(ver)}_{pid}")
     return bool(doc and (doc.get("data") or {}).get("export") == "stl")
 
-def _best_stl_for(pid: str, preferred: int | None) -> int | None:
+def _best_stl_for(docs: list[dict], preferred: int | None) -> int | None:
     """
-    Pick the STL version we should display:
+    Pick the STL version we should display from a project's cad_file docs:
     • If `preferred` is STL → keep it
     • Else → newest STL ≤ preferred
     • Else → newest STL overall
     """
-    docs = storage.list_artifacts(pid, "cad_file", latest=False) or []
     stls = [d for d in docs if (d.get("data") or {}).get("export") == "stl"]
     if not stls:
         return None
@@ -69,95 +76,133 @@ def _best_stl_for(pid: str, preferred: int | None) -> int | None:
             return int(max(le, key=lambda d: int(d.get("version", 0)))["version"])
     return int(max(stls, key=lambda d: int(d.get("version", 0)))["version"])
 
-def _brain_for_cad_ver(pid: str, cad_ver: int | None) -> int | None:
-    if cad_ver is None:
-        return None
-    bundles = storage.list_artifacts(pid, "version_bundle", latest=False) or []
-    best = None
-    for b in bundles:
-        data = b.get("data") or {}
-        try:
-            if int(data.get("cad_file_ver", -1)) == int(cad_ver):
-                if (best is None) or int(b.get("version", 0)) > int(best.get("version", 0)):
-                    best = b
-        except Exception:
-            continue
-    if best:
-        bv = (best.get("data") or {}).get("brainstorm_ver")
-        return int(bv) if bv is not None else None
-    return None
-
-
 # ───────────────────────── routes ─────────────────────────
 
-@router.get("/feed")
-async def community_feed(limit: int = 24, user=Depends(get_current_user_optional)):
-    items = storage.get_community_feed(limit, sign_previews=True)
-    uid = user["sub"] if user else None
-
+# The hydrated feed is the same for every viewer apart from likedByUser and
+# the own-originals filter, so it's built once per `limit` and shared for a few
+# seconds; the per-user bits are overlaid on a copy.
+FEED_CACHE_TTL_S = 20
+_feed_cache: TTLCache = TTLCache(maxsize=256, ttl=FEED_CACHE_TTL_S)
+# read/filled on the event loop, patched from like_route in the threadpool
+_feed_cache_lock = threading.Lock()
+
+async def _shared_feed(limit: int) -> tuple[list[dict], dict]:
+    """(items, likers) where likers[pid] = (recent liker ids, whether that set is complete)."""
+    with _feed_cache_lock:
+        cached = _feed_cache.get(limit)
+    if cached is not None:
+        return cached
+
+    items = await asyncio.to_thread(storage.get_community_feed, limit, sign_previews=True)
     items = [it for it in items if it.get("preview")]
 
-    # hydrate liked flags & ensure the CAD version we return is the one
-    # that matches the card preview (and is an STL)
+    # The page's artifact and maker lookups are independent, so issue them
+    # side by side off the event loop: one batched read each.
+    pids = [it["id"] for it in items]
+    owner_ids = [it.get("ownerID") for it in items if it.get("ownerID")]
+    cad_docs, idmap = await asyncio.gather(
+        asyncio.to_thread(storage.list_artifacts_bulk, pids, "cad_file", ["data.export"]),
+        asyncio.to_thread(storage.fetch_identity_min, owner_ids),
+    )
+
+    # ensure the CAD version we return is the one that matches the card
+    # preview (and is an STL)
+    likers: dict[str, tuple[frozenset, bool]] = {}
     for it in items:
         pid = it["id"]
 
+        # liker ids are only used for the liked flag, never sent to clients
+        recent = it.pop("recentLikers", None) or ()
+        likers[pid] = (frozenset(recent), len(recent) >= int(it.get("likesCount") or 0))
+
         # 1) pick the version from the preview image url, if present
         #    (this is the version the user actually *sees* on the card)
         display_ver = _preview_ver_from_url(it.get("preview"))
 
         # 2) normalize to an STL version (newest STL ≤ display_ver; else newest STL)
-        display_ver = _best_stl_for(pid, display_ver)
+        display_ver = _best_stl_for(cad_docs.get(pid, []), display_ver)
 
         # 3) fall back to legacy cadVersion if needed
         if display_ver is None:
-            display_ver = _best_stl_for(pid, it.get("cadVersion"))
+            display_ver = _best_stl_for(cad_docs.get(pid, []), it.get("cadVersion"))
 
         it["cadVersion"] = display_ver
 
-        # Map the brainstorm version that was current when this CAD was produced
-        it["brainVersion"] = _brain_for_cad_ver(pid, display_ver)
-
-        # liked flag
-        it["likedByUser"] = bool(uid and storage.has_liked(pid, uid))
-
-    # optional: hide my own originals
-    if uid:
-        items = [it for it in items if it.get("ownerID") != uid]
-
-    # attach maker username + avatar
-    owner_ids = [it.get("ownerID") for it in items if it.get("ownerID")]
-    idmap = storage.fetch_identity_min(owner_ids)
-
-    for it in items:
+        # attach maker username + avatar
         ident = idmap.get(it.get("ownerID"), {})
         it["makerName"]  = ident.get("username") or "maker"
         it["makerPhoto"] = ident.get("photoUrl") or None
         it["makerTier"]  = ident.get("tier") or "apprentice"
 
-    items.sort(
-        key=lambda it: (
-            int(it.get("likesCount", 0)),
-            int(it.get("remixCount", 0)),
-        ),
-        reverse=True,
-    )
+    # Map the brainstorm version that was current when each CAD was produced:
+    # one indexed limit-1 query per card, issued concurrently
+    brain_vers = await asyncio.gather(*(
+        asyncio.to_thread(storage.brain_ver_for_cad, it["id"], it["cadVersion"])
+        for it in items
+    ))
+    for it, bv in zip(items, brain_vers):
+        it["brainVersion"] = bv
+
+    with _feed_cache_lock:
+        _feed_cache[limit] = (items, likers)
+    return items, likers
+
+
+@router.get("/feed")
+async def community_feed(limit: int = 24, user=Depends(get_current_user_optional)):
+    items, likers = await _shared_feed(limit)
+    uid = user["sub"] if user else None
+
+    # optional: hide my own originals
+    if uid:
+        items = [it for it in items if it.get("ownerID") != uid]
 
-    return items
+    # liked flags: answered from the embedded recentLikers; only projects past
+    # the cap (or not yet backfilled) need the batched liked_users read
+    liked: set = set()
+    if uid:
+        unknown = []
+        for it in items:
+            ids, complete = likers.get(it["id"], (frozenset(), False))
+            if uid in ids:
+                liked.add(it["id"])
+            elif not complete:
+                unknown.append(it["id"])
+        if unknown:
+            liked |= await asyncio.to_thread(storage.liked_projects, unknown, uid)
+
+    # already ordered by (likesCount, remixCount) desc in storage
+    return DocsJSONResponse([{**it, "likedByUser": it["id"] in liked} for it in items])
+
+
+def _patch_cached_like(project_id: str, uid: str, liked: bool, likes_count: int) -> None:
+    """Apply one like/unlike to the cached feeds in place, so neither this user's
+    liked flag nor the count goes stale, without evicting everyone's cache."""
+    with _feed_cache_lock:
+        for items, likers in list(_feed_cache.values()):
+            if project_id not in likers:
+                continue
+            ids, complete = likers[project_id]
+            likers[project_id] = (ids | {uid} if liked else ids - {uid}, complete)
+            for it in items:
+                if it["id"] == project_id:
+                    it["likesCount"] = likes_count
+                    break
 
 
 @router.post("/like")
-def like_route(data: LikeIn, user=Depends(get_current_user)):
+def like_route(data: LikeIn, user=Depends(limit_user("like", 60))):
     liked = storage.toggle_like(data.project_id, user["sub"])
     # read the authoritative count (single doc read)
     meta = C_META.document(data.project_id).get().to_dict() or {}
     likes_count = int(meta.get("likesCount", 0))
+    _patch_cached_like(data.project_id, user["sub"], liked, likes_count)
     return {"liked": liked, "likesCount": likes_count}
 
 class ViewIn(BaseModel):
     project_id: str
 
-@router.post("/view")
+@router.post("/view", dependencies=[Depends(limit_ip("view", 120))])
 def view_route(data: ViewIn):
     storage.increment_view(data.project_id)
     return {"ok": True}
@@ -7,9 +7,11 @@ from __future__ import annotations
 
 import logging
 from typing import Dict, List, Optional, Any
-from fastapi import APIRouter, HTTPException, Depends, Query, Body
+from fastapi import APIRouter, HTTPException, Depends, Query, Body, Response
 from pydantic import BaseModel
 import asyncio
+import copy
+from cachetools import LRUCache
 
 logger = logging.getLogger(__name__)
 
@@ -51,6 +53,9 @@ class ReorderNodesRequest(BaseModel):
     new_order: List[str]
 
 
+# Responses wrapping trees we loaded/built ourselves are created with
+# model_construct(): the FeatureTree is already validated, and re-validating
+# every node + parameter on the way out is the bulk of these handlers' CPU.
 class TreeResponse(BaseModel):
     success: bool
     tree: Optional[FeatureTree] = None
@@ -78,6 +83,17 @@ class ValidNodeSuggestionsResponse(BaseModel):
     message: Optional[str] = None
 
 
+def _model_response(resp: BaseModel) -> Response:
+    """
+    Serialize a response model straight to JSON. Returning a Response makes
+    FastAPI skip its response_model pass (re-validate + copy of the whole
+    tree); response_model stays on the route for the OpenAPI schema.
+    pydantic-core writes JSON from the models directly, which beats
+    model_dump() + orjson since there is no intermediate dict.
+    """
+    return Response(content=resp.model_dump_json(), media_type="application/json")
+
+
 @router.post("/create", response_model=TreeResponse)
 async def create_feature_tree(
     request: CreateTreeRequest,
@@ -91,7 +107,7 @@ async def create_feature_tree(
             user_id=user_id,
             name=request.name
         )
-        return TreeResponse(success=True, tree=tree)
+        return _model_response(TreeResponse.model_construct(success=True, tree=tree))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -108,7 +124,7 @@ async def get_feature_tree(
         if not tree:
             raise HTTPException(status_code=404, detail=f"Feature tree not found for project {project_id}")
         
-        return TreeResponse(success=True, tree=tree)
+        return _model_response(TreeResponse.model_construct(success=True, tree=tree))
     except HTTPException:
         raise
     except Exception as e:
@@ -156,7 +172,7 @@ async def add_node(
             version=version
         )
         
-        return NodeResponse(success=True, node=node, tree=tree)
+        return _model_response(NodeResponse.model_construct(success=True, node=node, tree=tree))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -178,7 +194,7 @@ async def remove_node(
             version=version
         )
         
-        return TreeResponse(success=True, tree=tree, message=f"Node {node_id} removed")
+        return _model_response(TreeResponse.model_construct(success=True, tree=tree, message=f"Node {node_id} removed"))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -225,12 +241,12 @@ async def update_node(
         
         updated_node = updated_tree.nodes.get(node_id)
         
-        return NodeResponse(
+        return _model_response(NodeResponse.model_construct(
             success=True,
             node=updated_node,
             tree=updated_tree,
             message="Parameters updated successfully - 3D model needs regeneration"
-        )
+        ))
         
     except HTTPException:
         raise
@@ -240,24 +256,45 @@ async def update_node(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# feature type → (design component, key feature, key functionality)
+_FEATURE_TYPE_MAP: Dict[FeatureType, tuple] = {
+    FeatureType.BOX:      ("Rectangular body", "Rectangular profile", "Structural support"),
+    FeatureType.CYLINDER: ("Cylindrical body", "Cylindrical profile", "Rotational movement"),
+    FeatureType.SPHERE:   ("Spherical body", "Spherical profile", "Smooth surface"),
+    FeatureType.EXTRUDE:  ("Extruded feature", "Extended geometry", "Volume creation"),
+}
+_PRIMITIVE_TYPES = frozenset(_FEATURE_TYPE_MAP)
+
+# node types whose output can stand in as `result` in generated code
+_SOLID_TYPES = frozenset({FeatureType.EXTRUDE, FeatureType.REVOLVE, FeatureType.BOX,
+                          FeatureType.CYLINDER, FeatureType.SPHERE})
+
+# (project_id, version, updated_at) → brainstorm dict. save_feature_tree bumps
+# updated_at on every write, so it doubles as the tree's revision.
+_brainstorm_cache: LRUCache = LRUCache(maxsize=256)
+
+
 def _feature_tree_to_brainstorm(tree: FeatureTree) -> Dict[str, Any]:
     """Convert a feature tree back to brainstorm format for LLM regeneration"""
-    
+    key = (tree.project_id, tree.version, tree.updated_at)
+    cached = _brainstorm_cache.get(key)
+    if cached is None:
+        cached = _brainstorm_cache[key] = _build_brainstorm(tree)
+    return copy.deepcopy(cached)   # callers may edit it before prompting
+
+
+def _build_brainstorm(tree: FeatureTree) -> Dict[str, Any]:
     # Extract design parameters from the tree
-    design_components = []
-    key_features = []
-    key_functionalities = []
+    # (dicts as ordered sets: insertion order kept, duplicates free)
+    design_components: Dict[str, None] = {}
+    key_features: Dict[str, None] = {}
+    key_functionalities: Dict[str, None] = {}
     optimal_geometry = {}
     
-    # Get design parameters node if it exists (look for node name containing "design" or "param")
-    design_params_node = None
-    for node_id, node in tree.nodes.items():
-        if ("design_params" in node_id.lower() or 
-            "design_params" in node.name.lower() or 
-            ("design" in node.name.lower() and "param" in node.name.lower())):
-            design_params_node = node
-            logger.info(f"Found design parameters node: {node.name} with {len(node.parameters)} parameters")
-            break
+    # Get design parameters node if it exists (indexed on save)
+    design_params_node = tree.design_params_node()
+    if design_params_node:
+        logger.info(f"Found design parameters node: {design_params_node.name} with {len(design_params_node.parameters)} parameters")
     
     # Extract parameter values for optimal_geometry
     if design_params_node:
@@ -265,44 +302,42 @@ def _feature_tree_to_brainstorm(tree: FeatureTree) -> Dict[str, Any]:
             if param.name in ['outer_diameter', 'hub_diameter', 'mounting_hole_diameter', 'width', 'height', 'length', 'thickness', 'radius']:
                 optimal_geometry[param.name] = f"{param.value} mm"
     
-    # Analyze nodes to infer design components and features
-    for node_id, node in tree.nodes.items():
-        if node.feature_type == FeatureType.BOX:
-            design_components.append("Rectangular body")
-            key_features.append("Rectangular profile")
-            key_functionalities.append("Structural support")
-        elif node.feature_type == FeatureType.CYLINDER:
-            design_components.append("Cylindrical body")  
-            key_features.append("Cylindrical profile")
-            key_functionalities.append("Rotational movement")
-        elif node.feature_type == FeatureType.SPHERE:
-            design_components.append("Spherical body")
-            key_features.append("Spherical profile") 
-            key_functionalities.append("Smooth surface")
-        elif node.feature_type == FeatureType.EXTRUDE:
-            design_components.append("Extruded feature")
-            key_features.append("Extended geometry")
-            key_functionalities.append("Volume creation")
-        elif node.feature_type == FeatureType.SKETCH:
+    # Primitive solids only depend on which types exist: walk the per-type
+    # counts (one entry per distinct type) instead of every node
+    for ft in tree.feature_type_counts:
+        entry = _FEATURE_TYPE_MAP.get(ft)   # str keys hash like the str-enum members
+        if entry:
+            comp, feat, func = entry
+            design_components[comp] = None
+            key_features[feat] = None
+            key_functionalities[func] = None
+    
+    # Sketches and holes are inferred from node names
+    primitive, SKETCH = _PRIMITIVE_TYPES, FeatureType.SKETCH
+    for node in tree.nodes.values():
+        ft = node.feature_type
+        if ft in primitive:
+            continue
+        name = node.name.lower()
+        if ft == SKETCH:
             # Infer sketch type from parameters or name
-            if "circle" in node.name.lower():
-                design_components.append("Circular profile")
-                key_features.append("Circular cross-section")
-            elif "rect" in node.name.lower():
-                design_components.append("Rectangular profile")  
-                key_features.append("Rectangular cross-section")
+            if "circle" in name:
+                design_components["Circular profile"] = None
+                key_features["Circular cross-section"] = None
+            elif "rect" in name:
+                design_components["Rectangular profile"] = None  
+                key_features["Rectangular cross-section"] = None
             else:
-                design_components.append("Profile sketch")
-                key_features.append("Custom profile")
-        elif "hole" in node.name.lower():
-            design_components.append("Mounting hole")
-            key_features.append("Central mounting hole")
-            key_functionalities.append("Attachment point")
+                design_components["Profile sketch"] = None
+                key_features["Custom profile"] = None
+        elif "hole" in name:
+            design_components["Mounting hole"] = None
+            key_features["Central mounting hole"] = None
+            key_functionalities["Attachment point"] = None
     
-    # Remove duplicates while preserving order
-    design_components = list(dict.fromkeys(design_components))
-    key_features = list(dict.fromkeys(key_features))
-    key_functionalities = list(dict.fromkeys(key_functionalities))
+    design_components = list(design_components)
+    key_features = list(key_features)
+    key_functionalities = list(key_functionalities)
     
     # Generate project name and description based on components
     project_name = "Custom Design"
@@ -380,39 +415,38 @@ async def regenerate_cad_model(
             new_code = current_code
             
             # Find design parameters node and apply updates
-            design_params_node = None
-            for node_id, node in tree.nodes.items():
-                if ("design_params" in node_id.lower() or 
-                    "design_params" in node.name.lower() or 
-                    ("design" in node.name.lower() and "param" in node.name.lower())):
-                    design_params_node = node
-                    break
+            design_params_node = tree.design_params_node()
             
             if design_params_node:
                 logger.info(f"Found design parameters node with {len(design_params_node.parameters)} parameters")
                 extractor = CADAMStyleParameterExtractor()
                 
-                # Update each parameter in the code
-                for param in design_params_node.parameters:
-                    if param.original_variable_name:
-                        logger.info(f"Updating {param.original_variable_name} = {param.value}")
-                        new_code = extractor.update_parameter_in_code(
-                            new_code, 
-                            param.original_variable_name, 
-                            param.value
-                        )
+                # Rewrite every parameter assignment in one pass over the code
+                updates = {
+                    param.original_variable_name: param.value
+                    for param in design_params_node.parameters
+                    if param.original_variable_name
+                }
+                logger.info(f"Updating {len(updates)} parameters: {updates}")
+                new_code = extractor.update_parameters_in_code(new_code, updates)
         
         # 3. Get next version and store artifact (EXACT same as chat cad_edit)
         new_cad_ver = storage.next_version(project_id, "cad_code")
-        storage.put_artifact(
+        # Off the event loop, but before the sandbox: a cached geometry makes
+        # _sandbox_flow write cad_file / cadVersion within milliseconds, and
+        # those must never point at a cad_code version that isn't stored.
+        await asyncio.to_thread(
+            storage.put_artifact,
             project_id, user_id, session_id,
             art_type="cad_code", version=new_cad_ver,
             data={"code": new_code}, parent_id=doc.get("id") if doc else None
         )
         logger.info(f"Stored CAD code artifact version {new_cad_ver}")
         
-        # 4. Run STL pipeline in worker thread (EXACT same as chat cad_edit)
-        sandbox_task = asyncio.create_task(asyncio.to_thread(
+        # 4. Run STL pipeline in worker thread (EXACT same as chat cad_edit).
+        # 5. This response isn't streamed, so there's no keepalive to send:
+        #    await the thread directly (exceptions propagate like chat's).
+        await asyncio.to_thread(
             _sandbox_flow,
             project_id,
             session_id,
@@ -421,14 +455,7 @@ async def regenerate_cad_model(
             new_cad_ver,
             "stl",
             False,  # add_message=False (we don't want chat message for feature tree regen)
-        ))
-        
-        # 5. Wait for sandbox task to complete (EXACT same as chat cad_edit)
-        while not sandbox_task.done():
-            await asyncio.sleep(0.1)  # Similar to chat's keepalive pattern
-        
-        # Propagate any exception (like chat does)
-        await sandbox_task
+        )
         
         logger.info(f"Completed _sandbox_flow for version {new_cad_ver}")
         
@@ -475,7 +502,7 @@ async def reorder_nodes(
             version=version
         )
         
-        return TreeResponse(success=True, tree=tree, message="Nodes reordered successfully")
+        return _model_response(TreeResponse.model_construct(success=True, tree=tree, message="Nodes reordered successfully"))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -498,7 +525,7 @@ async def create_new_version(
             raise HTTPException(status_code=404, detail="Base feature tree not found")
         
         new_tree = feature_tree_storage.create_new_version(base_tree, user_id)
-        return TreeResponse(success=True, tree=new_tree)
+        return _model_response(TreeResponse.model_construct(success=True, tree=new_tree))
     except HTTPException:
         raise
     except Exception as e:
@@ -552,22 +579,25 @@ async def generate_code_from_tree(
         code_fragments = []
         code_fragments.append("import cadquery as cq")
         code_fragments.append("")
-        
-        for node_id in tree.regeneration_order:
-            node = tree.nodes[node_id]
-            if node.code_fragment:
-                code_fragments.append(f"# Feature: {node.name} ({node.feature_type})")
-                code_fragments.append(node.code_fragment)
-                code_fragments.append("")
+        has_result = False   # tracked per fragment instead of searching the joined source
+        nodes, order, append = tree.nodes, tree.regeneration_order, code_fragments.append
+        
+        for node_id in order:
+            node = nodes[node_id]
+            fragment = node.code_fragment
+            if fragment:
+                header = f"# Feature: {node.name} ({node.feature_type})"
+                append(header)
+                append(fragment)
+                append("")
+                has_result = has_result or "result = " in fragment or "result = " in header
         
         # Ensure we have a result variable
-        if "result = " not in "\n".join(code_fragments):
+        if not has_result:
             # Find the last solid-creating operation and assign it to result
-            for node_id in reversed(tree.regeneration_order):
-                node = tree.nodes[node_id]
-                if node.feature_type in [FeatureType.EXTRUDE, FeatureType.REVOLVE, FeatureType.BOX, 
-                                       FeatureType.CYLINDER, FeatureType.SPHERE]:
-                    code_fragments.append(f"result = {node_id}")
+            for node_id in reversed(order):
+                if nodes[node_id].feature_type in _SOLID_TYPES:
+                    append(f"result = {node_id}")
                     break
         
         generated_code = "\n".join(code_fragments)
@@ -611,7 +641,7 @@ async def suggest_valid_nodes(
         elif not parent_id:
             message = "General suggestions for adding nodes to the feature tree"
         
-        return ValidNodeSuggestionsResponse(
+        return ValidNodeSuggestionsResponse.model_construct(
             success=True,
             suggestions=suggestions,
             message=message
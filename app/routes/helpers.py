@@ -1,3 +1,27 @@
 # app/routes/helpers.py (new or place in routes/versions.py)
+import datetime as _dt
+
+import orjson
+from fastapi.responses import ORJSONResponse
+
+
 def artifact_id(art_type: str, version: int, project_id: str) -> str:
-    return f"{art_type}_{version}_{project_id}"
\ No newline at end of file
+    return f"{art_type}_{version}_{project_id}"
+
+
+def _json_default(o):
+    # Firestore hands back DatetimeWithNanoseconds (a datetime subclass), which
+    # orjson only serializes natively for the exact datetime type
+    if isinstance(o, (_dt.datetime, _dt.date)):
+        return o.isoformat()
+    return str(o)
+
+
+class DocsJSONResponse(ORJSONResponse):
+    """
+    orjson straight from Firestore dicts. Returning this from a route skips
+    FastAPI's jsonable_encoder/response_model pass, which dominates the cost of
+    large list payloads; datetimes come out as ISO strings just like before.
+    """
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
@@ -1,5 +1,7 @@
 # app/routes/projects.py
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
+from typing import Optional
+import asyncio
 from google.cloud.firestore import Query as FSQuery
 from app.services.auth import get_current_user
 from app.services.storage_gcp import C_META
@@ -12,78 +14,101 @@ router = APIRouter(prefix="/projects", tags=["projects"])
 class VisibilityPatch(BaseModel):
     private: bool
 
+# Routes are async with Firestore calls pushed to threads, so a burst of
+# dashboard polls doesn't queue up behind the shared sync threadpool.
 @router.get("/tick")
-def projects_tick(user=Depends(get_current_user)):
+async def projects_tick(user=Depends(get_current_user)):
     """
     Returns a monotonic-ish number that bumps whenever any of the user's
     projects update. The client can compare this value when a user returns
     to the dashboard and refetch /projects only if it changed.
     """
-    snaps = C_META.where("ownerID", "==", user["sub"]).select(["updatedAt"]).get()
+    # newest doc only (index: ownerID ASC, updatedAt DESC) – 1 read, not N
+    q = (
+        C_META.where("ownerID", "==", user["sub"])
+              .order_by("updatedAt", direction=FSQuery.DESCENDING)
+              .select(["updatedAt"])
+              .limit(1)
+    )
+    snaps = await asyncio.to_thread(q.get)
     latest = 0
     for s in snaps:
-        d = s.to_dict() or {}
-        ts = d.get("updatedAt")
+        ts = (s.to_dict() or {}).get("updatedAt")
         if ts:
             try:
                 # Firestore Timestamp -> epoch seconds (int)
-                latest = max(latest, int(ts.timestamp()))
+                latest = int(ts.timestamp())
             except Exception:
                 pass
     return {"latest": latest}
 
 @router.get("")  # → handles GET /projects
-def list_my_projects(user=Depends(get_current_user)):
-    snaps = C_META.where("ownerID", "==", user["sub"]).get()
-    rows = []
-    for s in snaps:
-        d = s.to_dict()
-        rows.append({
-            "id":        s.id,
+async def list_my_projects(
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    start_after: Optional[str] = Query(None, description="last project id of the previous page"),
+    user=Depends(get_current_user),
+):
+    # newest first, sorted + paged in Firestore (index: ownerID ASC, updatedAt DESC);
+    # no limit → every project, which is what the dashboard asks for today
+    q = (C_META.where("ownerID", "==", user["sub"])
+               .order_by("updatedAt", direction=FSQuery.DESCENDING))
+    if start_after:
+        cursor = await asyncio.to_thread(C_META.document(start_after).get)
+        if cursor.exists:
+            q = q.start_after(cursor)
+    if limit:
+        q = q.limit(limit)
+    snaps = await asyncio.to_thread(q.get)
+    docs = [(s.id, s.to_dict()) for s in snaps]
+
+    # stale previews re-sign + write back; do them side by side, not one by one
+    previews = await asyncio.gather(*(
+        asyncio.to_thread(storage.get_signed_preview, d, pid) for pid, d in docs
+    ))
+
+    out = []
+    for (pid, d), preview in zip(docs, previews):
+        ts = d.get("updatedAt")
+        out.append({
+            "id":        pid,
             "title":     d.get("title", "Untitled"),
-            "preview":   storage.get_signed_preview(d, s.id),
+            "preview":   preview,
             "cadVersion": d.get("cadVersion"),
             "likes":     d.get("likesCount", 0),
             "remix":     d.get("remixCount", 0),
-            "updatedAt": d.get("updatedAt"),  # sort with native Timestamp first
             "private":   bool(d.get("private", False)),
+            "updated":   ts.isoformat() if ts else None,
         })
-    rows.sort(key=lambda r: (r["updatedAt"] or 0), reverse=True)
-    # Final shape for the client:
-    return [
-        { **{k:v for k,v in r.items() if k!="updatedAt"},
-          "updated": (r["updatedAt"].isoformat() if r["updatedAt"] else None) }
-        for r in rows
-    ]
+    return out
 
 from fastapi import Body
 
 @router.patch("/{pid}/title")
-def rename_project(pid: str, payload: dict, user=Depends(get_current_user)):
+async def rename_project(pid: str, payload: dict, user=Depends(get_current_user)):
     title = payload.get("title", "").strip()
     if not title:
         raise Exception(400, "Title required")
     # update Firestore meta doc
-    C_META.document(pid).update({
+    await asyncio.to_thread(C_META.document(pid).update, {
         "title": title,
         "updatedAt": firestore.SERVER_TIMESTAMP
     })
     return {"ok": True, "title": title}
 
 @router.delete("/{pid}")
-def delete_project(pid: str, user=Depends(get_current_user)):
-    snap = C_META.document(pid).get()
+async def delete_project(pid: str, user=Depends(get_current_user)):
+    snap = await asyncio.to_thread(C_META.document(pid).get)
     if not snap.exists:
         raise HTTPException(status_code=404, detail="Project not found")
     if snap.to_dict().get("ownerID") != user["sub"]:
         raise HTTPException(status_code=403, detail="Forbidden")
 
-    storage.delete_project(pid)
+    await asyncio.to_thread(storage.delete_project, pid)
     return {"ok": True}
 
 @router.patch("/{pid}/visibility")
-def set_visibility(pid: str, data: VisibilityPatch, user=Depends(get_current_user)):
-    snap = C_META.document(pid).get()
+async def set_visibility(pid: str, data: VisibilityPatch, user=Depends(get_current_user)):
+    snap = await asyncio.to_thread(C_META.document(pid).get)
     if not snap.exists:
         raise HTTPException(status_code=404, detail="Project not found")
     meta = snap.to_dict() or {}
@@ -91,7 +116,8 @@ def set_visibility(pid: str, data: VisibilityPatch, user=Depends(get_current_use
         raise HTTPException(status_code=403, detail="Forbidden")
 
     # only Pro can enable private projects
-    features = storage.action_usage_snapshot(user["sub"]).get("features", {})
+    usage = await asyncio.to_thread(storage.action_usage_snapshot, user["sub"])
+    features = usage.get("features", {})
     is_allowed = bool(features.get("private_projects"))
     if data.private and not is_allowed:
         # 402 so the client can open an upgrade modal
@@ -101,7 +127,7 @@ def set_visibility(pid: str, data: VisibilityPatch, user=Depends(get_current_use
                     "message": "Upgrade to Pro to make private projects."}
         )
 
-    C_META.document(pid).update({
+    await asyncio.to_thread(C_META.document(pid).update, {
         "private": bool(data.private),
         "updatedAt": firestore.SERVER_TIMESTAMP
     })
@@ -33,25 +33,10 @@ def _latest_stl_ver(pid: str) -> int | None:
 
 
 def _brain_for_cad_ver(pid: str, cad_ver: int | None) -> int | None:
-    if cad_ver is None:
-        return None
     try:
-        bundles = storage.list_artifacts(pid, "version_bundle", latest=False) or []
+        return storage.brain_ver_for_cad(pid, cad_ver)
     except Exception:
         return None
-    best = None
-    for b in bundles:
-        data = b.get("data") or {}
-        try:
-            if int(data.get("cad_file_ver", -1)) == int(cad_ver):
-                if (best is None) or int(b.get("version", 0)) > int(best.get("version", 0)):
-                    best = b
-        except Exception:
-            continue
-    if best:
-        bv = (best.get("data") or {}).get("brainstorm_ver")
-        return int(bv) if bv is not None else None
-    return None
 
 
 @router.post("")
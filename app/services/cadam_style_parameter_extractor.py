@@ -205,30 +205,29 @@ class CADAMStyleParameterExtractor:
     
     def update_parameter_in_code(self, code: str, original_var_name: str, new_value: any) -> str:
         """Update a parameter value in the code (like CADAM's updateParameter)"""
-        lines = code.split('\n')
-        updated_lines = []
-        
-        for line in lines:
-            stripped = line.strip()
-            
-            # Check if this line contains the variable assignment
-            pattern = rf'^(\s*)({re.escape(original_var_name)})\s*=\s*.+'
-            match = re.match(pattern, line)
-            
-            if match:
-                indent = match.group(1)
-                var_name = match.group(2)
-                
-                # Create new assignment line
-                if isinstance(new_value, str) and not new_value.replace('.', '').replace('-', '').isdigit():
-                    # String value - add quotes
-                    new_line = f"{indent}{var_name} = \"{new_value}\""
-                else:
-                    # Numeric or other value
-                    new_line = f"{indent}{var_name} = {new_value}"
-                
-                updated_lines.append(new_line)
-            else:
-                updated_lines.append(line)
-        
-        return '\n'.join(updated_lines)
\ No newline at end of file
+        return self.update_parameters_in_code(code, {original_var_name: new_value})
+    
+    def update_parameters_in_code(self, code: str, updates: Dict[str, any]) -> str:
+        """Apply several {variable: value} updates in a single pass over the code"""
+        if not updates:
+            return code
+        # longest first so a name never shadows a longer one sharing its prefix
+        names = sorted(updates, key=len, reverse=True)
+        pattern = re.compile(
+            r'^([^\S\n]*)(' + '|'.join(re.escape(n) for n in names) + r')[^\S\n]*=[^\S\n]*.+',
+            re.MULTILINE,
+        )
+        
+        def _sub(match: re.Match) -> str:
+            indent, var_name = match.group(1), match.group(2)
+            return f"{indent}{var_name} = {self._format_value(updates[var_name])}"
+        
+        return pattern.sub(_sub, code)
+    
+    @staticmethod
+    def _format_value(new_value: any) -> str:
+        if isinstance(new_value, str) and not new_value.replace('.', '').replace('-', '').isdigit():
+            # String value - add quotes
+            return f"\"{new_value}\""
+        # Numeric or other value
+        return f"{new_value}"
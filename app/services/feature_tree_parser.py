@@ -10,6 +10,7 @@ import ast
 import re
 from typing import Dict, List, Optional, Tuple, Any, Set
 from dataclasses import dataclass
+from datetime import datetime, timezone
 
 from app.models.feature_tree import (
     FeatureTree, FeatureNode, FeatureType, Parameter, ParameterType, FeatureReference
@@ -360,6 +361,7 @@ class FeatureTreeParser:
         chain = chain_info['chain']
         
         parent_id = None
+        now = datetime.now(timezone.utc)  # one timestamp for the whole chain
         
         for i, call in enumerate(chain):
             func_name = call['function']
@@ -375,7 +377,7 @@ class FeatureTreeParser:
                     ))
                 
                 # Add to tree
-                self.current_tree.add_node(node, parent_id)
+                self.current_tree.add_node(node, parent_id, now=now)
                 
                 # Track the variable
                 self.variable_tracker[var_name] = node.id
@@ -8,14 +8,14 @@ from __future__ import annotations
 
 import json
 from typing import Dict, List, Optional, Any
-from datetime import datetime
+from datetime import datetime, timezone
 
 from google.cloud import firestore
 from google.api_core.datetime_helpers import DatetimeWithNanoseconds
 
 from app.models.feature_tree import (
     FeatureTree, FeatureNode, FeatureTreeOperation, FeatureTreeHistory,
-    Parameter, FeatureReference
+    Parameter, FeatureReference, _utcnow
 )
 from app.services.gcp_clients import get_firestore_client
 from app.core.config import settings
@@ -73,7 +73,8 @@ class FeatureTreeStorage:
     
     def save_feature_tree(self, tree: FeatureTree) -> None:
         """Save/update a feature tree"""
-        tree.updated_at = datetime.utcnow()
+        tree.updated_at = _utcnow()
+        tree.refresh_indices()
         doc_id = f"{tree.project_id}_v{tree.version}"
         doc_data = self._serialize_tree(tree)
         
@@ -84,8 +85,8 @@ class FeatureTreeStorage:
         new_tree = FeatureTree(**tree.dict())
         new_tree.id = None  # Generate new ID
         new_tree.version += 1
-        new_tree.created_at = datetime.utcnow()
-        new_tree.updated_at = datetime.utcnow()
+        new_tree.created_at = _utcnow()
+        new_tree.updated_at = _utcnow()
         new_tree.created_by = user_id
         
         self.save_feature_tree(new_tree)
@@ -226,8 +227,9 @@ class FeatureTreeStorage:
                     param.value = new_value
                     break
         
-        node.updated_at = datetime.utcnow()
-        tree.updated_at = datetime.utcnow()
+        now = _utcnow()
+        node.updated_at = now
+        tree.updated_at = now
         
         self.save_feature_tree(tree)
         
@@ -255,7 +257,7 @@ class FeatureTreeStorage:
         tree.regeneration_order = new_order
         tree.dirty = True
         tree.needs_full_regeneration = True
-        tree.updated_at = datetime.utcnow()
+        tree.updated_at = _utcnow()
         
         self.save_feature_tree(tree)
         
@@ -275,7 +277,7 @@ class FeatureTreeStorage:
             return FeatureTreeHistory(
                 tree_id=tree_id,
                 operations=[FeatureTreeOperation(**op) for op in data.get("operations", [])],
-                created_at=data.get("created_at", datetime.utcnow())
+                created_at=data.get("created_at", _utcnow())
             )
         return None
     
@@ -324,14 +326,12 @@ class FeatureTreeStorage:
         try:
             # Convert Firestore timestamps back to datetime
             if isinstance(data.get("created_at"), DatetimeWithNanoseconds):
-                data["created_at"] = datetime.fromtimestamp(data["created_at"].timestamp())
+                data["created_at"] = datetime.fromtimestamp(data["created_at"].timestamp(), tz=timezone.utc)
             if isinstance(data.get("updated_at"), DatetimeWithNanoseconds):
-                data["updated_at"] = datetime.fromtimestamp(data["updated_at"].timestamp())
+                data["updated_at"] = datetime.fromtimestamp(data["updated_at"].timestamp(), tz=timezone.utc)
             
-            # Ensure required fields have defaults
+            # Missing list fields are left to the model's default factories
             data.setdefault("nodes", {})
-            data.setdefault("regeneration_order", [])
-            data.setdefault("global_parameters", [])
             
             # Convert nodes back to FeatureNode objects
             nodes = {}
@@ -344,14 +344,9 @@ class FeatureTreeStorage:
                     
                     # Convert timestamps in nodes
                     if isinstance(node_data.get("created_at"), DatetimeWithNanoseconds):
-                        node_data["created_at"] = datetime.fromtimestamp(node_data["created_at"].timestamp())
+                        node_data["created_at"] = datetime.fromtimestamp(node_data["created_at"].timestamp(), tz=timezone.utc)
                     if isinstance(node_data.get("updated_at"), DatetimeWithNanoseconds):
-                        node_data["updated_at"] = datetime.fromtimestamp(node_data["updated_at"].timestamp())
-                    
-                    # Ensure required fields exist
-                    node_data.setdefault("parameters", [])
-                    node_data.setdefault("parent_references", [])
-                    node_data.setdefault("child_ids", [])
+                        node_data["updated_at"] = datetime.fromtimestamp(node_data["updated_at"].timestamp(), tz=timezone.utc)
                     
                     # Convert parameters and references safely
                     if "parameters" in node_data and isinstance(node_data["parameters"], list):
@@ -389,7 +384,7 @@ class FeatureTreeStorage:
             operations = []
             history_data = {
                 "tree_id": tree_id,
-                "created_at": datetime.utcnow()
+                "created_at": _utcnow()
             }
         
         # Add new operation
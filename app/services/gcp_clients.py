@@ -10,3 +10,12 @@ def get_storage_client() -> gcs.Client:
 @lru_cache(maxsize=1)
 def get_firestore_client() -> firestore.Client:
     return firestore.Client()
+
+
+@lru_cache(maxsize=1)
+def get_publisher_client():
+    # imported lazily: only needed when STEP exports go through Pub/Sub
+    from google.cloud import pubsub_v1
+    return pubsub_v1.PublisherClient(
+        publisher_options=pubsub_v1.types.PublisherOptions(enable_message_ordering=True),
+    )
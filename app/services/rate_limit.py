@@ -0,0 +1,97 @@
+"""
+In-process sliding-window rate limiting for the endpoints that fan out to
+Stripe / Firestore transactions (checkout, like, view).
+
+Windows live in this process only, so the effective limit is per worker
+(N workers → up to N× the configured rate). That's enough to stop a single
+client hammering an endpoint; a shared store would be needed for an exact
+global cap.
+"""
+from __future__ import annotations
+
+import os, threading, time
+from collections import deque
+
+from cachetools import TTLCache
+from fastapi import Depends, HTTPException, Request
+
+from app.services.auth import get_current_user
+
+MAX_TRACKED_KEYS = 50_000
+# proxies in front of us that append to X-Forwarded-For (Cloud Run's LB = 1);
+# 0 = no trusted proxy, use the socket peer
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1"))
+
+
+class SlidingWindowLimiter:
+    """At most `max_calls` hits per key in any `window_s` second window."""
+
+    def __init__(self, max_calls: int, window_s: float = 60.0):
+        self.max_calls = max_calls
+        self.window_s = window_s
+        # idle keys fall out after one window, so memory stays bounded
+        self._hits: TTLCache = TTLCache(maxsize=MAX_TRACKED_KEYS, ttl=window_s)
+        self._lock = threading.Lock()
+
+    def hit(self, key: str) -> float:
+        """Record a hit. Returns 0 if allowed, else seconds until a slot frees."""
+        now = time.monotonic()
+        cutoff = now - self.window_s
+        with self._lock:
+            q = self._hits.get(key)
+            if q is None:
+                q = deque()
+            while q and q[0] <= cutoff:
+                q.popleft()
+            if len(q) >= self.max_calls:
+                self._hits[key] = q
+                return max(q[0] - cutoff, 0.001)
+            q.append(now)
+            self._hits[key] = q   # re-set refreshes the TTL
+            return 0.0
+
+
+def _reject(retry_after: float):
+    raise HTTPException(
+        429, "Too many requests",
+        headers={"Retry-After": str(int(retry_after) + 1)},
+    )
+
+
+def limit_user(scope: str, max_calls: int, window_s: float = 60.0):
+    """Dependency: authenticates like get_current_user, then rate-limits by sub."""
+    limiter = SlidingWindowLimiter(max_calls, window_s)
+
+    async def _dep(user=Depends(get_current_user)):
+        wait = limiter.hit(f"{user['sub']}:{scope}")
+        if wait:
+            _reject(wait)
+        return user
+
+    return _dep
+
+
+def client_ip(request: Request) -> str:
+    """
+    The address our own proxy saw. Leading X-Forwarded-For entries are
+    whatever the client sent, so only the hop appended by the trusted proxy
+    (counting from the right) can key a limit.
+    """
+    fwd = request.headers.get("x-forwarded-for")
+    if fwd and TRUSTED_PROXY_HOPS > 0:
+        hops = [h.strip() for h in fwd.split(",") if h.strip()]
+        if len(hops) >= TRUSTED_PROXY_HOPS:
+            return hops[-TRUSTED_PROXY_HOPS]
+    return request.client.host if request.client else "unknown"
+
+
+def limit_ip(scope: str, max_calls: int, window_s: float = 60.0):
+    """Dependency for anonymous routes: rate-limits by client IP."""
+    limiter = SlidingWindowLimiter(max_calls, window_s)
+
+    async def _dep(request: Request):
+        wait = limiter.hit(f"{client_ip(request)}:{scope}")
+        if wait:
+            _reject(wait)
+
+    return _dep
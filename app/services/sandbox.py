@@ -5,33 +5,188 @@ Runs un-trusted CADQuery code in a forked Python process with
   •  memory limit (POSIX only)
   •  clean temp directory
 
-Returns a STEP file path on success or raises SandboxError on failure.
+Returns the exported geometry (bytes, or a file path via run_cadquery)
+on success or raises SandboxError on failure.
+
+Scripts run in pre-spawned worker processes that import CadQuery/OCP
+while idle, so a run does not pay the import + OCCT set-up cost. Each
+worker runs exactly one script and then exits: user code never shares an
+interpreter with another user's job. Set CADQUERY_POOL_WORKERS=0 to fall
+back to one fresh interpreter per run.
 """
 
 from __future__ import annotations
 
-import os, subprocess, tempfile, textwrap, uuid, shutil, sys, resource
-from pathlib import Path
+import os, subprocess, tempfile, textwrap, uuid, sys, resource
+import hashlib, multiprocessing, queue, runpy, threading, traceback
+from collections import OrderedDict
 TIME_LIMIT = 180          # seconds
 MEM_LIMIT_MB = 2048       # address-space cap (soft+hard)
+POOL_WORKERS = int(os.getenv("CADQUERY_POOL_WORKERS", "2"))
+RESULT_CACHE_SIZE = 64    # (code digest, ext) → geometry bytes, max entries
 
 class SandboxError(RuntimeError):
     """Raised when user CADQuery code fails or times out."""
 
-def _run_child(script_path: str) -> subprocess.CompletedProcess:
-    """Launch a child Python interpreter with optional RLIMIT caps."""
-    def _set_limits() -> None:
+class SandboxBusy(SandboxError):
+    """No run slot freed up in time; the code itself was never run."""
+
+def _set_limits() -> None:
+    try:
+        # RLIMIT_AS not available on macOS; fall back to data segment.
+        limit_name = getattr(resource, "RLIMIT_AS", resource.RLIMIT_DATA)
+        resource.setrlimit(
+            limit_name,
+            (MEM_LIMIT_MB * 2**20, MEM_LIMIT_MB * 2**20),
+        )
+    except (ValueError, OSError, AttributeError):
+        # Platform does not support this limit; continue without it.
+        pass
+
+# ───────── Warm single-use workers ─────────
+# POOL_WORKERS caps concurrent runs; the same number of spares sit warm
+# (CadQuery imported, waiting for a script). A run takes a spare, a
+# replacement starts warming at once, and the used worker is discarded.
+# A run that can't get a slot within RUN_SLOT_TIMEOUT fails as busy rather
+# than holding a request thread through other users' runs.
+WORKER_READY_TIMEOUT = 120  # seconds for a spare to finish importing
+RUN_SLOT_TIMEOUT = float(os.getenv("CADQUERY_SLOT_TIMEOUT_S", "30"))
+_ctx = multiprocessing.get_context("spawn")  # not fork: the API process holds gRPC channels
+_spares: "queue.SimpleQueue[tuple]" = queue.SimpleQueue()
+_run_slots = threading.BoundedSemaphore(max(POOL_WORKERS, 1))
+_pool_lock = threading.Lock()
+_pool_open = False
+
+def _preimport_cadquery() -> None:
+    """Cap memory, then pay the CadQuery/OCP import once."""
+    if os.name == "posix":
+        _set_limits()
+    import cadquery  # noqa: F401
+    import OCP  # noqa: F401
+
+def _exec_script(script_path: str) -> tuple[bool, str]:
+    """Run a generated script inside a warm worker. Returns (ok, error_text)."""
+    try:
+        runpy.run_path(script_path, run_name="__main__")
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            return False, traceback.format_exc()
+    except BaseException:
+        return False, traceback.format_exc()
+    return True, ""
+
+def _worker_main(conn) -> None:
+    """Child: import, report ready, run one script, report, exit."""
+    try:
+        _preimport_cadquery()
+        conn.send("ready")
+        script_path = conn.recv()
+    except BaseException:
+        return
+    conn.send(_exec_script(script_path))
+    conn.close()
+
+def _spawn_spare() -> None:
+    parent, child = _ctx.Pipe()
+    proc = _ctx.Process(target=_worker_main, args=(child,), daemon=True)
+    proc.start()
+    child.close()
+    _spares.put((proc, parent))
+
+def _discard(proc, conn) -> None:
+    try:
+        conn.close()
+    except Exception:
+        pass
+    if proc.is_alive():
+        proc.kill()
+    proc.join(timeout=5)
+
+def _open_pool() -> None:
+    global _pool_open
+    with _pool_lock:
+        if not _pool_open:
+            _pool_open = True
+            for _ in range(POOL_WORKERS):
+                _spawn_spare()
+
+def _take_spare():
+    _open_pool()
+    proc, conn = _spares.get()
+    _spawn_spare()   # keep the spare count constant
+    return proc, conn
+
+def warm_pool() -> None:
+    """Start the spares now so the first request doesn't wait on imports."""
+    if POOL_WORKERS > 0:
+        _open_pool()
+
+def shutdown_pool() -> None:
+    global _pool_open
+    with _pool_lock:
+        _pool_open = False
+        while True:
+            try:
+                proc, conn = _spares.get_nowait()
+            except queue.Empty:
+                break
+            _discard(proc, conn)
+
+def _run_in_pool(script_path: str) -> None:
+    # Waiting for a free slot / a warm worker is not charged to TIME_LIMIT
+    if not _run_slots.acquire(timeout=RUN_SLOT_TIMEOUT):
+        raise SandboxBusy("sandbox busy")
+    try:
+        proc, conn = _take_spare()
         try:
-            # RLIMIT_AS not available on macOS; fall back to data segment.
-            limit_name = getattr(resource, "RLIMIT_AS", resource.RLIMIT_DATA)
-            resource.setrlimit(
-                limit_name,
-                (MEM_LIMIT_MB * 2**20, MEM_LIMIT_MB * 2**20),
-            )
-        except (ValueError, OSError, AttributeError):
-            # Platform does not support this limit; continue without it.
-            pass
+            try:
+                if not conn.poll(WORKER_READY_TIMEOUT) or conn.recv() != "ready":
+                    raise SandboxError("CadQuery worker failed to start")
+                conn.send(script_path)
+                # the clock starts once the script is in the worker's hands
+                if not conn.poll(TIME_LIMIT):
+                    raise SandboxError(f"Execution exceeded {TIME_LIMIT}s")
+                ok, err = conn.recv()
+            except (EOFError, OSError):
+                # OCCT segfault / OOM kill takes the worker down with it
+                raise SandboxError("CadQuery worker crashed (segfault or memory limit)")
+        finally:
+            _discard(proc, conn)   # only this run's worker; others are untouched
+    finally:
+        _run_slots.release()
+    if not ok:
+        raise SandboxError(err or "Unknown error")
+
+# ───────── Result cache ─────────
+# (code digest, ext) → geometry bytes, bounded by total size
+RESULT_CACHE_BYTES = int(os.getenv("CADQUERY_RESULT_CACHE_MB", "128")) * 2**20
+_results: "OrderedDict[tuple[str, str], bytes]" = OrderedDict()
+_results_bytes = 0
+_results_lock = threading.Lock()
+
+def _cache_get(key: tuple[str, str]) -> bytes | None:
+    with _results_lock:
+        data = _results.get(key)
+        if data is not None:
+            _results.move_to_end(key)
+        return data
+
+def _cache_put(key: tuple[str, str], data: bytes) -> None:
+    global _results_bytes
+    if len(data) > RESULT_CACHE_BYTES:
+        return
+    with _results_lock:
+        old = _results.pop(key, None)
+        if old is not None:
+            _results_bytes -= len(old)
+        _results[key] = data
+        _results_bytes += len(data)
+        while len(_results) > RESULT_CACHE_SIZE or _results_bytes > RESULT_CACHE_BYTES:
+            _, evicted = _results.popitem(last=False)
+            _results_bytes -= len(evicted)
 
+def _run_child(script_path: str) -> subprocess.CompletedProcess:
+    """Launch a child Python interpreter with optional RLIMIT caps."""
     return subprocess.run(
         [sys.executable, script_path],
         stdout=subprocess.PIPE,
@@ -41,12 +196,36 @@ def _run_child(script_path: str) -> subprocess.CompletedProcess:
         preexec_fn=_set_limits if os.name == "posix" else None,
     )
 
+def run_cadquery_bytes(code: str, ext: str = "stl") -> tuple[bytes, str]:
+    """
+    Execute CADQuery code and return (geometry_bytes, filename) without
+    staging a copy on disk, so callers can hand the buffer straight to GCS.
+    Raises SandboxError on timeout or failure.
+    """
+    key = (hashlib.sha256(code.encode("utf-8")).hexdigest(), ext.lower())
+    data = _cache_get(key)
+    if data is None:
+        data = _execute(code, ext)
+        _cache_put(key, data)
+    return data, f"{uuid.uuid4()}.{ext}"
+
 def run_cadquery(code: str, ext: str = "stl") -> str:
     """
     Execute CADQuery code and return a file path.
     (`export_ext` = "stl" | "step").
     Raises SandboxError on timeout or failure.
     """
+    data, filename = run_cadquery_bytes(code, ext)
+    # Create temp directory for output files if it doesn't exist
+    temp_dir = os.path.join(os.getcwd(), "temp", "geometry")
+    os.makedirs(temp_dir, exist_ok=True)
+
+    final = os.path.join(temp_dir, filename)
+    with open(final, "wb") as f:
+        f.write(data)
+    return final
+
+def _execute(code: str, ext: str) -> bytes:
     with tempfile.TemporaryDirectory(prefix="cqrun_") as tmp:
         script_path = os.path.join(tmp, "model_script.py")
         geom_path   = os.path.join(tmp, f"model.{ext}")
@@ -126,17 +305,19 @@ def run_cadquery(code: str, ext: str = "stl") -> str:
         with open(script_path, "w", encoding="utf-8") as f:
             f.write(code.rstrip() + "\n\n" + trailer)
 
+        if POOL_WORKERS > 0:
+            _run_in_pool(script_path)
+        else:
+            try:
+                proc = _run_child(script_path)
+            except subprocess.TimeoutExpired:
+                raise SandboxError(f"Execution exceeded {TIME_LIMIT}s")
+
+            if proc.returncode != 0:
+                raise SandboxError(proc.stderr or proc.stdout or "Unknown error")
+
         try:
-            proc = _run_child(script_path)
-        except subprocess.TimeoutExpired:
-            raise SandboxError(f"Execution exceeded {TIME_LIMIT}s")
-
-        if proc.returncode != 0:
-            raise SandboxError(proc.stderr or proc.stdout or "Unknown error")
-        # Create temp directory for output files if it doesn't exist
-        temp_dir = os.path.join(os.getcwd(), "temp", "geometry")
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        final = os.path.join(temp_dir, f"{uuid.uuid4()}.{ext}")
-        shutil.copy(geom_path, final)
-        return final
\ No newline at end of file
+            with open(geom_path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise SandboxError("Script finished without exporting any geometry")
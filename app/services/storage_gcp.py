@@ -27,13 +27,15 @@ import datetime as _dt
 import json, uuid, bcrypt, tempfile
 from pathlib import Path
 from typing import Any, Dict, Optional, List
-import gzip, shutil
+import gzip, shutil, threading
+from io import BytesIO
 
 import jwt  # PyJWT
 
 from google.cloud import firestore  # type: ignore
 from google.cloud import storage as gcs  # type: ignore
 from google.api_core.datetime_helpers import DatetimeWithNanoseconds  # type: ignore
+from google.api_core.exceptions import AlreadyExists, NotFound
 from app.services.auth import _sign
 from app.services.gcp_clients import get_storage_client, get_firestore_client
 import os
@@ -43,6 +45,8 @@ from app.core.config import settings
 import math
 from google.cloud.firestore_v1 import FieldFilter
 from zoneinfo import ZoneInfo
+from cachetools import LRUCache, TTLCache
+from functools import lru_cache
 
 
 LOCAL_TZ = ZoneInfo("America/Chicago")
@@ -222,12 +226,29 @@ def _need_refresh(meta: dict) -> bool:
     # `exp` is epoch seconds (int)
     return (int(_dt.datetime.utcnow().timestamp()) + _REFRESH_IF_LEEWAY) >= int(exp)
 
+# Signing is an RSA/HMAC op (or an IAM signBlob round-trip on the fallback
+# signer), so share one URL per blob across requests for _SIGN_BUCKET_S.
+# Every URL handed out still has >= _SIGN_TTL - _SIGN_BUCKET_S left.
+_SIGN_BUCKET_S = 900
+_signed_cache: TTLCache = TTLCache(maxsize=10_000, ttl=_SIGN_BUCKET_S)
+_signed_cache_lock = threading.Lock()
+
+def _sign_cached(path: str) -> tuple[str, int]:
+    now = int(_dt.datetime.utcnow().timestamp())
+    key = (path, now // _SIGN_BUCKET_S)
+    with _signed_cache_lock:
+        hit = _signed_cache.get(key)
+    if hit is not None:
+        return hit
+    url = _signed_url_v4(_bucket.blob(path), _SIGN_TTL, "GET")
+    hit = (url, now + _SIGN_TTL)
+    with _signed_cache_lock:
+        _signed_cache[key] = hit
+    return hit
+
 def _sign_thumbnail(project_id: str, path: str) -> tuple[str, int]:
     """Return (url, expires_epoch).  *No* network calls."""
-    blob = _bucket.blob(path)
-    url  = _signed_url_v4(blob, _SIGN_TTL, "GET")
-    expires = int(_dt.datetime.utcnow().timestamp()) + _SIGN_TTL
-    return url, expires
+    return _sign_cached(path)
 
 def _fs_safe(value):
     """Recursively convert value to Firestore-acceptable types."""
@@ -237,8 +258,10 @@ def _fs_safe(value):
             return None
         return value
 
-    # ✅ Preserve Firestore server timestamp sentinel
-    if value is firestore.SERVER_TIMESTAMP:
+    # ✅ Preserve Firestore sentinels / transforms (server timestamp, delete, increment)
+    if value is firestore.SERVER_TIMESTAMP or value is firestore.DELETE_FIELD:
+        return value
+    if isinstance(value, firestore.Increment):
         return value
 
     # ✅ Preserve datetime / Firestore timestamp types
@@ -288,6 +311,8 @@ C_OPER     = _fs.collection("operations")
 C_ART      = _fs.collection("artifacts")
 C_CHAT     = _fs.collection("chat_history")
 C_META     = _fs.collection("projects_meta")
+C_WEBHOOK  = _fs.collection("webhook_events")   # Stripe event ids already handled
+C_STRIPE_IDX = _fs.collection("stripe_customer_index")   # customer id → {userID}
 
 # ───────────────────────── Helpers ─────────────────────────
 def LIKED_USERS(pid: str):
@@ -340,6 +365,7 @@ def save_avatar(user_id: str, file_bytes: bytes, content_type: str) -> str:
     return url
 
 # --- Deterministic geometry paths (STL unchanged, STEP gains suffix) ---
+@lru_cache(maxsize=8192)
 def geometry_blob_path(project_id: str, version: int, ext: str = "stl") -> str:
     return f"cad-files/{project_id}/geometry/{int(version)}.{ext}"
 
@@ -347,10 +373,44 @@ def geometry_blob_path_step(project_id: str, version: int) -> str:
     """STEP lives at {ver}_step.step so STL and STEP never collide or confuse."""
     return f"cad-files/{project_id}/geometry/{int(version)}_step.step"
 
+# An STL slot only ever flips missing → present, so "present" is cached for
+# good; "missing" is re-checked after a short TTL (the UI polls while building).
+_stl_present: LRUCache = LRUCache(maxsize=16384)
+_stl_missing: TTLCache = TTLCache(maxsize=4096, ttl=10)
+_stl_lock = threading.Lock()
+
+def _mark_stl_present(project_id: str, version: int) -> None:
+    key = (project_id, int(version))
+    with _stl_lock:
+        _stl_present[key] = True
+        _stl_missing.pop(key, None)
+
+def _forget_stl_slots(project_id: str) -> None:
+    with _stl_lock:
+        for cache in (_stl_present, _stl_missing):
+            for key in [k for k in cache if k[0] == project_id]:
+                cache.pop(key, None)
+
 def stl_exists(project_id: str, version: int) -> bool:
-    return _bucket.blob(geometry_blob_path(project_id, version, "stl")).exists()
+    key = (project_id, int(version))
+    with _stl_lock:
+        if key in _stl_present:
+            return True
+        if key in _stl_missing:
+            return False
+    exists = _bucket.blob(geometry_blob_path(project_id, version, "stl")).exists()
+    with _stl_lock:
+        if exists:
+            _stl_present[key] = True
+        else:
+            _stl_missing[key] = True
+    return exists
 
 
+# meta.recentLikers embeds up to this many liker ids so the feed can answer
+# "liked by me?" without a read; past the cap it falls back to liked_users
+RECENT_LIKERS_CAP = 1000
+
 @firestore.transactional
 def _txn_toggle_like(txn, project_id: str, user_id: str) -> bool:
     liker_ref = C_META.document(project_id).collection("liked_users").document(user_id)
@@ -358,13 +418,65 @@ def _txn_toggle_like(txn, project_id: str, user_id: str) -> bool:
 
     if liker_ref.get(transaction=txn).exists:
         txn.delete(liker_ref)
-        txn.update(meta_ref, {"likesCount": firestore.Increment(-1)})
+        txn.update(meta_ref, {
+            "likesCount": firestore.Increment(-1),
+            "recentLikers": firestore.ArrayRemove([user_id]),
+        })
         return False
     else:
+        meta = meta_ref.get(["recentLikers"], transaction=txn).to_dict() or {}
+        upd = {"likesCount": firestore.Increment(+1)}
+        if len(meta.get("recentLikers") or ()) < RECENT_LIKERS_CAP:
+            upd["recentLikers"] = firestore.ArrayUnion([user_id])
         txn.set(liker_ref, {})
-        txn.update(meta_ref, {"likesCount": firestore.Increment(+1)})
+        txn.update(meta_ref, upd)
         return True
-    
+
+# ───────── Token usage (identity/{doc}/tokenUsage/{day_iso | month_key}) ─────────
+# One small doc per day / month instead of an ever-growing map on the identity
+# doc. Older identities may still carry the legacy `tokenUsage` map; it is read
+# as a fallback and dropped on their next metered write.
+def _usage_refs(identity_ref, day_iso: str, mkey: str):
+    col = identity_ref.collection("tokenUsage")
+    return col.document(day_iso), col.document(mkey)
+
+def _tokens_from(snap, legacy: dict | None, key: str) -> int:
+    if snap is not None and snap.exists:
+        entry = snap.to_dict() or {}
+    else:
+        entry = (legacy or {}).get(key) or {}
+    return int(entry.get("tokens", 0))
+
+def read_usage_tokens(identity_ref, day_iso: str, mkey: str,
+                      legacy: dict | None = None, transaction=None) -> tuple[int, int]:
+    """(day_tokens, month_tokens) for one identity, in a single batch get."""
+    refs = _usage_refs(identity_ref, day_iso, mkey)
+    got = {s.id: s for s in _fs.get_all(refs, transaction=transaction)}
+    return _tokens_from(got.get(day_iso), legacy, day_iso), _tokens_from(got.get(mkey), legacy, mkey)
+
+def read_identity_with_usage(identity_ref, day_iso: str, mkey: str,
+                             fields: list | None = None):
+    """
+    Identity doc plus (day, month) tokens in one BatchGetDocuments round trip,
+    for callers that already hold the identity ref. Returns (None, 0, 0) if
+    the identity doc no longer exists.
+    """
+    day_ref, mon_ref = _usage_refs(identity_ref, day_iso, mkey)
+    if fields is not None:
+        fields = list(dict.fromkeys([*fields, "tokens"]))
+    got = {s.reference.path: s for s in _fs.get_all([identity_ref, day_ref, mon_ref], field_paths=fields)}
+
+    ident = got.get(identity_ref.path)
+    if ident is None or not ident.exists:
+        return None, 0, 0
+    doc = ident.to_dict() or {}
+    legacy = doc.get("tokenUsage")
+    return (
+        doc,
+        _tokens_from(got.get(day_ref.path), legacy, day_iso),
+        _tokens_from(got.get(mon_ref.path), legacy, mkey),
+    )
+
 @firestore.transactional
 def _txn_apply_token_usage(txn, user_id: str, raw_tokens_delta: int):
     # 1) fetch identity doc
@@ -379,25 +491,22 @@ def _txn_apply_token_usage(txn, user_id: str, raw_tokens_delta: int):
     day_iso = _today_local_iso()
     mkey    = _month_key_from_day(day_iso)
 
-    tu = dict(doc.get("tokenUsage") or {})
-    day_entry = dict(tu.get(day_iso) or {})
-    mon_entry = dict(tu.get(mkey)    or {})
-
-    prev_day_tokens = int(day_entry.get("tokens", 0))
-    prev_mon_tokens = int(mon_entry.get("tokens", 0))
+    # all reads must happen before the first transactional write
+    legacy_tu = doc.get("tokenUsage")
+    prev_day_tokens, prev_mon_tokens = read_usage_tokens(
+        ref, day_iso, mkey, legacy=legacy_tu, transaction=txn
+    )
 
     # apply RAW tokens
     add_tokens = int(raw_tokens_delta)
-    day_entry["tokens"] = int(prev_day_tokens + add_tokens)
-    mon_entry["tokens"] = int(prev_mon_tokens + add_tokens)
-    tu[day_iso] = day_entry
-    tu[mkey]    = mon_entry
+    new_day_tokens = int(prev_day_tokens + add_tokens)
+    new_mon_tokens = int(prev_mon_tokens + add_tokens)
 
     # credits totals (before/after) — PROFIT_FACTOR applied HERE (inside helper)
     prev_day_cr = _credits_from_tokens(prev_day_tokens)
     prev_mon_cr = _credits_from_tokens(prev_mon_tokens)
-    new_day_cr  = _credits_from_tokens(day_entry["tokens"])
-    new_mon_cr  = _credits_from_tokens(mon_entry["tokens"])
+    new_day_cr  = _credits_from_tokens(new_day_tokens)
+    new_mon_cr  = _credits_from_tokens(new_mon_tokens)
 
     # 3) plan caps
     plan = (doc.get("plan") or "free").lower()
@@ -467,14 +576,20 @@ def _txn_apply_token_usage(txn, user_id: str, raw_tokens_delta: int):
     monthly_remaining_after = max(0, monthly_cap - new_mon_cr)
 
     # 6) maybe debit bank
+    day_ref, mon_ref = _usage_refs(ref, day_iso, mkey)
+    txn.set(day_ref, {"tokens": new_day_tokens}, merge=True)
+    txn.set(mon_ref, {"tokens": new_mon_tokens}, merge=True)
+
     updates = {
-        "tokenUsage":        tu,
         "creditsLeft":       credits_left_after,
         "monthlyUsed":       new_mon_cr,
         "monthlyRemaining":  monthly_remaining_after,
         "lastUsageAt":       _server_ts(),
         "usageTick":         firestore.Increment(1),
     }
+    if legacy_tu is not None:
+        # current day/month now live in the subcollection
+        updates["tokenUsage"] = firestore.DELETE_FIELD
 
     bm = (doc.get("bankMode") or {})
     bm_enabled = bool(bm.get("enabled"))
@@ -594,21 +709,64 @@ def toggle_like(project_id: str, user_id: str) -> bool:
             pass
     return liked
 
+# ---- View counter ------------------------------------------------------------
+# Views are buffered in memory and folded into one Increment(delta) per project
+# every VIEW_FLUSH_INTERVAL_S (see main.py), instead of one write per page view.
+VIEW_FLUSH_INTERVAL_S = 30
+_pending_views: Dict[str, int] = {}
+_pending_views_lock = threading.Lock()
+
 def increment_view(project_id: str):
-    C_META.document(project_id).update({"viewCount": firestore.Increment(1)})
+    with _pending_views_lock:
+        _pending_views[project_id] = _pending_views.get(project_id, 0) + 1
+
+def flush_views() -> int:
+    """Write buffered view counts to projects_meta. Returns projects flushed."""
+    global _pending_views
+    with _pending_views_lock:
+        pending, _pending_views = _pending_views, {}
+    flushed = 0
+    for pid, delta in pending.items():
+        try:
+            C_META.document(pid).update({"viewCount": firestore.Increment(delta)})
+            flushed += 1
+        except NotFound:
+            pass   # project deleted since the view; drop it
+        except Exception as e:
+            print(f"[views] flush failed for {pid}: {e}")
+            with _pending_views_lock:   # keep it for the next round
+                _pending_views[pid] = _pending_views.get(pid, 0) + delta
+    return flushed
+
+FEED_ORDER = ("likesCount", "remixCount")   # most engaged first
 
-def get_community_feed(limit: int = 30, sign_previews: bool = False):
+def get_community_feed(limit: int = 30, sign_previews: bool = False,
+                       order_by: tuple[str, ...] | None = FEED_ORDER):
     """
-    Return up to `limit` *original* projects (skip remixes).
-    Firestore doesn’t let us do “!= remix” + `order_by(updatedAt)` cleanly,
-    so we over-fetch then filter in Python.
+    Return up to `limit` *original* projects (skip remixes), ordered by
+    `order_by` fields descending. Sorting + limit run in Firestore (composite
+    index on projects_meta); docs missing an `order_by` field are not matched,
+    see backfill_feed_counters.py. Firestore doesn’t let us filter “!= remix”
+    alongside that ordering, so we over-fetch then filter in Python.
     """
-    candidates = (
-        C_META.where(filter=FieldFilter("cadVersion", ">", 0))
-              .order_by("cadVersion")
-              .limit(limit * 3)
-              .get()
-    )
+    q = C_META.where(filter=FieldFilter("cadVersion", ">", 0))
+    for field in order_by or ():
+        q = q.order_by(field, direction=firestore.Query.DESCENDING)
+    if not order_by:
+        q = q.order_by("cadVersion")
+    try:
+        candidates = q.limit(limit * 3).get()
+        presorted = True
+    except Exception as e:
+        # index still building → old query, sort in memory below
+        print(f"[Warning] Feed index unavailable, sorting in memory: {e}")
+        candidates = (
+            C_META.where(filter=FieldFilter("cadVersion", ">", 0))
+                  .order_by("cadVersion")
+                  .limit(limit * 3)
+                  .get()
+        )
+        presorted = not order_by
 
     items: list[dict] = []
     for s in candidates:
@@ -635,16 +793,29 @@ def get_community_feed(limit: int = 30, sign_previews: bool = False):
 
         if d.get("cadVersion"):
             items.append(d)
-            if len(items) == limit:         # stop once we hit the quota
+            if presorted and len(items) == limit:   # stop once we hit the quota
                 break
+
+    if not presorted:
+        items.sort(key=lambda d: tuple(int(d.get(f, 0)) for f in order_by), reverse=True)
+        items = items[:limit]
     return items
 
 def has_liked(project_id: str, user_id: str) -> bool:
-    doc = C_META.document(project_id) \
-            .collection("liked_users") \
-            .document(user_id) \
-            .get()
-    return doc.exists
+    return project_id in liked_projects([project_id], user_id)
+
+def liked_projects(project_ids: list[str], user_id: str) -> set[str]:
+    """
+    Subset of `project_ids` the user has liked. Likes live at
+    projects_meta/{pid}/liked_users/{uid}, so every candidate is a known doc
+    path: one get_all (a single BatchGetDocuments RPC) covers the whole page.
+    """
+    if not user_id:
+        return set()
+    refs = [LIKED_USERS(pid).document(user_id) for pid in dict.fromkeys(project_ids) if pid]
+    if not refs:
+        return set()
+    return {s.reference.parent.parent.id for s in _fs.get_all(refs) if s.exists}
 
 def copy_blob(src_path: str, dst_path: str) -> str:
     """Server-side copy within the same bucket; returns dst_path."""
@@ -671,7 +842,6 @@ def signup(email: str, password: str) -> str:
         "password": _hash_pw(password),
         "createdAt": _server_ts(),
         "projects": [],
-        "tokenUsage": {},
         # NEW defaults
         "username": email.split("@")[0][:10],
         "photoUrl": None,
@@ -744,6 +914,9 @@ def upsert_project_meta(
         "ownerID": owner_id,
         "title": title or "Untitled project",
         "updatedAt": _server_ts(),
+        # +0 creates the feed counters on first write and leaves them alone after
+        "likesCount": firestore.Increment(0),
+        "remixCount": firestore.Increment(0),
     }
     if preview_url:                      # add/replace *only* when non-null
         doc["preview"] = preview_url
@@ -774,7 +947,7 @@ def put_artifact(
         "userID": user_id,
         "sessionID": session_id,
         "type": art_type,
-        "version": int(version),
+        "version": int(version),          # always int: readers compare/sort it as-is
         "parentID": parent_id,
         "createdAt": _server_ts(),
         "blobUrl": blob_url,
@@ -793,26 +966,31 @@ def get_artifact(project_id: str, art_id: str) -> Optional[Dict[str, Any]]:
     doc["id"] = art_id
     return doc
 
-def list_artifacts(project_id: str, art_type: str | None = None, latest: bool = False):
+def list_artifacts(
+    project_id: str,
+    art_type: str | None = None,
+    latest: bool = False,
+    fields: list[str] | None = None,
+    limit: int | None = None,
+):
     """
-    List artifacts with fallback when composite index is building.
+    List artifacts (newest version first) with fallback when composite index is building.
     Uses simple queries that don't require composite indexes.
+    `fields` (e.g. ["version", "data.summary"]) projects the read server-side;
+    the fallback path ignores it and returns whole documents.
+    `limit` caps how many of the newest versions are returned.
     """
     try:
         # Try the original complex query first
+        q = C_ART.where(filter=FieldFilter("projectID", "==", project_id))
         if art_type:
-            snaps = (
-                C_ART.where(filter=FieldFilter("projectID", "==", project_id))
-                     .where(filter=FieldFilter("type", "==", art_type))
-                     .order_by("version", direction=firestore.Query.DESCENDING)
-                     .get()
-            )
-        else:
-            snaps = (
-                C_ART.where(filter=FieldFilter("projectID", "==", project_id))
-                     .order_by("version", direction=firestore.Query.DESCENDING)
-                     .get()
-            )
+            q = q.where(filter=FieldFilter("type", "==", art_type))
+        q = q.order_by("version", direction=firestore.Query.DESCENDING)
+        if fields:
+            q = q.select(fields)
+        if limit:
+            q = q.limit(limit)
+        snaps = q.get()
         
         items = [s.to_dict() for s in snaps if s.exists]
         if latest and items:
@@ -842,7 +1020,7 @@ def list_artifacts(project_id: str, art_type: str | None = None, latest: bool =
             
             if latest and items:
                 return items[0]
-            return items
+            return items[:limit] if limit else items
             
         except Exception as e2:
             print(f"[Error] Even fallback query failed for {art_type} in {project_id}: {e2}")
@@ -850,6 +1028,86 @@ def list_artifacts(project_id: str, art_type: str | None = None, latest: bool =
                 return None
             return []
 
+def list_artifacts_bulk(
+    project_ids: list[str],
+    art_type: str,
+    fields: list[str] | None = None,
+) -> dict[str, list[dict]]:
+    """
+    Artifacts of one type for many projects → {project_id: [docs, newest first]}.
+    One `in` query per 10 projects instead of one query per project.
+    `fields` projects the read server-side (projectID/version are always kept).
+    """
+    out: dict[str, list[dict]] = {pid: [] for pid in project_ids if pid}
+    ordered = list(out)
+    if fields:
+        fields = list(dict.fromkeys(["projectID", "version", *fields]))
+
+    chunk_size = 10
+    for i in range(0, len(ordered), chunk_size):
+        chunk = ordered[i:i + chunk_size]
+        q = (C_ART.where(filter=FieldFilter("projectID", "in", chunk))
+                  .where(filter=FieldFilter("type", "==", art_type)))
+        if fields:
+            q = q.select(fields)
+        for s in q.stream():
+            d = s.to_dict() or {}
+            bucket = out.get(d.get("projectID"))
+            if bucket is not None:
+                bucket.append(d)
+
+    for docs in out.values():
+        docs.sort(key=lambda x: int(x.get("version", 0)), reverse=True)
+    return out
+
+def brain_ver_for_cad(project_id: str, cad_ver: int | None) -> int | None:
+    """
+    brainstorm_ver of the newest version_bundle that captured `cad_ver`,
+    as one indexed TopN query (limit 1) instead of a client-side scan.
+    """
+    if cad_ver is None:
+        return None
+    try:
+        snaps = (
+            C_ART.where(filter=FieldFilter("projectID", "==", project_id))
+                 .where(filter=FieldFilter("type", "==", "version_bundle"))
+                 .where(filter=FieldFilter("data.cad_file_ver", "==", int(cad_ver)))
+                 .order_by("version", direction=firestore.Query.DESCENDING)
+                 .select(["data.brainstorm_ver"])
+                 .limit(1)
+                 .get()
+        )
+    except Exception as e:
+        # index still building → scan the bundles (already newest first)
+        print(f"[Warning] bundle index unavailable for {project_id}: {e}")
+        snaps = None
+    if snaps is not None:
+        bv = ((snaps[0].to_dict() or {}).get("data") or {}).get("brainstorm_ver") if snaps else None
+        return int(bv) if bv is not None else None
+
+    for b in list_artifacts(project_id, "version_bundle", latest=False) or []:
+        data = b.get("data") or {}
+        if data.get("cad_file_ver") == int(cad_ver):
+            bv = data.get("brainstorm_ver")
+            return int(bv) if bv is not None else None
+    return None
+
+def watch_artifacts(project_id: str, art_type: str, on_change):
+    """
+    Open a Firestore snapshot listener on a project's artifacts of one type.
+    `on_change(docs)` runs on the listener's thread with every current doc
+    (once immediately, then after each change). Call `.unsubscribe()` on the
+    returned watch when done.
+    """
+    def _cb(snaps, _changes, _read_time):
+        on_change([s.to_dict() for s in snaps if s.exists])
+
+    return (
+        C_ART.where(filter=FieldFilter("projectID", "==", project_id))
+             .where(filter=FieldFilter("type", "==", art_type))
+             .on_snapshot(_cb)
+    )
+
 def next_version(project_id: str, art_type: str) -> int:
     """Get next version number with fallback when index is building."""
     try:
@@ -950,6 +1208,8 @@ def log_operation(
     except Exception:
         # never fail the caller because of metering
         pass
+    finally:
+        forget_ai_allowed(user_id)
 
 
 def add_chat_message(
@@ -984,7 +1244,7 @@ def add_chat_message(
 
 # ───────────────────────── Cloud Storage ─────────────────────────
 def upload_blob(local_path: str, project_id: str, subdir: str, ttl_sec: int = 3600) -> str:
-    file_name = Path(local_path).name
+    file_name = os.path.basename(local_path)
     blob_path = f"cad-files/{project_id}/{subdir}/{file_name}"
     blob = _bucket.blob(blob_path)
 
@@ -1020,20 +1280,36 @@ def upload_geometry(local_path: str, project_id: str, version: int,
     """
     blob_path = geometry_blob_path(project_id, version, ext)
     blob = _bucket.blob(blob_path)
+    blob.upload_from_filename(local_path, content_type=_geometry_content_type(ext))
+    if ext.lower() == "stl":
+        _mark_stl_present(project_id, version)
 
-    # content type
-    ext_l = ext.lower()
-    if ext_l == "stl":
-        ctype = "model/stl"
-    elif ext_l in ("step", "stp"):
-        ctype = "application/step"
-    else:
-        ctype = "application/octet-stream"
-    blob.upload_from_filename(local_path, content_type=ctype)
+    url = _signed_url_v4(blob, ttl_sec, "GET")
+    return url, blob_path
+
+def upload_geometry_bytes(data: bytes, project_id: str, version: int,
+                          ext: str = "stl", ttl_sec: int = 86_400) -> tuple[str, str]:
+    """
+    Same as upload_geometry, but straight from the sandbox's in-memory
+    buffer — no local file to re-open. Returns (signed_url, blob_path).
+    """
+    blob_path = geometry_blob_path(project_id, version, ext)
+    blob = _bucket.blob(blob_path)
+    blob.upload_from_file(BytesIO(data), size=len(data), content_type=_geometry_content_type(ext))
+    if ext.lower() == "stl":
+        _mark_stl_present(project_id, version)
 
     url = _signed_url_v4(blob, ttl_sec, "GET")
     return url, blob_path
 
+def _geometry_content_type(ext: str) -> str:
+    ext_l = ext.lower()
+    if ext_l == "stl":
+        return "model/stl"
+    if ext_l in ("step", "stp"):
+        return "application/step"
+    return "application/octet-stream"
+
 def upload_step_gz(local_path: str, project_id: str, version: int,
                    ttl_sec: int = 86_400) -> tuple[str, str]:
     """
@@ -1053,6 +1329,19 @@ def upload_step_gz(local_path: str, project_id: str, version: int,
     url = _signed_url_v4(blob, ttl_sec, "GET")
     return url, blob_path
 
+def upload_step_gz_bytes(data: bytes, project_id: str, version: int,
+                         ttl_sec: int = 86_400) -> tuple[str, str]:
+    """In-memory variant of upload_step_gz (no .gz temp file)."""
+    gz = gzip.compress(data, compresslevel=6)
+
+    blob_path = geometry_blob_path_step(project_id, version)  # ← <ver>_step.step
+    blob = _bucket.blob(blob_path)
+    blob.content_encoding = "gzip"
+    blob.upload_from_file(BytesIO(gz), size=len(gz), content_type="application/step")
+
+    url = _signed_url_v4(blob, ttl_sec, "GET")
+    return url, blob_path
+
 
 def sign_path(blob_path: str, ttl_sec: int = 86_400) -> str:
     """Mint a fresh V4 signed URL for an existing object path."""
@@ -1121,10 +1410,11 @@ def get_signed_preview(meta: dict, project_id: str) -> str | None:
 
         # (re)-sign locally, no network
         url, exp = _sign_thumbnail(project_id, meta_path)
-        C_META.document(project_id).update({
-            "previewSigned": url,
-            "previewExp":    exp,
-        })
+        if url != meta.get("previewSigned"):   # cached URL may already be stored
+            C_META.document(project_id).update({
+                "previewSigned": url,
+                "previewExp":    exp,
+            })
         return url
 
     # 2) Legacy doc – try to discover the file once (any supported ext)
@@ -1186,6 +1476,154 @@ def delete_project(project_id: str):
     prefix = f"cad-files/{project_id}/"
     for blob in _bucket.list_blobs(prefix=prefix):
         blob.delete()
+    _forget_stl_slots(project_id)
+
+# ───────── Stripe webhook idempotency ─────────
+WEBHOOK_EVENT_TTL_DAYS = 30   # expireAt drives the Firestore TTL policy
+WEBHOOK_CLAIM_LEASE_S  = 300  # a claim still held after this is presumed dead
+WEBHOOK_MAX_ATTEMPTS   = 8    # then the event is parked as "dead" for a human
+WEBHOOK_RETRY_MAX_S    = 3600
+
+# Every claimed event is also a queue entry: `leaseUntil` is set while it is
+# unfinished (pending / failed) and deleted once it is done, so the drain job
+# finds due work with a single-field range query.
+
+def _lease(seconds: float) -> _dt.datetime:
+    return _dt.datetime.now(_dt.timezone.utc) + _dt.timedelta(seconds=seconds)
+
+def _webhook_claim(event_type: str, payload: str | None) -> dict:
+    return {
+        "type": event_type,
+        "status": "pending",
+        "payload": payload,
+        "attempts": 1,
+        "ts": _server_ts(),
+        "leaseUntil": _lease(WEBHOOK_CLAIM_LEASE_S),
+        "expireAt": _lease(WEBHOOK_EVENT_TTL_DAYS * 86400),
+    }
+
+@firestore.transactional
+def _txn_take_over_webhook_event(txn, ref, claim: dict | None) -> dict | None:
+    """Data of the taken-over event, or None if it is finished or still leased."""
+    snap = ref.get(transaction=txn)
+    if not snap.exists:
+        if claim is None:
+            return None
+        txn.create(ref, claim)   # released between our create() and now
+        return claim
+    d = snap.to_dict() or {}
+    lease = d.get("leaseUntil")
+    if d.get("status") not in ("pending", "failed") or lease is None \
+            or lease > _dt.datetime.now(_dt.timezone.utc):
+        return None
+    txn.update(ref, {
+        "status": "pending",
+        "leaseUntil": _lease(WEBHOOK_CLAIM_LEASE_S),
+        "attempts": firestore.Increment(1),
+    })
+    return d
+
+def claim_webhook_event(event_id: str, event_type: str, payload: str | None = None) -> bool:
+    """
+    Record a Stripe event id and its raw payload; False if it was already
+    recorded (a redelivery). create() fails if the doc exists, so concurrent
+    deliveries can't both win. A claim whose lease ran out (the handler's
+    process died, or it failed and is due a retry) is taken over instead.
+    """
+    ref = C_WEBHOOK.document(event_id)
+    claim = _webhook_claim(event_type, payload)
+    try:
+        ref.create(claim)
+        return True
+    except AlreadyExists:
+        return _txn_take_over_webhook_event(firestore.Transaction(_fs), ref, claim) is not None
+
+def take_over_webhook_event(event_id: str) -> dict | None:
+    """Lease a due event for the drain job; its stored data, or None."""
+    return _txn_take_over_webhook_event(firestore.Transaction(_fs), C_WEBHOOK.document(event_id), None)
+
+def due_webhook_events(limit: int = 20) -> list[str]:
+    """Ids of unfinished events whose lease has run out."""
+    now = _dt.datetime.now(_dt.timezone.utc)
+    snaps = (C_WEBHOOK.where(filter=FieldFilter("leaseUntil", "<=", now))
+                      .select(["leaseUntil"]).limit(limit).get())
+    return [s.id for s in snaps]
+
+def finish_webhook_event(event_id: str, status: str) -> None:
+    """Mark a claimed event done / skipped:<reason>; drops it from the queue."""
+    try:
+        C_WEBHOOK.document(event_id).update({
+            "status": status,
+            "finishedAt": _server_ts(),
+            "payload": firestore.DELETE_FIELD,
+            "leaseUntil": firestore.DELETE_FIELD,
+        })
+    except Exception:
+        pass
+
+@firestore.transactional
+def _txn_fail_webhook_event(txn, ref, error: str) -> None:
+    snap = ref.get(transaction=txn)
+    if not snap.exists:
+        return
+    attempts = int((snap.to_dict() or {}).get("attempts") or 1)
+    upd: dict = {"error": error[:1000], "failedAt": _server_ts()}
+    if attempts >= WEBHOOK_MAX_ATTEMPTS:
+        upd.update(status="dead", leaseUntil=firestore.DELETE_FIELD)   # keeps the payload
+    else:
+        upd.update(status="failed",
+                   leaseUntil=_lease(min(60 * 2 ** attempts, WEBHOOK_RETRY_MAX_S)))
+    txn.update(ref, upd)
+
+def fail_webhook_event(event_id: str, error: str) -> None:
+    """Schedule a retry with exponential backoff, or park the event as dead."""
+    try:
+        _txn_fail_webhook_event(firestore.Transaction(_fs), C_WEBHOOK.document(event_id), error)
+    except Exception as e:
+        # the lease still runs out, so the drain job retries it anyway
+        print(f"[Warning] could not record webhook failure {event_id}: {e}")
+
+def index_stripe_customer(customer_id: str | None, user_id: str | None) -> None:
+    if not customer_id or not user_id:
+        return
+    C_STRIPE_IDX.document(customer_id).set({"userID": user_id})
+
+def user_id_for_stripe_customer(customer_id: str | None) -> str | None:
+    """Resolve a Stripe customer to our userID with a point read of the index."""
+    if not customer_id:
+        return None
+    snap = C_STRIPE_IDX.document(customer_id).get()
+    if snap.exists:
+        return (snap.to_dict() or {}).get("userID")
+    # not indexed yet (pre-index customer) → query once and fill the index
+    q = C_IDENTITY.where(filter=FieldFilter("stripeCustomerId", "==", customer_id)).limit(1).get()
+    if not q:
+        return None
+    user_id = (q[0].to_dict() or {}).get("userID")
+    try:
+        index_stripe_customer(customer_id, user_id)
+    except Exception:
+        pass
+    return user_id
+
+@firestore.transactional
+def _txn_advance_stripe_watermark(txn, user_id: str, key: str, created: int) -> bool:
+    q = C_IDENTITY.where(filter=FieldFilter("userID", "==", user_id)).limit(1).stream(transaction=txn)
+    snap = next(q, None)
+    if not snap:
+        return True     # nothing stored to compare against
+    seen = ((snap.to_dict() or {}).get("lastStripeEventTs") or {}).get(key)
+    if seen is not None and int(created) < int(seen):
+        return False
+    txn.update(snap.reference, {f"lastStripeEventTs.{key}": int(created)})
+    return True
+
+def advance_stripe_watermark(user_id: str, key: str, created: int) -> bool:
+    """
+    Compare-and-set identity.lastStripeEventTs.<key> to `created` (Stripe epoch
+    seconds). False when a newer event for the same key was already applied.
+    """
+    return _txn_advance_stripe_watermark(firestore.Transaction(_fs), user_id, key, int(created))
 
 def set_plan_for_user(user_id: str, plan: str, credits_per_month: int | None = None):
     ref, doc = _identity_ref_by_user_id(user_id)
@@ -1197,6 +1635,7 @@ def set_plan_for_user(user_id: str, plan: str, credits_per_month: int | None = N
         "monthlyCredits": int(cfg["monthly_cap"]),
     }
     ref.update(updates)
+    forget_ai_allowed(user_id)
     return updates["plan"]
 
 #--------------------UX stuff--------------------
@@ -1486,36 +1925,35 @@ def _ensure_avatar_url(user_id: str, doc: dict) -> str | None:
     return signed
 
 
+_IDENTITY_MIN_FIELDS = ["userID", "username", "photoUrl", "photoUrlPath", "photoUrlExp", "xp"]
+
 def fetch_identity_min(user_ids: list[str]) -> dict[str, dict]:
     """
     Batch fetch lightweight identity (username, photoUrl) for given user_ids.
     Ensures avatar URLs are public/stable.
-    Firestore 'in' queries allow up to ~10 values per call, so we chunk.
+    Identity docs are keyed by email, so this can't be a get_all by id; it is
+    one projected `in` query per 30 ids (Firestore's `in` limit), i.e. a
+    single round trip for a normal feed page.
     """
     out: dict[str, dict] = {}
     if not user_ids:
         return out
 
     # de-dupe while preserving order
-    seen = set()
-    ordered = []
-    for u in user_ids:
-        if u and u not in seen:
-            ordered.append(u); seen.add(u)
+    ordered = list(dict.fromkeys(u for u in user_ids if u))
 
-    chunk_size = 10
+    chunk_size = 30
     for i in range(0, len(ordered), chunk_size):
         chunk = ordered[i:i + chunk_size]
-        snaps = C_IDENTITY.where(filter=FieldFilter("userID", "in", chunk)).get()
+        snaps = (C_IDENTITY.where(filter=FieldFilter("userID", "in", chunk))
+                           .select(_IDENTITY_MIN_FIELDS)
+                           .stream())
         for s in snaps:
             d = s.to_dict() or {}
             uid = d.get("userID")
             if not uid:
                 continue
-            # Ensure defaults, then compute tier from xp (keeps legacy-safe)
-            doc = _ensure_progress_defaults(d)
-            xp = int(doc.get("xp", 0))
-            tier = _tier_for_xp(xp)
+            tier = _tier_for_xp(int(d.get("xp") or 0))
 
             username = d.get("username")
             photo = _ensure_avatar_url(uid, d) or d.get("photoUrl")
@@ -1570,10 +2008,7 @@ def _signed_url_v4(blob, ttl_seconds: int, method: str = "GET"):
 
 
 def _sign_any(path: str) -> tuple[str, int]:
-    blob = _bucket.blob(path)
-    url  = _signed_url_v4(blob, _SIGN_TTL, "GET")
-    expires = int(_dt.datetime.utcnow().timestamp()) + _SIGN_TTL
-    return url, expires
+    return _sign_cached(path)
 
 def usage_snapshot(user_id: str) -> dict:
     ref_q = C_IDENTITY.where(filter=FieldFilter("userID", "==", user_id)).limit(1).get()
@@ -1591,10 +2026,9 @@ def usage_snapshot(user_id: str) -> dict:
 
     day_iso = _today_local_iso()
     mkey    = _month_key_from_day(day_iso)
-    tu      = doc.get("tokenUsage") or {}
-
-    day_tokens = int((tu.get(day_iso) or {}).get("tokens", 0))
-    mon_tokens = int((tu.get(mkey)    or {}).get("tokens", 0))
+    day_tokens, mon_tokens = read_usage_tokens(
+        ref_q[0].reference, day_iso, mkey, legacy=doc.get("tokenUsage")
+    )
 
     day_used   = _credits_from_tokens(day_tokens)
     mon_used   = _credits_from_tokens(mon_tokens)
@@ -1624,27 +2058,49 @@ def usage_snapshot(user_id: str) -> dict:
     }
     return snap
 
+# Positive quota decisions are reused for a few seconds so the several gated
+# calls one request makes (e.g. /chat checks once per intent) share one read.
+# Any metering for the user (log_operation) or plan/bank change drops the entry.
+AI_QUOTA_CACHE_TTL_S = int(os.getenv("AI_QUOTA_CACHE_TTL_S", "10"))
+_ai_allowed_cache: TTLCache = TTLCache(maxsize=4096, ttl=AI_QUOTA_CACHE_TTL_S)
+_ai_allowed_lock = threading.Lock()
+
+def forget_ai_allowed(user_id: str) -> None:
+    with _ai_allowed_lock:
+        _ai_allowed_cache.pop(user_id, None)
+
 def check_ai_allowed(user_id: str) -> tuple[bool, dict]:
+    with _ai_allowed_lock:
+        cached = _ai_allowed_cache.get(user_id)
+    if cached is not None:
+        return True, cached
+
     s = usage_snapshot(user_id)
     base_allowed = (s["creditsLeft"] > 0) and (s["monthlyRemaining"] > 0)
+    bm = (s.get("bank") or {}).get("mode") or {}
 
     if base_allowed:
         # If bank was on, kill it silently now that normal credits are back.
-        try:
-            ref, _ = _identity_ref_by_user_id(user_id)
-            ref.update({"bankMode.enabled": False})
-        except Exception:
-            pass
-        return True, s
+        if bm.get("enabled"):
+            try:
+                ref, _ = _identity_ref_by_user_id(user_id)
+                ref.update({"bankMode.enabled": False})
+            except Exception:
+                pass
+        allowed = True
 
     # fallback to bank mode
-    bm = (s.get("bank") or {}).get("mode") or {}
-    if bm.get("enabled") and bm.get("source") in ("rollover", "rewards"):
+    elif bm.get("enabled") and bm.get("source") in ("rollover", "rewards"):
         bal = int((s["bank"]["rollover"] if bm["source"] == "rollover" else s["bank"]["rewards"]) or 0)
-        if bal > 0:
-            return True, s
+        allowed = bal > 0
 
-    return False, s
+    else:
+        allowed = False
+
+    if allowed:
+        with _ai_allowed_lock:
+            _ai_allowed_cache[user_id] = s
+    return allowed, s
 
 # --- Notifications ----------------------------------------------------
 def _utc_now() -> _dt.datetime:
@@ -1694,6 +2150,48 @@ def _txn_push_notif(
         txn.set(nref, _fs_safe(payload))
     return True
 
+def delete_refs(refs: list) -> None:
+    """Delete documents in batched commits (Firestore batch limit)."""
+    batch = _fs.batch(); count = 0
+    for ref in refs:
+        batch.delete(ref); count += 1
+        if count == 400:
+            batch.commit(); batch = _fs.batch(); count = 0
+    if count:
+        batch.commit()
+
+def push_notifications_batch(identity_ref, items: list[dict]) -> int:
+    """
+    Write several notifications for one user with a single existence read
+    (get_all) and a single batch commit. `items` hold push_notification's
+    kwargs (kind, title, body, data, dedupe_key, ttl_days). Same de-dupe
+    semantics: an existing keyed doc keeps its 'seen' and 'ts'.
+    """
+    staged: dict[str, tuple] = {}
+    for it in items:
+        nref = identity_ref.collection("notifications").document(_notif_doc_id(it.get("dedupe_key")))
+        payload = _fs_safe(_notif_payload(
+            it["kind"], it["title"], it.get("body", ""), it.get("data"), it.get("ttl_days", 14),
+        ))
+        staged[nref.path] = (nref, payload, bool(it.get("dedupe_key")))
+    if not staged:
+        return 0
+
+    keyed = [nref for nref, _, has_key in staged.values() if has_key]
+    existing = {snap.reference.path for snap in _fs.get_all(keyed) if snap.exists} if keyed else set()
+
+    batch = _fs.batch()
+    for path, (nref, payload, has_key) in staged.items():
+        if has_key and path in existing:
+            p = dict(payload)
+            p.pop("seen", None)
+            p.pop("ts", None)
+            batch.set(nref, p, merge=True)
+        else:
+            batch.set(nref, payload)
+    batch.commit()
+    return len(staged)
+
 def push_notification(user_id, kind, title, body, data=None, dedupe_key=None, ttl_days=14):
     ref, _ = _identity_ref_by_user_id(user_id)
     nref = ref.collection("notifications").document(_notif_doc_id(dedupe_key))
@@ -0,0 +1,38 @@
+# backfill_feed_counters.py
+# The community feed orders by likesCount/remixCount in Firestore, which only
+# matches docs that have both fields. Older projects_meta docs may lack them.
+from __future__ import annotations
+import argparse
+from app.services import storage_gcp as storage
+from app.services.storage_gcp import C_META
+
+def run(dry: bool = False):
+    batch = storage._fs.batch()
+    pending = 0
+    patched = 0
+    for s in C_META.stream():
+        meta = s.to_dict() or {}
+        upd = {f: 0 for f in ("likesCount", "remixCount") if f not in meta}
+        if not upd:
+            continue
+
+        print(f"{s.id}: {upd}")
+        patched += 1
+        if dry:
+            continue
+        batch.update(s.reference, upd)
+        pending += 1
+        if pending >= 400:
+            batch.commit()
+            batch = storage._fs.batch()
+            pending = 0
+
+    if pending and not dry:
+        batch.commit()
+    print("patched:", patched)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--dry", action="store_true")
+    args = ap.parse_args()
+    run(dry=args.dry)
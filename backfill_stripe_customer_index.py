@@ -0,0 +1,38 @@
+# backfill_stripe_customer_index.py
+# Webhooks resolve Stripe customers through stripe_customer_index/{customer_id};
+# seed it for identities that got a stripeCustomerId before the index existed.
+from __future__ import annotations
+import argparse
+from app.services import storage_gcp as storage
+from app.services.storage_gcp import C_IDENTITY, C_STRIPE_IDX
+
+def run(dry: bool = False):
+    batch = storage._fs.batch()
+    pending = 0
+    indexed = 0
+    for s in C_IDENTITY.select(["userID", "stripeCustomerId"]).stream():
+        d = s.to_dict() or {}
+        cid, uid = d.get("stripeCustomerId"), d.get("userID")
+        if not cid or not uid:
+            continue
+
+        print(f"{cid} -> {uid}")
+        indexed += 1
+        if dry:
+            continue
+        batch.set(C_STRIPE_IDX.document(cid), {"userID": uid})
+        pending += 1
+        if pending >= 400:
+            batch.commit()
+            batch = storage._fs.batch()
+            pending = 0
+
+    if pending and not dry:
+        batch.commit()
+    print("indexed:", indexed)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--dry", action="store_true")
+    args = ap.parse_args()
+    run(dry=args.dry)
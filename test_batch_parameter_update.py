@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Test script for single-pass batch parameter updates in CadQuery code.
+"""
+
+import sys
+import os
+
+# Add the app directory to Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+from app.services.cadam_style_parameter_extractor import CADAMStyleParameterExtractor
+
+CODE = """import cadquery as cq
+
+width = 10
+width_offset = 2
+height = 5.5
+label = "box"
+
+def build():
+    depth = 3
+    return cq.Workplane("XY").box(width, height, depth)
+
+result = build()
+"""
+
+
+def test_updates_all_assignments_in_one_pass():
+    """Every requested variable is rewritten, the rest of the code is untouched"""
+    print("🧪 Testing batch update...")
+    extractor = CADAMStyleParameterExtractor()
+    out = extractor.update_parameters_in_code(CODE, {"width": 20, "height": 7.25, "depth": 4})
+    assert "width = 20\n" in out, out
+    assert "height = 7.25\n" in out, out
+    assert "    depth = 4\n" in out, out          # indentation kept
+    assert "width_offset = 2\n" in out, out       # prefix-sharing name untouched
+    assert "box(width, height, depth)" in out, out
+    print("✅ All assignments updated")
+    return True
+
+
+def test_prefix_names_do_not_shadow():
+    """A short name never rewrites a longer one that starts with it"""
+    print("🧪 Testing prefix names...")
+    extractor = CADAMStyleParameterExtractor()
+    out = extractor.update_parameters_in_code(CODE, {"width": 1, "width_offset": 9})
+    assert "width = 1\n" in out and "width_offset = 9\n" in out, out
+    print("✅ Prefix names kept apart")
+    return True
+
+
+def test_value_formatting():
+    """Non-numeric strings are quoted, numeric strings are not"""
+    print("🧪 Testing value formatting...")
+    extractor = CADAMStyleParameterExtractor()
+    out = extractor.update_parameters_in_code(CODE, {"label": "lid", "height": "-2.5"})
+    assert 'label = "lid"\n' in out, out
+    assert "height = -2.5\n" in out, out
+    print("✅ Values formatted")
+    return True
+
+
+def test_matches_one_at_a_time_updates():
+    """The batch result equals applying each update separately"""
+    print("🧪 Testing equivalence with single updates...")
+    extractor = CADAMStyleParameterExtractor()
+    updates = {"width": 12, "height": 3, "label": "tray", "depth": 8}
+    sequential = CODE
+    for name, value in updates.items():
+        sequential = extractor.update_parameter_in_code(sequential, name, value)
+    assert extractor.update_parameters_in_code(CODE, updates) == sequential
+    print("✅ Batch and sequential updates agree")
+    return True
+
+
+def test_empty_and_unknown_updates():
+    """No updates, or updates for absent names, leave the code unchanged"""
+    print("🧪 Testing no-op updates...")
+    extractor = CADAMStyleParameterExtractor()
+    assert extractor.update_parameters_in_code(CODE, {}) == CODE
+    assert extractor.update_parameters_in_code(CODE, {"radius": 4}) == CODE
+    print("✅ Code unchanged")
+    return True
+
+
+def main():
+    """Run all tests"""
+    print("🚀 Running Batch Parameter Update Tests\n")
+
+    tests = [
+        test_updates_all_assignments_in_one_pass,
+        test_prefix_names_do_not_shadow,
+        test_value_formatting,
+        test_matches_one_at_a_time_updates,
+        test_empty_and_unknown_updates,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            if test():
+                passed += 1
+            else:
+                print(f"❌ {test.__name__} failed")
+        except Exception as e:
+            print(f"❌ {test.__name__} crashed: {e!r}")
+
+    print(f"\n📊 Test Results: {passed}/{len(tests)} tests passed")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
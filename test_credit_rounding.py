@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Test script for token → credit conversion (exact integer math in account routes).
+"""
+
+import sys
+import os
+from fractions import Fraction
+
+# Add the app directory to Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+from app.routes.account import _credits_from_tokens, _CREDIT_RATIO
+from app.services.storage_gcp import PROFIT_FACTOR, TOKENS_PER_CREDIT
+
+
+def _exact(tokens: int) -> int:
+    # round() on a Fraction is exact and rounds ties to even
+    return round(tokens * _CREDIT_RATIO)
+
+
+def test_ratio_matches_config():
+    """The precomputed ratio is PROFIT_FACTOR / TOKENS_PER_CREDIT"""
+    print("🧪 Testing credit ratio...")
+    assert _CREDIT_RATIO == Fraction(str(PROFIT_FACTOR)) / TOKENS_PER_CREDIT, _CREDIT_RATIO
+    print(f"✅ Ratio is {_CREDIT_RATIO}")
+    return True
+
+
+def test_small_and_zero_usage():
+    """Zero tokens cost nothing; below half a credit rounds down"""
+    print("🧪 Testing small usage...")
+    assert _credits_from_tokens(0) == 0
+    assert _credits_from_tokens(1) == 0
+    assert _credits_from_tokens(TOKENS_PER_CREDIT) == _exact(TOKENS_PER_CREDIT)
+    print("✅ Small usage converted")
+    return True
+
+
+def test_ties_round_to_even():
+    """Exact half credits round to the even neighbour, like round()"""
+    print("🧪 Testing ties...")
+    ties = 0
+    for tokens in range(0, 200_000, 8):
+        value = tokens * _CREDIT_RATIO
+        if value.denominator == 2:
+            ties += 1
+            got = _credits_from_tokens(tokens)
+            assert got % 2 == 0 and abs(got - value) == Fraction(1, 2), (tokens, got)
+    assert ties, "expected some exact half-credit totals"
+    print(f"✅ {ties} ties rounded to even")
+    return True
+
+
+def test_matches_exact_rounding():
+    """Integer path agrees with exact rational rounding across a wide range"""
+    print("🧪 Testing exact rounding...")
+    for tokens in list(range(0, 50_000, 7)) + [10**9 + 3, 10**15 + 4_000, 2**62 + 1]:
+        assert _credits_from_tokens(tokens) == _exact(tokens), tokens
+    print("✅ Matches exact rounding")
+    return True
+
+
+def test_float_tokens_still_accepted():
+    """Non-int token counts keep the float formula"""
+    print("🧪 Testing float tokens...")
+    assert _credits_from_tokens(12_345.0) == int(round(12_345.0 * PROFIT_FACTOR / TOKENS_PER_CREDIT))
+    print("✅ Float tokens converted")
+    return True
+
+
+def main():
+    """Run all tests"""
+    print("🚀 Running Credit Rounding Tests\n")
+
+    tests = [
+        test_ratio_matches_config,
+        test_small_and_zero_usage,
+        test_ties_round_to_even,
+        test_matches_exact_rounding,
+        test_float_tokens_still_accepted,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            if test():
+                passed += 1
+            else:
+                print(f"❌ {test.__name__} failed")
+        except Exception as e:
+            print(f"❌ {test.__name__} crashed: {e!r}")
+
+    print(f"\n📊 Test Results: {passed}/{len(tests)} tests passed")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
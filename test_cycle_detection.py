@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Test script for feature tree cycle detection (iterative Tarjan SCC).
+"""
+
+import sys
+import os
+
+# Add the app directory to Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+from app.models.feature_tree import (
+    FeatureTree, FeatureNode, FeatureType, FeatureReference, _find_cycles
+)
+
+
+def _node(node_id, *parents):
+    return FeatureNode(
+        id=node_id,
+        name=node_id,
+        feature_type=FeatureType.BOX,
+        parent_references=[FeatureReference(feature_id=p, entity_type="feature") for p in parents],
+    )
+
+
+def _nodes(*nodes):
+    return {n.id: n for n in nodes}
+
+
+def test_acyclic_graph_has_no_cycles():
+    """A diamond-shaped DAG is not a cycle"""
+    print("🧪 Testing acyclic graph...")
+    nodes = _nodes(_node("a"), _node("b", "a"), _node("c", "a"), _node("d", "b", "c"))
+    cycles = _find_cycles(nodes)
+    assert cycles == [], cycles
+    print("✅ No cycles reported")
+    return True
+
+
+def test_simple_cycle_detected_once():
+    """a → b → c → a is reported as a single component"""
+    print("🧪 Testing simple cycle...")
+    nodes = _nodes(_node("a", "c"), _node("b", "a"), _node("c", "b"), _node("d", "c"))
+    cycles = _find_cycles(nodes)
+    assert len(cycles) == 1, cycles
+    assert sorted(cycles[0]) == ["a", "b", "c"], cycles
+    print("✅ Cycle reported once, without the downstream node")
+    return True
+
+
+def test_self_reference_is_a_cycle():
+    """A node that references itself forms a one-node cycle"""
+    print("🧪 Testing self reference...")
+    nodes = _nodes(_node("a"), _node("b", "b"))
+    cycles = _find_cycles(nodes)
+    assert cycles == [["b"]], cycles
+    print("✅ Self loop reported")
+    return True
+
+
+def test_separate_cycles_reported_separately():
+    """Two disjoint cycles come back as two components"""
+    print("🧪 Testing disjoint cycles...")
+    nodes = _nodes(_node("a", "b"), _node("b", "a"), _node("x", "y"), _node("y", "x"))
+    cycles = sorted(sorted(c) for c in _find_cycles(nodes))
+    assert cycles == [["a", "b"], ["x", "y"]], cycles
+    print("✅ Both cycles reported")
+    return True
+
+
+def test_missing_parent_is_not_a_cycle():
+    """References to unknown nodes are ignored by cycle detection"""
+    print("🧪 Testing dangling reference...")
+    nodes = _nodes(_node("a", "ghost"))
+    assert _find_cycles(nodes) == []
+    print("✅ Dangling reference ignored")
+    return True
+
+
+def test_deep_chain_does_not_recurse():
+    """A chain far deeper than the recursion limit is handled iteratively"""
+    print("🧪 Testing deep chain...")
+    depth = sys.getrecursionlimit() * 3
+    chain = [_node("n0", f"n{depth - 1}")]
+    chain += [_node(f"n{i}", f"n{i - 1}") for i in range(1, depth)]
+    cycles = _find_cycles(_nodes(*chain))
+    assert len(cycles) == 1 and len(cycles[0]) == depth
+    print(f"✅ {depth}-node cycle found without recursion")
+    return True
+
+
+def test_validate_tree_reports_cycle():
+    """validate_tree surfaces cycles found by _find_cycles"""
+    print("🧪 Testing validate_tree...")
+    tree = FeatureTree(project_id="test_cycles", version=1, name="Cycles", created_by="test_user")
+    for node in (_node("a", "b"), _node("b", "a")):
+        tree.add_node(node)
+    errors = tree.validate_tree()
+    assert any(e.startswith("Circular dependency detected") for e in errors), errors
+    print("✅ Cycle reported by validate_tree")
+    return True
+
+
+def main():
+    """Run all tests"""
+    print("🚀 Running Cycle Detection Tests\n")
+
+    tests = [
+        test_acyclic_graph_has_no_cycles,
+        test_simple_cycle_detected_once,
+        test_self_reference_is_a_cycle,
+        test_separate_cycles_reported_separately,
+        test_missing_parent_is_not_a_cycle,
+        test_deep_chain_does_not_recurse,
+        test_validate_tree_reports_cycle,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            if test():
+                passed += 1
+            else:
+                print(f"❌ {test.__name__} failed")
+        except Exception as e:
+            print(f"❌ {test.__name__} crashed: {e!r}")
+
+    print(f"\n📊 Test Results: {passed}/{len(tests)} tests passed")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Test script for feature tree node removal (iterative subtree collection).
+"""
+
+import sys
+import os
+
+# Add the app directory to Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+from app.models.feature_tree import FeatureTree, FeatureNode, FeatureType
+
+
+def _tree():
+    return FeatureTree(project_id="test_removal", version=1, name="Removal", created_by="test_user")
+
+
+def _node(node_id):
+    return FeatureNode(id=node_id, name=node_id, feature_type=FeatureType.BOX)
+
+
+def _build(edges):
+    """edges: list of (node_id, parent_id or None), added in order"""
+    tree = _tree()
+    for node_id, parent_id in edges:
+        tree.add_node(_node(node_id), parent_id)
+    return tree
+
+
+def test_collect_subtree_preorder():
+    """_collect_subtree returns the node first, then every descendant once"""
+    print("🧪 Testing subtree collection...")
+    tree = _build([("root", None), ("a", "root"), ("b", "a"), ("c", "a"), ("d", "root")])
+    order = tree._collect_subtree("a")
+    assert order[0] == "a", order
+    assert sorted(order) == ["a", "b", "c"], order
+    assert tree._collect_subtree("missing") == []
+    print("✅ Subtree collected")
+    return True
+
+
+def test_remove_node_drops_descendants():
+    """Removing a node removes its whole subtree and unlinks it from the parent"""
+    print("🧪 Testing subtree removal...")
+    tree = _build([("root", None), ("a", "root"), ("b", "a"), ("c", "b"), ("d", "root")])
+    tree.remove_node("a")
+    assert set(tree.nodes) == {"root", "d"}, tree.nodes.keys()
+    assert tree.nodes["root"].child_ids == ["d"], tree.nodes["root"].child_ids
+    assert tree.regeneration_order == ["root", "d"], tree.regeneration_order
+    assert tree.root_node_id == "root"
+    print("✅ Subtree removed")
+    return True
+
+
+def test_remove_root_clears_root():
+    """Removing the root leaves an empty tree with no root"""
+    print("🧪 Testing root removal...")
+    tree = _build([("root", None), ("a", "root")])
+    tree.remove_node("root")
+    assert tree.nodes == {} and tree.regeneration_order == []
+    assert tree.root_node_id is None
+    print("✅ Root cleared")
+    return True
+
+
+def test_remove_missing_node_is_noop():
+    """Unknown ids are ignored"""
+    print("🧪 Testing missing node removal...")
+    tree = _build([("root", None)])
+    tree.remove_node("ghost")
+    assert set(tree.nodes) == {"root"}
+    print("✅ Nothing removed")
+    return True
+
+
+def test_remove_shared_child_once():
+    """A child listed under two parents is removed once, with no errors"""
+    print("🧪 Testing shared child...")
+    tree = _build([("root", None), ("a", "root"), ("b", "a")])
+    tree.nodes["root"].child_ids.append("b")
+    tree.remove_node("root")
+    assert tree.nodes == {}, tree.nodes.keys()
+    print("✅ Shared child removed once")
+    return True
+
+
+def test_remove_deep_chain():
+    """A chain far deeper than the recursion limit is removed iteratively"""
+    print("🧪 Testing deep chain removal...")
+    depth = sys.getrecursionlimit() * 3
+    edges = [("n0", None)] + [(f"n{i}", f"n{i - 1}") for i in range(1, depth)]
+    tree = _build(edges)
+    tree.remove_node("n1")
+    assert set(tree.nodes) == {"n0"}
+    assert tree.nodes["n0"].child_ids == []
+    print(f"✅ {depth - 1} nodes removed without recursion")
+    return True
+
+
+def main():
+    """Run all tests"""
+    print("🚀 Running Node Removal Tests\n")
+
+    tests = [
+        test_collect_subtree_preorder,
+        test_remove_node_drops_descendants,
+        test_remove_root_clears_root,
+        test_remove_missing_node_is_noop,
+        test_remove_shared_child_once,
+        test_remove_deep_chain,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            if test():
+                passed += 1
+            else:
+                print(f"❌ {test.__name__} failed")
+        except Exception as e:
+            print(f"❌ {test.__name__} crashed: {e!r}")
+
+    print(f"\n📊 Test Results: {passed}/{len(tests)} tests passed")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Test script for the in-process sliding-window rate limiter.
+"""
+
+import sys
+import os
+from types import SimpleNamespace
+
+# Add the app directory to Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+from app.services import rate_limit
+from app.services.rate_limit import SlidingWindowLimiter, client_ip
+
+
+class _Clock:
+    """Stand-in for time.monotonic so windows can be stepped deterministically"""
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _with_clock(fn):
+    clock = _Clock()
+    real = rate_limit.time
+    rate_limit.time = SimpleNamespace(monotonic=clock)
+    try:
+        return fn(clock)
+    finally:
+        rate_limit.time = real
+
+
+def test_allows_up_to_limit():
+    """max_calls hits pass, the next one is refused with a wait"""
+    print("🧪 Testing limit...")
+
+    def run(clock):
+        limiter = SlidingWindowLimiter(3, window_s=60)
+        assert [limiter.hit("u") for _ in range(3)] == [0.0, 0.0, 0.0]
+        wait = limiter.hit("u")
+        assert 59 < wait <= 60, wait
+    _with_clock(run)
+    print("✅ Fourth hit refused")
+    return True
+
+
+def test_window_slides():
+    """A slot frees exactly when the oldest hit leaves the window"""
+    print("🧪 Testing sliding window...")
+
+    def run(clock):
+        limiter = SlidingWindowLimiter(2, window_s=10)
+        assert limiter.hit("u") == 0.0
+        clock.now += 4
+        assert limiter.hit("u") == 0.0
+        clock.now += 5
+        wait = limiter.hit("u")
+        assert abs(wait - 1) < 1e-9, wait     # first hit expires in 1s
+        clock.now += 1
+        assert limiter.hit("u") == 0.0
+        assert limiter.hit("u") > 0           # second hit still in window
+    _with_clock(run)
+    print("✅ Window slides")
+    return True
+
+
+def test_refused_hits_do_not_count():
+    """Rejected calls don't extend the caller's lockout"""
+    print("🧪 Testing rejected hits...")
+
+    def run(clock):
+        limiter = SlidingWindowLimiter(1, window_s=10)
+        assert limiter.hit("u") == 0.0
+        for _ in range(20):
+            assert limiter.hit("u") > 0
+        clock.now += 10
+        assert limiter.hit("u") == 0.0
+    _with_clock(run)
+    print("✅ Lockout not extended")
+    return True
+
+
+def test_keys_are_independent():
+    """One key's usage never limits another"""
+    print("🧪 Testing independent keys...")
+    limiter = SlidingWindowLimiter(1, window_s=60)
+    assert limiter.hit("a:like") == 0.0
+    assert limiter.hit("a:like") > 0
+    assert limiter.hit("b:like") == 0.0
+    assert limiter.hit("a:view") == 0.0
+    print("✅ Keys independent")
+    return True
+
+
+def _request(xff=None, host="10.0.0.9"):
+    headers = {"x-forwarded-for": xff} if xff is not None else {}
+    return SimpleNamespace(headers=headers, client=SimpleNamespace(host=host))
+
+
+def test_client_ip_uses_proxy_hop():
+    """Spoofed leading X-Forwarded-For entries are ignored"""
+    print("🧪 Testing client IP...")
+    real = rate_limit.TRUSTED_PROXY_HOPS
+    try:
+        rate_limit.TRUSTED_PROXY_HOPS = 1
+        assert client_ip(_request("6.6.6.6, 203.0.113.7")) == "203.0.113.7"
+        assert client_ip(_request("203.0.113.7")) == "203.0.113.7"
+        assert client_ip(_request()) == "10.0.0.9"
+        rate_limit.TRUSTED_PROXY_HOPS = 2
+        assert client_ip(_request("6.6.6.6, 203.0.113.7, 35.1.1.1")) == "203.0.113.7"
+        assert client_ip(_request("35.1.1.1")) == "10.0.0.9"
+        rate_limit.TRUSTED_PROXY_HOPS = 0
+        assert client_ip(_request("6.6.6.6")) == "10.0.0.9"
+    finally:
+        rate_limit.TRUSTED_PROXY_HOPS = real
+    print("✅ Client IP taken from the trusted hop")
+    return True
+
+
+def main():
+    """Run all tests"""
+    print("🚀 Running Rate Limit Tests\n")
+
+    tests = [
+        test_allows_up_to_limit,
+        test_window_slides,
+        test_refused_hits_do_not_count,
+        test_keys_are_independent,
+        test_client_ip_uses_proxy_hop,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            if test():
+                passed += 1
+            else:
+                print(f"❌ {test.__name__} failed")
+        except Exception as e:
+            print(f"❌ {test.__name__} crashed: {e!r}")
+
+    print(f"\n📊 Test Results: {passed}/{len(tests)} tests passed")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Test script for single-flight deduplication of identical in-flight requests.
+"""
+
+import sys
+import os
+import threading
+import time
+
+# Add the app directory to Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+from app.main import _single_flight, _flight_key, _SF_CALLS
+
+
+def _run_concurrently(key, fn, n):
+    """Start n callers of _single_flight(key, fn); return [(result, error)] in order"""
+    out = [None] * n
+
+    def call(i):
+        try:
+            out[i] = (_single_flight(key, fn), None)
+        except Exception as e:
+            out[i] = (None, e)
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    return out
+
+
+def test_followers_share_leader_result():
+    """Identical concurrent calls run fn once and all get its result"""
+    print("🧪 Testing shared result...")
+    calls = []
+    release = threading.Event()
+
+    def work():
+        calls.append(1)
+        release.wait(2)
+        return {"ok": len(calls)}
+
+    key = _flight_key("test", "shared")
+    threading.Timer(0.2, release.set).start()
+    out = _run_concurrently(key, work, 5)
+    assert len(calls) == 1, calls
+    assert all(err is None and res == {"ok": 1} for res, err in out), out
+    assert key not in _SF_CALLS
+    print("✅ One call, five results")
+    return True
+
+
+def test_followers_share_leader_exception():
+    """A failing leader raises the same exception in every waiting caller"""
+    print("🧪 Testing shared exception...")
+    calls = []
+
+    def work():
+        calls.append(1)
+        time.sleep(0.2)
+        raise ValueError("boom")
+
+    key = _flight_key("test", "error")
+    out = _run_concurrently(key, work, 4)
+    assert len(calls) == 1, calls
+    assert all(isinstance(err, ValueError) for _, err in out), out
+    assert key not in _SF_CALLS
+    print("✅ Exception shared")
+    return True
+
+
+def test_sequential_calls_run_again():
+    """Once a flight finishes, the next identical call does the work again"""
+    print("🧪 Testing sequential calls...")
+    calls = []
+    key = _flight_key("test", "sequential")
+    assert _single_flight(key, lambda: calls.append(1) or len(calls)) == 1
+    assert _single_flight(key, lambda: calls.append(1) or len(calls)) == 2
+    print("✅ Finished flights are not cached")
+    return True
+
+
+def test_distinct_keys_do_not_wait():
+    """Different keys run independently"""
+    print("🧪 Testing distinct keys...")
+    release = threading.Event()
+    slow = threading.Thread(
+        target=_single_flight, args=(_flight_key("test", "slow"), lambda: release.wait(2))
+    )
+    slow.start()
+    try:
+        started = time.monotonic()
+        assert _single_flight(_flight_key("test", "fast"), lambda: "fast") == "fast"
+        assert time.monotonic() - started < 1
+    finally:
+        release.set()
+        slow.join(5)
+    print("✅ Other keys unaffected")
+    return True
+
+
+def test_flight_key_distinguishes_parts():
+    """Keys depend on every part, and None differs from the string 'None'"""
+    print("🧪 Testing flight keys...")
+    assert _flight_key("a", 1, "q") == _flight_key("a", 1, "q")
+    assert _flight_key("a", 1, "q") != _flight_key("a", 2, "q")
+    assert _flight_key("a", None) != _flight_key("a", "None")
+    print("✅ Keys are distinct")
+    return True
+
+
+def main():
+    """Run all tests"""
+    print("🚀 Running Single-Flight Tests\n")
+
+    tests = [
+        test_followers_share_leader_result,
+        test_followers_share_leader_exception,
+        test_sequential_calls_run_again,
+        test_distinct_keys_do_not_wait,
+        test_flight_key_distinguishes_parts,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            if test():
+                passed += 1
+            else:
+                print(f"❌ {test.__name__} failed")
+        except Exception as e:
+            print(f"❌ {test.__name__} crashed: {e!r}")
+
+    print(f"\n📊 Test Results: {passed}/{len(tests)} tests passed")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
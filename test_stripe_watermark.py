@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Test script for the per-user Stripe event watermark that drops stale webhooks.
+"""
+
+import sys
+import os
+
+# Add the app directory to Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+from app.routes import billing
+from app.services import storage_gcp
+
+
+class _Snap:
+    def __init__(self, data):
+        self._data = data
+        self.reference = "identity/u1"
+
+    def to_dict(self):
+        return self._data
+
+
+class _Txn:
+    def __init__(self, doc):
+        self.doc = doc
+
+    def update(self, ref, fields):
+        for path, value in fields.items():
+            head, _, tail = path.partition(".")
+            self.doc.setdefault(head, {})[tail] = value
+
+
+class _Identity:
+    """Enough of C_IDENTITY for `where(...).limit(1).stream(transaction=...)`"""
+    def __init__(self, doc):
+        self.doc = doc
+
+    def where(self, **_):
+        return self
+
+    def limit(self, _):
+        return self
+
+    def stream(self, transaction=None):
+        return iter([_Snap(self.doc)] if self.doc is not None else [])
+
+
+def _advance(doc, created, key="plan"):
+    """Run the watermark transaction body against an in-memory identity doc"""
+    real = storage_gcp.C_IDENTITY
+    storage_gcp.C_IDENTITY = _Identity(doc)
+    try:
+        txn_fn = storage_gcp._txn_advance_stripe_watermark
+        body = getattr(txn_fn, "to_wrap", txn_fn)   # unwrap @firestore.transactional
+        return body(_Txn(doc), "u1", key, created)
+    finally:
+        storage_gcp.C_IDENTITY = real
+
+
+def test_watermark_advances_and_rejects_older():
+    """Newer or equal events move the watermark; older ones are refused"""
+    print("🧪 Testing watermark compare-and-set...")
+    doc = {}
+    assert _advance(doc, 100) is True
+    assert doc["lastStripeEventTs"]["plan"] == 100
+    assert _advance(doc, 150) is True
+    assert _advance(doc, 150) is True          # same second is not stale
+    assert _advance(doc, 120) is False
+    assert doc["lastStripeEventTs"]["plan"] == 150
+    print("✅ Watermark only moves forward")
+    return True
+
+
+def test_watermark_keys_are_separate():
+    """Each key keeps its own watermark"""
+    print("🧪 Testing watermark keys...")
+    doc = {"lastStripeEventTs": {"plan": 500}}
+    assert _advance(doc, 100, key="credits") is True
+    assert _advance(doc, 100, key="plan") is False
+    print("✅ Keys independent")
+    return True
+
+
+def test_unknown_user_is_never_stale():
+    """Without an identity doc there's nothing to compare against"""
+    print("🧪 Testing unknown user...")
+    assert _advance(None, 1) is True
+    print("✅ Unknown user allowed")
+    return True
+
+
+def _with_watermark(fn):
+    marks = {}
+
+    def advance(user_id, key, created):
+        seen = marks.get((user_id, key))
+        if seen is not None and int(created) < seen:
+            return False
+        marks[(user_id, key)] = int(created)
+        return True
+
+    real = billing.storage.advance_stripe_watermark
+    billing.storage.advance_stripe_watermark = advance
+    try:
+        return fn()
+    finally:
+        billing.storage.advance_stripe_watermark = real
+
+
+def test_is_stale_drops_late_redelivery():
+    """A delayed older event arriving after a newer one is stale"""
+    print("🧪 Testing late redelivery...")
+
+    def run():
+        assert billing._is_stale({"created": 200}, "u1") is False
+        assert billing._is_stale({"created": 100}, "u1") is True
+        assert billing._is_stale({"created": 100}, "u2") is False
+        assert billing._is_stale({}, "u3") is False
+    _with_watermark(run)
+    print("✅ Late event skipped")
+    return True
+
+
+def test_is_stale_fails_open():
+    """A watermark read error processes the event rather than dropping it"""
+    print("🧪 Testing watermark errors...")
+    real = billing.storage.advance_stripe_watermark
+
+    def broken(*_):
+        raise RuntimeError("firestore unavailable")
+
+    billing.storage.advance_stripe_watermark = broken
+    try:
+        assert billing._is_stale({"created": 1}, "u1") is False
+    finally:
+        billing.storage.advance_stripe_watermark = real
+    print("✅ Errors don't drop events")
+    return True
+
+
+def main():
+    """Run all tests"""
+    print("🚀 Running Stripe Watermark Tests\n")
+
+    tests = [
+        test_watermark_advances_and_rejects_older,
+        test_watermark_keys_are_separate,
+        test_unknown_user_is_never_stale,
+        test_is_stale_drops_late_redelivery,
+        test_is_stale_fails_open,
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            if test():
+                passed += 1
+            else:
+                print(f"❌ {test.__name__} failed")
+        except Exception as e:
+            print(f"❌ {test.__name__} crashed: {e!r}")
+
+    print(f"\n📊 Test Results: {passed}/{len(tests)} tests passed")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())